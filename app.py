@@ -1,13 +1,20 @@
 from urllib.parse import urlparse, urlunparse
-from flask import Flask, flash, jsonify, redirect, session, url_for, request, render_template, abort
+from flask import Flask, Response, flash, jsonify, redirect, session, url_for, request, render_template, abort, stream_with_context
 from oauth import create_flow, store_credentials_in_session
-from main import process_seo_improvement, get_history_for_user
-import firebase_admin
-from firebase_admin import firestore as fa_firestore, auth as firebase_auth
 from oauth import exchange_code_and_store, get_user_credentials
 from werkzeug.middleware.proxy_fix import ProxyFix
+import json
 import os
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from cache_utils import LRUCache, get_shared_store
+from firebase_app import get_auth, get_db
+from improvement_writer import get_improvement_writer
+from metrics import render_prometheus
+from jobs import JobLimitExceeded, STATUS_DONE, get_job_queue
+from result_store import COLUMN_KEYS, query_rows, row_count, row_order
+from result_store import unpack_result, load_result_blobs, delete_result_blobs
 #os.environ['OAUTHLIB_INSECURE_TRANSPORT'] = '1' 
 
 app = Flask(__name__)
@@ -15,14 +22,8 @@ app.secret_key = os.getenv("FLASK_SECRET_KEY", "defaultsecretkey")
 app.wsgi_app = ProxyFix(app.wsgi_app, x_proto=1, x_host=1)
 app.config['PREFERRED_URL_SCHEME'] = 'https'
 
-
-#cred = credentials.Certificate("credentials.json")
-#firebase_admin.initialize_app(cred)
-try:
-    firebase_admin.get_app()
-except ValueError:
-    firebase_admin.initialize_app()
-db = fa_firestore.client()
+# 解析（main: pandas / Google API / OpenAI など）と Firebase は最初に使うときに読み込む。
+# /privacy・/terms・/login の表示だけならコールドスタートでそれらを読み込まない。
 
 def to_sc_property(raw_url: str) -> str:
     """
@@ -69,6 +70,14 @@ def is_oauth_authenticated():
     # Firestore に保存済みのトークンがあれば True
     return get_user_credentials(uid) is not None
 
+def process_seo_improvement(*args, principal=None, **kwargs):
+    """
+    main.run_seo_improvement（実行中の同じ解析があれば合流する）。
+    main は pandas や各 API クライアントを読むので初回呼び出し時に import する。
+    """
+    from main import run_seo_improvement
+    return run_seo_improvement(*args, principal=principal, **kwargs)
+
 def _to_site_root(u: str) -> str:
     if not u.startswith(("http://","https://")):
         u = "https://" + u
@@ -90,7 +99,7 @@ def load_site_config(uid: str | None, input_url: str):
 
     if uid:
         doc = (
-            db.collection("sites").document(uid)
+            get_db().collection("sites").document(uid)
               .collection("owned").document(_site_key(root)).get()
         )
         if doc.exists:
@@ -101,24 +110,42 @@ def load_site_config(uid: str | None, input_url: str):
 
     return root, sc_prop, ga_prop, sheet_id
 
-def load_history_from_db(uid):
-    """Firestore から当該ユーザーの履歴を降順で取得してリスト化"""
-    history = []
-    docs = (
-        db.collection("improvements")
-          .where("uid", "==", uid)
-          .order_by("timestamp", direction=fa_firestore.Query.DESCENDING)
-          .stream()
-    )
-    for d in docs:
-        rec = d.to_dict()
-        history.append({
-            "id":               d.id,
-            "input_url":        rec.get("input_url"),
-            "timestamp":        rec.get("timestamp").strftime("%Y-%m-%d %H:%M"),
-            "chatgpt_response": rec.get("result", {}).get("chatgpt_response", "")
-        })
-    return history
+def load_history_from_db(uid, cursor=None):
+    """Firestore から当該ユーザーの履歴を降順で 1 ページ分取得する → (items, next_cursor)"""
+    if not uid:
+        return [], None
+    from main import get_history_page
+    items, next_cursor = get_history_page(uid, cursor=cursor)
+    if cursor is None:
+        items = _with_pending_history(uid, items)
+    return items, next_cursor
+
+def _with_pending_history(uid, items: list) -> list:
+    """まだ Firestore に書いていない履歴（write-behind のキュー）を先頭に足す"""
+    loaded = {item["id"] for item in items}
+    pending = [item for item in get_improvement_writer().pending_history(uid) if item["id"] not in loaded]
+    return pending + items
+
+# 解析と並行して履歴の先頭ページを読んでおき、結果画面を Firestore の往復で待たせない
+HISTORY_PREFETCH_WAIT = float(os.getenv("HISTORY_PREFETCH_WAIT", "1.0"))   # 解析後にまだ読めていなければ待つ秒数
+_history_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="history-prefetch")
+
+def _prefetch_history(uid):
+    if not uid:
+        return None
+    from main import get_history_page
+    return _history_pool.submit(get_history_page, uid)
+
+def _prefetched_history(uid, future):
+    """先読みした履歴＋書き込み待ちの履歴。間に合わなければ書き込み待ちの分だけ表示する"""
+    if not uid:
+        return [], None
+    try:
+        items, next_cursor = future.result(timeout=HISTORY_PREFETCH_WAIT)
+    except Exception as e:
+        print("履歴の先読みスキップ:", e)
+        items, next_cursor = [], None
+    return _with_pending_history(uid, items), next_cursor
 
 def _no_keywords(result: dict) -> bool:
     """結果オブジェクトから 'キーワードが無い' を推定"""
@@ -132,10 +159,172 @@ def _no_keywords(result: dict) -> bool:
     return False
 
 
+# 競合を調べる GSC キーワードの数（表示回数の上位から。SerpAPI の呼び出し数もこの数になる）
+COMPETITOR_KEYWORDS = int(os.getenv("COMPETITOR_KEYWORDS", "3"))
+
+# 画面に分かりやすいメッセージ
+NO_KEYWORDS_MESSAGE = (
+    "⚠️ 検索キーワードが取得できませんでした。"
+    "Search Console に対象サイトのデータがあるか、対象期間/プロパティ設定（URLプレフィックス or ドメイン）を見直してください。"
+)
+
+def _save_improvement(uid: str, input_url: str, result: dict) -> str:
+    """
+    解析結果の保存を write-behind のキューに積み、ドキュメントIDをすぐ返す
+    （コンパクト形式への変換と Firestore への書き込みはバックグラウンド）
+    """
+    return get_improvement_writer().save(uid, input_url, result)
+
+def _load_improvement(uid: str, doc_id: str) -> dict | None:
+    """保存済みの解析結果を読み出し、表示用に展開する（本人のもののみ）"""
+    pending = get_improvement_writer().get_pending(doc_id)
+    if pending is not None:
+        # まだ書き込み待ち（メモリ上の結果をそのまま使う）
+        if pending["uid"] != uid:
+            return None
+        return {"input_url": pending["input_url"], "result": pending["result"]}
+    doc_ref = get_db().collection("improvements").document(doc_id)
+    snap = doc_ref.get()
+    if not snap.exists:
+        return None
+    rec = snap.to_dict() or {}
+    if rec.get("uid") != uid:
+        return None
+    return {
+        "input_url": rec.get("input_url", ""),
+        "result":    unpack_result(rec.get("result"), lambda: load_result_blobs(doc_ref)),
+    }
+
+# --- 改善案のストリーミング配信（SSE） ------------------------------------------
+# 解析結果の画面を先に返し、ChatGPT の生成は /suggestion/stream/<id> でトークンごとに流す。
+# EventSource の接続は画面を返したのと別の gunicorn ワーカーに届くことがあるので、
+# 登録はワーカー間で共有する SQLite（cache_utils の共有ストア）に置く。
+_SUGGESTION_NAMESPACE = "suggestion_stream"
+_SUGGESTION_TTL = 600
+
+def _register_suggestion_stream(uid, prompt: str, doc_id: str | None) -> str:
+    stream_id = uuid.uuid4().hex
+    get_shared_store().set(
+        _SUGGESTION_NAMESPACE, stream_id, {"uid": uid, "prompt": prompt, "doc_id": doc_id}, ttl=_SUGGESTION_TTL,
+    )
+    return stream_id
+
+def _pop_suggestion_stream(stream_id: str) -> dict | None:
+    store = get_shared_store()
+    pending = store.get(_SUGGESTION_NAMESPACE, stream_id)
+    if pending is not None:
+        store.delete(_SUGGESTION_NAMESPACE, stream_id)   # 1 回だけ使う
+    return pending
+
+@app.route("/suggestion/stream/<stream_id>")
+def suggestion_stream(stream_id):
+    pending = _pop_suggestion_stream(stream_id)
+    if not pending or pending["uid"] != session.get("uid"):
+        abort(404)
+
+    from chatgpt_utils import stream_chatgpt_response
+
+    def _events():
+        parts = []
+        try:
+            for delta in stream_chatgpt_response(pending["prompt"]):
+                parts.append(delta)
+                yield f"data: {json.dumps({'delta': delta}, ensure_ascii=False)}\n\n"
+        except Exception:
+            # 途中で切れた応答は完了扱いにも保存もしない
+            yield f"event: failed\ndata: {{}}\n\n"
+            return
+        text = "".join(parts).strip()
+        if not text:
+            yield f"event: failed\ndata: {{}}\n\n"
+            return
+        yield "event: done\ndata: {}\n\n"
+        # 履歴にも生成結果を残す
+        if pending["doc_id"]:
+            get_improvement_writer().update(pending["doc_id"], {"result.chatgpt_response": text})
+
+    return Response(
+        stream_with_context(_events()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+# --- 表の行 API --------------------------------------------------------------
+# 結果画面に表全体（数千行の HTML）を埋め込まず、/results/<id>/rows から
+# ソート・絞り込み済みの 1 ページ分だけ JSON で返す。列データは結果 ID ごとにメモリに置き、
+# 無ければ（別ワーカー・期限切れ）保存済みの結果から読み直す。
+TABLE_PAGE_MAX = 500
+_result_tables = LRUCache(maxsize=256, ttl=3600)
+
+def _register_table(owner: str, columns: dict, table_id: str | None = None) -> str:
+    """列データを行 API で引けるようにして ID を返す（保存済みならドキュメントIDを使う）"""
+    table_id = table_id or uuid.uuid4().hex
+    _result_tables.set(table_id, {"owner": owner, "columns": columns or {}, "orders": {}})
+    return table_id
+
+def _table_view(owner: str, columns: dict, table_id: str | None = None) -> dict:
+    """result.html に渡す表の情報（行は画面から行 API で読む）"""
+    total = row_count(columns)
+    if not total:
+        return {"table_url": None, "table_total": 0}
+    table_id = _register_table(owner, columns, table_id)
+    return {"table_url": url_for("result_rows", table_id=table_id), "table_total": total}
+
+def _float_arg(name: str):
+    try:
+        return float(request.args[name]) if request.args.get(name) not in (None, "") else None
+    except ValueError:
+        abort(400, f"{name} は数値で指定してください")
+
+@app.route("/results/<table_id>/rows")
+def result_rows(table_id):
+    """
+    表の行を JSON で返す。
+    sort=clicks|impressions|ctr|position|conversions|url, order=asc|desc, q=URL の部分一致,
+    min_<列>/max_<列>=範囲, offset, limit（最大 TABLE_PAGE_MAX）
+    """
+    owner = _job_owner()
+    entry = _result_tables.get(table_id)
+    if entry is None and session.get("uid"):
+        saved = _load_improvement(session["uid"], table_id)
+        if saved is not None:
+            _register_table(owner, saved["result"].get("table_columns") or {}, table_id)
+            entry = _result_tables.get(table_id)
+    if entry is None or entry["owner"] != owner:
+        abort(404)
+
+    sort = request.args.get("sort") or None
+    if sort is not None and sort not in COLUMN_KEYS:
+        abort(400, "sort の列が不正です")
+    descending = request.args.get("order", "desc" if sort else "asc") == "desc"
+    order = entry["orders"].get((sort, descending))
+    if order is None:
+        # 並べ替えは結果・列・向きごとに 1 回だけ（ページ送りでは使い回す）
+        order = entry["orders"][(sort, descending)] = row_order(entry["columns"], sort, descending)
+
+    ranges = {}
+    for key in COLUMN_KEYS:
+        lo, hi = _float_arg(f"min_{key}"), _float_arg(f"max_{key}")
+        if lo is not None or hi is not None:
+            ranges[key] = (lo, hi)
+    offset = max(0, request.args.get("offset", 0, type=int))
+    limit = min(max(1, request.args.get("limit", 100, type=int)), TABLE_PAGE_MAX)
+
+    total, rows = query_rows(
+        entry["columns"], order, q=request.args.get("q", ""), ranges=ranges, offset=offset, limit=limit
+    )
+    return jsonify({
+        "columns": [key for key, name in COLUMN_KEYS.items() if name in entry["columns"]],
+        "rows":    rows,
+        "total":   total,
+        "offset":  offset,
+        "limit":   limit,
+    })
+
+
 @app.route("/", methods=["GET", "POST"])
 def index():
-    uid = session.get("uid")
-    history = get_history_for_user(uid) if uid else []
     competitors = []
     
     if request.method == "POST":
@@ -153,55 +342,172 @@ def index():
 
             input_url = request.form["url"].strip()
             site_root, sc_property, ga_property, sheet_id = load_site_config(uid, input_url)
+            history_future = _prefetch_history(uid)
 
             try:
                 result = process_seo_improvement(
+                    principal=uid,               # 結果を他のユーザーと共有してよいかの判定用
                     url=input_url,               # 画面表示用にフルURLを渡す
                     creds=creds,                 # ★ ユーザーOAuth（NoneでもOK：内部でskipする実装に）
                     sc_property=sc_property,     # ★ "sc-domain:..." or "https://..."
                     ga_property=ga_property,     # ★ "properties/123..."（未設定なら None でOK）
                     sheet_id=sheet_id,           # ★ 任意
                     skip_metrics=effective_skip, # ★ TrueならGA/GSC/Sheetsを完全スキップ
+                    competitor_keywords=COMPETITOR_KEYWORDS,
+                    # ★ ここに来るのは JavaScript 無効時のフォーム送信だけ（JS ありは /jobs）。
+                    #   EventSource が使えないので改善案はこの場で生成する
+                    defer_suggestion=False,
                 )
             except Exception as e:
                 app.logger.exception("analysis failed")
                 abort(500, "内部エラーが発生しました。設定を見直してください。")
             if not effective_skip and _no_keywords(result):
-            # 画面に分かりやすいメッセージ
-                friendly = (
-                    "⚠️ 検索キーワードが取得できませんでした。"
-                    "Search Console に対象サイトのデータがあるか、対象期間/プロパティ設定（URLプレフィックス or ドメイン）を見直してください。"
-                )
                 # 履歴には残さない（誤記録防止）
-                return render_template("index.html", result=friendly, history=history)
+                return render_template("index.html", result=NO_KEYWORDS_MESSAGE)
             competitors = result.get("competitors", [])
+            result.pop("chatgpt_prompt", None)   # プロンプトは保存しない
 
+            doc_id = None
             if uid:
-                doc = {
-                    "uid":            uid,
-                    "input_url":      input_url,
-                    "result":         result,
-                    "timestamp":      datetime.utcnow()
-                }
-                db.collection("improvements").add(doc)
-                # 追加後、再取得して最新順にする
-                history = get_history_for_user(uid)
-
+                doc_id = _save_improvement(uid, input_url, result)
+            # 保存は待たない。先読みした履歴の先頭に今回の結果（書き込み待ち）を足して表示する
+            history, history_cursor = _prefetched_history(uid, history_future)
 
             return render_template(
                 "result.html",
                 site_url=input_url,
-                table_html=result["table_html"],
+                **_table_view(_job_owner(), result.get("table_columns"), doc_id),
                 chart_labels=result["chart_labels"],
                 chart_data=result["chart_data"],
                 competitors=competitors,
                 chatgpt_response=result.get("chatgpt_response", ""),
-                history=history
+                history=history,
+                history_cursor=history_cursor,
             )
     return render_template(
         "index.html"
         )
 
+# --- バックグラウンド解析ジョブ ---------------------------------------------------
+# POST /jobs でジョブIDを即時に返し、解析はワーカープールで実行する。
+# 画面は GET /jobs/<id> をポーリングし、完了したら /jobs/<id>/view で結果を表示する。
+
+def _job_owner() -> str:
+    """ジョブの所有者キー（未ログインでもセッション単位で区別する）"""
+    uid = session.get("uid")
+    if uid:
+        return uid
+    if "anon_id" not in session:
+        session["anon_id"] = uuid.uuid4().hex
+    return "anon:" + session["anon_id"]
+
+def _run_analysis_job(payload: dict) -> dict:
+    """ワーカースレッドで実行される解析本体（リクエストコンテキストには触れない）"""
+    uid = payload.get("uid")
+    input_url = payload["input_url"]
+    skip = payload["skip_metrics"]
+
+    creds = None if skip else get_user_credentials(uid)
+    skip = skip or creds is None
+    site_root, sc_property, ga_property, sheet_id = load_site_config(uid, input_url)
+
+    result = process_seo_improvement(
+        principal=uid,
+        url=input_url,
+        creds=creds,
+        sc_property=sc_property,
+        ga_property=ga_property,
+        sheet_id=sheet_id,
+        skip_metrics=skip,
+        competitor_keywords=COMPETITOR_KEYWORDS,
+        defer_suggestion=True,   # 改善案は結果画面（/jobs/<id>/view）から SSE で流す
+    )
+    if not skip and _no_keywords(result):
+        return {"input_url": input_url, "notice": NO_KEYWORDS_MESSAGE, "result": None, "doc_id": None}
+
+    prompt = result.pop("chatgpt_prompt", "")   # プロンプトは improvements には保存しない
+    doc_id = _save_improvement(uid, input_url, result) if uid else None
+    return {"input_url": input_url, "notice": None, "result": result, "doc_id": doc_id, "prompt": prompt}
+
+def _owned_job_or_404(job_id: str) -> dict:
+    job = get_job_queue().get(job_id)
+    if not job or job["owner"] != _job_owner():
+        abort(404)
+    return job
+
+@app.route("/jobs", methods=["POST"])
+def submit_job():
+    body = request.get_json(silent=True) or request.form
+    input_url = (body.get("url") or "").strip()
+    if not input_url:
+        return jsonify({"error": "URLが空です。"}), 400
+    skip_metrics = body.get("skip_metrics") in (True, "on", "true", "1")
+
+    uid = session.get("uid")
+    notice = None
+    if not skip_metrics and not (uid and is_oauth_authenticated()):
+        skip_metrics = True
+        notice = "Google Analytics / Search Console の連携がありません。データ連携なしで実行します。"
+
+    try:
+        job_id = get_job_queue().submit(
+            _job_owner(),
+            _run_analysis_job,
+            {"uid": uid, "input_url": input_url, "skip_metrics": skip_metrics},
+        )
+    except JobLimitExceeded as e:
+        return jsonify({"error": str(e)}), 429
+
+    return jsonify({
+        "job_id":     job_id,
+        "status_url": url_for("job_status", job_id=job_id),
+        "view_url":   url_for("job_view", job_id=job_id),
+        "notice":     notice,
+    }), 202
+
+@app.route("/jobs/<job_id>")
+def job_status(job_id):
+    job = _owned_job_or_404(job_id)
+    return jsonify({
+        "job_id":  job["id"],
+        "status":  job["status"],
+        "error":   "解析に失敗しました。設定を見直してください。" if job.get("error") else None,
+        "view_url": url_for("job_view", job_id=job_id) if job["status"] == STATUS_DONE else None,
+    })
+
+@app.route("/jobs/<job_id>/view")
+def job_view(job_id):
+    job = _owned_job_or_404(job_id)
+    if job["status"] != STATUS_DONE:
+        return render_template("index.html", result="解析中です。しばらくしてから再読み込みしてください。")
+
+    out = job["result"] or {}
+    if out.get("notice"):
+        return render_template("index.html", result=out["notice"])
+
+    uid = session.get("uid")
+    history, history_cursor = load_history_from_db(uid)
+    result = out["result"]
+
+    # 改善案は画面表示後に SSE で流す（再表示のたびに登録するが、生成済みなら応答キャッシュから返る）
+    suggestion_stream_url = None
+    if out.get("prompt") and not result.get("chatgpt_response"):
+        stream_id = _register_suggestion_stream(uid, out["prompt"], out.get("doc_id"))
+        suggestion_stream_url = url_for("suggestion_stream", stream_id=stream_id)
+
+    return render_template(
+        "result.html",
+        site_url=out["input_url"],
+        **_table_view(_job_owner(), result.get("table_columns"), out.get("doc_id")),
+        chart_labels=result["chart_labels"],
+        chart_data=result["chart_data"],
+        competitors=result.get("competitors", []),
+        chatgpt_response=result.get("chatgpt_response", ""),
+        suggestion_stream_url=suggestion_stream_url,
+        history=history,
+        history_cursor=history_cursor,
+    )
+
 @app.route("/register", methods=["GET", "POST"])
 def register():
     if request.method == "POST":
@@ -212,7 +518,7 @@ def register():
 
         # Firebase Admin SDK でトークンを検証し、UID を取得
         try:
-            decoded = firebase_auth.verify_id_token(body["idToken"])
+            decoded = get_auth().verify_id_token(body["idToken"])
         except Exception as e:
             abort(400, f"トークンの検証に失敗しました: {e}")
 
@@ -253,7 +559,7 @@ def login():
         abort(400, "idToken がありません")
 
     try:
-        decoded = firebase_auth.verify_id_token(body["idToken"])
+        decoded = get_auth().verify_id_token(body["idToken"])
     except Exception as e:
         abort(400, f"トークン検証に失敗: {e}")
 
@@ -298,12 +604,7 @@ def result():
 
             # Firestore に永続化
         timestamp = datetime.utcnow()
-        db.collection("improvements").add({
-            "uid": uid,
-            "input_url": input_url,
-            "result": data,
-            "timestamp": timestamp
-         })
+        _save_improvement(uid, input_url, data)
     
         # 新規アイテム用データ
         new_item = {
@@ -331,55 +632,83 @@ def result():
             })
 
         # --- 履歴取得（常に実行） ---
-        docs = (
-            db.collection("improvements")
-            .where("uid", "==", uid)
-            .order_by("timestamp", direction=fa_firestore.Query.DESCENDING)
-            .stream()
-        )
-        for d in docs:
-            rec = d.to_dict()
-            history.append({
-                "id":               d.id,
-                "input_url":        rec.get("input_url"),
-                "timestamp":        rec.get("timestamp").strftime("%Y-%m-%d %H:%M"),
-                "chatgpt_response": rec.get("result", {}).get("chatgpt_response", "")
-            })
+        history, history_cursor = load_history_from_db(uid)
 
         return render_template(
             "result.html",
             site_url=input_url,
-            table_html=data.get("table_html", ""),
+            **_table_view(_job_owner(), data.get("table_columns")),
             chart_labels=data.get("chart_labels", []),
             chart_data=data.get("chart_data", {}),
             competitors=competitors,                        
             chatgpt_response=data.get("chatgpt_response",""),
             history=history,
+            history_cursor=history_cursor,
             new_item=new_item
         )
     else:
         if not session.get("user_authenticated") or not session.get("uid"):
             return redirect(url_for("login"))
         uid = session["uid"]
-        history = load_history_from_db(uid)
+        history, history_cursor = load_history_from_db(uid)
         return render_template(
             "result.html",
             site_url="",
-            table_html="",
+            table_url=None,
             chart_labels=[],
             chart_data={},
             competitors=[],           
             chatgpt_response="",
             history=history,
+            history_cursor=history_cursor,
             new_item=None
         )
 
+@app.route("/improvements/<doc_id>")
+def improvement_detail(doc_id):
+    """保存済みの解析結果を表示する（表の HTML はここで組み立てる）"""
+    uid = session.get("uid")
+    if not session.get("user_authenticated") or not uid:
+        return redirect(url_for("login"))
+    saved = _load_improvement(uid, doc_id)
+    if saved is None:
+        abort(404)
+    result = saved["result"]
+    history, history_cursor = load_history_from_db(uid)
+    return render_template(
+        "result.html",
+        site_url=saved["input_url"],
+        **_table_view(_job_owner(), result.get("table_columns"), doc_id),
+        chart_labels=result.get("chart_labels", []),
+        chart_data=result.get("chart_data", {}),
+        competitors=result.get("competitors", []),
+        chatgpt_response=result.get("chatgpt_response", ""),
+        history=history,
+        history_cursor=history_cursor,
+    )
+
+@app.route("/history")
+def history_page():
+    """履歴の続きを JSON で返す（結果画面の「さらに表示」から呼ばれる）"""
+    uid = session.get("uid")
+    if not session.get("user_authenticated") or not uid:
+        abort(401)
+    items, next_cursor = load_history_from_db(uid, cursor=request.args.get("cursor"))
+    return jsonify({"items": items, "next_cursor": next_cursor})
+
 @app.route("/delete_improvement", methods=["POST"])
 def delete_improvement():
     if not session.get("user_authenticated"):
         return redirect(url_for("login"))
     doc_id = request.form["doc_id"]
-    db.collection("improvements").document(doc_id).delete()
+    if get_improvement_writer().cancel(doc_id, session.get("uid")):
+        return redirect(request.referrer or url_for("result"))   # まだ書いていなかった
+    doc_ref = get_db().collection("improvements").document(doc_id)
+    # 本人のものだけ消す（_load_improvement と同じ確認。本体の大きな result は読まない）
+    snap = doc_ref.get(field_paths=["uid"])
+    if snap.exists and (snap.to_dict() or {}).get("uid") == session.get("uid"):
+        delete_result_blobs(doc_ref)
+        doc_ref.delete()
     return redirect(request.referrer or url_for("result"))
 
 
@@ -391,6 +720,14 @@ def privacy():
 def terms():
     return render_template("terms.html")
 
+# Prometheus 用。値はこのプロセス（gunicorn ワーカー）分だけ。METRICS_TOKEN を設定すると Bearer 認証を要求する
+@app.route("/metrics")
+def metrics():
+    token = os.getenv("METRICS_TOKEN")
+    if token and request.headers.get("Authorization") != f"Bearer {token}":
+        abort(401)
+    return Response(render_prometheus(), mimetype="text/plain; version=0.0.4")
+
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 10000))
     app.run(host="0.0.0.0", port=port, debug=True)
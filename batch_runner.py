@@ -0,0 +1,196 @@
+"""
+複数サイトをまとめて解析する一括実行 CLI（代理店向けの夜間バッチなど）。
+
+    python batch_runner.py sites.csv -o results.jsonl --credentials authorized_user.json \
+        --workers 4 --limit gsc=2 --limit ga=2 --limit serpapi=3 --limit openai=3 --limit sheets=1
+
+入力（CSV または JSONL）の列:
+    url（必須）, sc_property, ga_property, sheet_id, credentials（authorized_user JSON のパス）, key
+
+- サイトごとにプロセスプールで process_seo_improvement を実行する
+- サービス（gsc / ga / serpapi / scrape / openai / sheets）ごとの同時実行数をプロセス間で制限する
+- 結果は 1 件終わるごとに JSONL に追記する。同じ出力で再実行すると成功済みの key は飛ばす（再開）
+- --parquet を付けると最後に JSONL から Parquet を書き出す（pyarrow が必要）
+"""
+import argparse
+import csv
+import json
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import service_slots
+
+
+# ---------------------- 入出力 ----------------------
+
+def read_sites(path: str) -> list[dict]:
+    """CSV / JSONL からサイト一覧を読む。key が無ければ url から作る"""
+    with open(path, encoding="utf-8") as f:
+        if path.endswith((".jsonl", ".ndjson")):
+            rows = [json.loads(line) for line in f if line.strip()]
+        else:
+            rows = list(csv.DictReader(f))
+    sites = []
+    for r in rows:
+        r = {k: (v.strip() if isinstance(v, str) else v) for k, v in r.items() if v not in (None, "")}
+        if not r.get("url"):
+            continue
+        r.setdefault("key", f"{r['url']}|{r.get('sc_property', '')}")
+        sites.append(r)
+    return sites
+
+
+def load_checkpoint(output: str) -> set[str]:
+    """出力済み JSONL から成功済みの key を集める"""
+    done = set()
+    if not os.path.exists(output):
+        return done
+    with open(output, encoding="utf-8") as f:
+        for line in f:
+            try:
+                rec = json.loads(line)
+            except ValueError:
+                continue   # 途中で落ちたときの書きかけ行
+            if rec.get("status") == "ok":
+                done.add(rec.get("key"))
+    return done
+
+
+def write_parquet(jsonl_path: str, parquet_path: str):
+    import pandas as pd
+    records = []
+    with open(jsonl_path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                rec = json.loads(line)
+            except ValueError:
+                continue
+            summary = rec.get("result") or {}
+            records.append({
+                "key": rec.get("key"),
+                "url": rec.get("url"),
+                "status": rec.get("status"),
+                "error": rec.get("error"),
+                "elapsed_sec": rec.get("elapsed_sec"),
+                "finished_at": rec.get("finished_at"),
+                **{k: summary.get(k) for k in ("clicks", "impressions", "ctr", "position", "conversions")},
+                "competitors": json.dumps(summary.get("competitors", []), ensure_ascii=False),
+                "chatgpt_response": summary.get("chatgpt_response", ""),
+            })
+    # 再開で同じ key が複数行になるので最後の結果を残す
+    df = pd.DataFrame(records).drop_duplicates(subset=["key"], keep="last")
+    df.to_parquet(parquet_path, index=False)
+
+
+# ---------------------- ワーカー ----------------------
+
+def _init_worker(slots: dict):
+    service_slots.configure(slots)
+
+
+def _load_credentials(path: str | None):
+    if not path:
+        return None
+    from google.oauth2.credentials import Credentials
+    return Credentials.from_authorized_user_file(path)
+
+
+def _run_site(site: dict, default_credentials: str | None, options: dict) -> dict:
+    """ワーカープロセスで 1 サイトを解析し、JSON で書ける dict を返す"""
+    from main import process_seo_improvement
+
+    started = time.time()
+    rec = {"key": site["key"], "url": site["url"]}
+    try:
+        creds = _load_credentials(site.get("credentials") or default_credentials)
+        result = process_seo_improvement(
+            url=site["url"],
+            creds=creds,
+            sc_property=site.get("sc_property"),
+            ga_property=site.get("ga_property"),
+            sheet_id=site.get("sheet_id"),
+            skip_metrics=creds is None,
+            competitor_keywords=options["competitor_keywords"],
+        )
+        result.pop("chatgpt_prompt", None)
+        rec.update(status="ok", result=result)
+    except Exception as e:
+        rec.update(status="error", error=f"{type(e).__name__}: {e}")
+    rec["elapsed_sec"] = round(time.time() - started, 2)
+    rec["finished_at"] = time.strftime("%Y-%m-%dT%H:%M:%S")
+    return rec
+
+
+# ---------------------- CLI ----------------------
+
+def _parse_limits(values: list[str]) -> dict[str, int]:
+    limits = {}
+    for v in values or []:
+        name, _, n = v.partition("=")
+        if name not in service_slots.SERVICES or not n.isdigit() or int(n) < 1:
+            raise SystemExit(f"--limit は {'/'.join(service_slots.SERVICES)}=N の形式で指定してください: {v}")
+        limits[name] = int(n)
+    return limits
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="複数サイトの SEO 解析を一括実行する")
+    ap.add_argument("sites", help="サイト一覧（.csv または .jsonl）")
+    ap.add_argument("-o", "--output", default="batch_results.jsonl", help="結果の JSONL（追記・再開に使う）")
+    ap.add_argument("--parquet", help="完了後に書き出す Parquet のパス")
+    ap.add_argument("--credentials", help="既定の authorized_user JSON（行ごとの credentials 列が優先）")
+    ap.add_argument("--workers", type=int, default=max(1, (os.cpu_count() or 2) // 2))
+    ap.add_argument("--limit", action="append", metavar="SERVICE=N",
+                    help="サービスごとの同時実行数（例: --limit gsc=2）。複数指定可")
+    ap.add_argument("--competitor-keywords", type=int, default=3)
+    ap.add_argument("--no-resume", action="store_true", help="出力済みの結果を無視して全件やり直す")
+    args = ap.parse_args(argv)
+
+    sites = read_sites(args.sites)
+    done = set() if args.no_resume else load_checkpoint(args.output)
+    todo = [s for s in sites if s["key"] not in done]
+    print(f"🚀 一括実行: {len(sites)} サイト（完了済み {len(sites) - len(todo)} 件をスキップ）")
+
+    limits = _parse_limits(args.limit)
+    options = {"competitor_keywords": args.competitor_keywords}
+
+    ok = failed = 0
+    with multiprocessing.Manager() as manager:
+        # プロセス間で共有するセマフォ（Manager のプロキシは子プロセスへ渡せる）
+        slots = {name: manager.BoundedSemaphore(n) for name, n in limits.items()}
+        with ProcessPoolExecutor(max_workers=args.workers, initializer=_init_worker, initargs=(slots,)) as pool, \
+                open(args.output, "a", encoding="utf-8") as out:
+            futures = {pool.submit(_run_site, s, args.credentials, options): s for s in todo}
+            for f in as_completed(futures):
+                site = futures[f]
+                try:
+                    rec = f.result()
+                except Exception as e:   # ワーカーごと落ちた場合など
+                    rec = {"key": site["key"], "url": site["url"], "status": "error",
+                           "error": f"{type(e).__name__}: {e}"}
+                out.write(json.dumps(rec, ensure_ascii=False, default=str) + "\n")
+                out.flush()
+                if rec["status"] == "ok":
+                    ok += 1
+                else:
+                    failed += 1
+                    print(f"⚠️ 失敗: {site['url']} -> {rec.get('error')}")
+                print(f"  [{ok + failed}/{len(todo)}] {site['url']} ({rec['status']})")
+
+    print(f"✅ 完了: 成功 {ok} 件 / 失敗 {failed} 件 → {args.output}")
+
+    if args.parquet:
+        try:
+            write_parquet(args.output, args.parquet)
+            print(f"✅ Parquet 書き出し: {args.parquet}")
+        except ImportError as e:
+            print("⚠️ Parquet の書き出しには pyarrow が必要です:", e)
+
+    return 0 if failed == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,97 @@
+"""
+GSC レスポンス解析のマイクロベンチマーク。
+
+旧実装（行ごとに normalize_url を呼んで Python のリストを組み立てる）と
+gsc_utils._rows_to_frame（列ごとに配列化＋異なる URL だけ正規化）を比べる。
+
+    python benchmarks/bench_gsc_parse.py [--rows 25000 100000] [--pages 300] [--repeat 5]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pandas as pd  # noqa: E402
+
+import gsc_utils  # noqa: E402
+from gsc_utils import normalize_url  # noqa: E402
+
+
+def legacy_rows_to_frame(rows) -> pd.DataFrame:
+    """変更前の fetch_gsc_data のループ（比較用にそのまま残したもの）"""
+    data = []
+    for r in rows:
+        keys = r.get('keys', [])
+        page = keys[0] if len(keys) > 0 else ''
+        query = keys[1] if len(keys) > 1 else ''
+        clicks = r.get('clicks', 0) or 0
+        imps   = r.get('impressions', 0) or 0
+        ctr    = r.get('ctr', 0.0) or 0.0
+        pos    = r.get('position', 0.0) or 0.0
+        data.append([
+            query,
+            normalize_url(page) if page else '',
+            clicks,
+            imps,
+            round(ctr * 100, 2),
+            round(pos, 2),
+        ])
+    return pd.DataFrame(
+        data,
+        columns=['検索キーワード', 'URL', 'クリック数', '表示回数', 'CTR（%）', '平均順位']
+    )
+
+
+def make_rows(n: int, pages: int, seed: int = 0) -> list[dict]:
+    """Search Analytics API の rows を模したデータ（少数のページが何度も出る）"""
+    rnd = random.Random(seed)
+    urls = [f"https://www.example.com/blog/post-{i}" for i in range(pages)]
+    rows = []
+    for i in range(n):
+        imps = rnd.randint(1, 5000)
+        clicks = rnd.randint(0, imps // 10)
+        rows.append({
+            'keys': [rnd.choice(urls), f"キーワード {i}"],
+            'clicks': clicks,
+            'impressions': imps,
+            'ctr': clicks / imps,
+            'position': rnd.uniform(1, 80),
+        })
+    return rows
+
+
+def best_of(fn, rows, repeat: int) -> float:
+    times = []
+    for _ in range(repeat):
+        gsc_utils._normalize_url_cached.cache_clear()   # 毎回コールドな状態で比べる
+        t0 = time.perf_counter()
+        fn(rows)
+        times.append(time.perf_counter() - t0)
+    return min(times)
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    ap.add_argument("--rows", type=int, nargs="+", default=[25000, 100000])
+    ap.add_argument("--pages", type=int, default=300, help="異なるページ URL の数")
+    ap.add_argument("--repeat", type=int, default=5)
+    args = ap.parse_args()
+
+    print(f"{'rows':>8} {'legacy(ms)':>11} {'columnar(ms)':>13} {'speedup':>8}")
+    for n in args.rows:
+        rows = make_rows(n, args.pages)
+        # np.round と組み込み round は .xx5 の丸めだけ 0.01 ずれることがある
+        pd.testing.assert_frame_equal(
+            legacy_rows_to_frame(rows), gsc_utils._rows_to_frame(rows),
+            check_dtype=False, check_exact=False, atol=0.011,
+        )
+        legacy = best_of(legacy_rows_to_frame, rows, args.repeat)
+        columnar = best_of(gsc_utils._rows_to_frame, rows, args.repeat)
+        print(f"{n:>8} {legacy * 1000:>11.1f} {columnar * 1000:>13.1f} {legacy / columnar:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
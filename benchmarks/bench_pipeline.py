@@ -0,0 +1,499 @@
+"""
+process_seo_improvement のエンドツーエンド・ベンチマーク（外部サービスはすべてローカルの代役）。
+
+GSC / GA4 / SerpAPI / OpenAI / Sheets はプロセス内のフェイククライアントに差し替え、
+競合ページ（とその他の Web ページ）はローカルの HTTP サーバーから返す。
+遅延・エラー率・GSC の行数を変えながら、ステージごとの所要時間（metrics の span）と
+全体の所要時間、ピークメモリ（tracemalloc）を表示する。ネットワークも API キーも要らない。
+
+    python benchmarks/bench_pipeline.py [--rows 100 10000 100000] [--repeat 3] [--warmup 1]
+        [--latency gsc=0.3 --latency openai=2.0 ...] [--error-rate serpapi=0.1 ...]
+        [--cache cold|warm] [--snapshot] [--competitor-keywords 3] [--json out.json]
+
+- 遅延は 1 回の呼び出しごとの秒数（GSC はページごと、ページは 1 リクエストごと）
+- --cache cold（既定）は毎回キャッシュ（SQLite / LRU / スナップショット）を空にして測る
+- ステージ時間の serpapi はキーワードごとの並列呼び出しの合計（壁時計ではない）
+- ピークメモリは計測用に 1 回だけ tracemalloc を有効にして別に実行する（遅延計測には含めない）
+- Sheets の代役は書き込んだ値を覚えているので、2 回目以降は差分書き込み（SHEETS_DIFF）の経路になる
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import re
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+_TMP = tempfile.mkdtemp(prefix="mrseo-bench-")
+# 本番のキャッシュやスナップショットを汚さないよう、import 前に保存先を一時ディレクトリへ向ける
+os.environ["MRSEO_CACHE_DB"] = os.path.join(_TMP, "cache.sqlite3")
+os.environ["GSC_SNAPSHOT_DB"] = os.path.join(_TMP, "gsc.sqlite3")
+os.environ.setdefault("SERPAPI_KEY", "bench")
+os.environ.setdefault("OPENAI_API_KEY", "bench")
+os.environ.setdefault("METRICS_LOG", "0")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httplib2  # noqa: E402
+from google.api_core.exceptions import ServiceUnavailable  # noqa: E402
+from googleapiclient.errors import HttpError  # noqa: E402
+
+import cache_utils  # noqa: E402
+import chatgpt_utils  # noqa: E402
+import ga_utils  # noqa: E402
+import gsc_snapshot  # noqa: E402
+import gsc_utils  # noqa: E402
+import main  # noqa: E402
+import metrics  # noqa: E402
+import page_cache  # noqa: E402
+import serp_api_utils  # noqa: E402
+import sheet_utils  # noqa: E402
+
+SERVICES = ("gsc", "ga", "serpapi", "openai", "sheets", "page")
+DEFAULT_LATENCY = {"gsc": 0.3, "ga": 0.2, "serpapi": 0.8, "openai": 2.0, "sheets": 0.3, "page": 0.15}
+STAGES = ("gsc", "ga", "serpapi", "scrape", "prompt", "openai", "sheets", "analysis")
+
+
+class Faults:
+    """サービスごとの遅延とエラー率"""
+
+    def __init__(self, latency: dict, error_rate: dict, seed: int):
+        self.latency = latency
+        self.error_rate = error_rate
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def hit(self, service: str) -> bool:
+        """遅延を入れ、エラーにすべきなら True"""
+        delay = self.latency.get(service, 0.0)
+        if delay > 0:
+            time.sleep(delay)
+        with self._lock:
+            return self._rng.random() < self.error_rate.get(service, 0.0)
+
+
+# ---------------------- 競合ページ（ローカル HTTP） ----------------------
+
+def _page_html(path: str, size_kb: int) -> bytes:
+    slug = path.strip("/").replace("/", "-") or "top"
+    filler = "<p>" + ("サンプル本文 " * 40) + "</p>\n"
+    body = filler * max(1, size_kb * 1024 // len(filler.encode("utf-8")))
+    return (
+        "<!doctype html><html><head><meta charset='utf-8'>"
+        f"<title>競合ページ {slug}</title>"
+        f"<meta name='description' content='{slug} の説明文です。'>"
+        f"<meta property='og:description' content='{slug} の OG 説明文'>"
+        f"</head><body><h1>{slug}</h1>{body}</body></html>"
+    ).encode("utf-8")
+
+
+def start_page_servers(n: int, faults: Faults, size_kb: int) -> list[int]:
+    """
+    同じ内容を返すサーバーを n 個立てる（fetch_meta_infos はホスト＝netloc ごとに同時数を絞るので、
+    ポートを分けて「別サイト」に見せる）。返値はポート番号のリスト。
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if faults.hit("page"):
+                self.send_error(503)
+                return
+            body = _page_html(self.path, size_kb)
+            etag = '"%08x"' % zlib.crc32(body)
+            if self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.send_header("ETag", etag)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    ports = []
+    for _ in range(max(1, n)):
+        server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        ports.append(server.server_address[1])
+    return ports
+
+
+# ---------------------- GSC ----------------------
+
+class FakeSearchConsole:
+    """searchanalytics().query(siteUrl=, body=).execute() だけを持つ代役"""
+
+    def __init__(self, rows: int, site: str, faults: Faults):
+        self.n_rows = rows
+        self.site = site.rstrip("/")
+        self.faults = faults
+        self.n_pages = max(1, min(rows, max(20, rows // 50)))
+        self._responses = {}   # 同じ期間の行は 1 回だけ作る（代役自身のコストを計測に混ぜない）
+        self._lock = threading.Lock()
+
+    def searchanalytics(self):
+        return self
+
+    def query(self, *, siteUrl, body):
+        return SimpleNamespace(execute=lambda http=None: self._execute(body))
+
+    def _rows_for(self, body) -> list[dict]:
+        key = (body["startDate"], body["endDate"], tuple(body["dimensions"]))
+        with self._lock:
+            rows = self._responses.get(key)
+        if rows is not None:
+            return rows
+        days = (gsc_utils._to_date(body["endDate"]) - gsc_utils._to_date(body["startDate"])).days + 1
+        scale = days / 28
+        daily = body["dimensions"][0] == "date"
+        rows = []
+        for i in range(self.n_rows):
+            page = f"{self.site}/p/{i % self.n_pages}"
+            query = f"キーワード {i // self.n_pages}"
+            imps = max(1, int((1000 * 50 / (i + 50)) * scale))
+            clicks = imps * (5 + i % 11) // 100
+            keys = [body["startDate"], page, query] if daily else [page, query]
+            rows.append({
+                "keys": keys,
+                "clicks": clicks,
+                "impressions": imps,
+                "ctr": clicks / imps,
+                "position": 1 + (i % 400) / 10,
+            })
+        with self._lock:
+            self._responses[key] = rows
+        return rows
+
+    def _execute(self, body):
+        if self.faults.hit("gsc"):
+            raise HttpError(httplib2.Response({"status": 503}), b"fake backend error")
+        rows = self._rows_for(body)
+        start = body.get("startRow", 0)
+        return {"rows": rows[start:start + body.get("rowLimit", 1000)]}
+
+
+# ---------------------- GA4 ----------------------
+
+def _ga_response(paths: list[str], offset: int, limit: int):
+    page = paths[offset:offset + limit]
+    return SimpleNamespace(
+        rows=[
+            SimpleNamespace(
+                dimension_values=[SimpleNamespace(value=p)],
+                metric_values=[SimpleNamespace(value=str(zlib.crc32(p.encode()) % 7))],
+            )
+            for p in page
+        ],
+        row_count=len(paths),
+    )
+
+
+class FakeGaClient:
+    """run_report / batch_run_reports の代役。/p/{i} のうち 3 件に 1 件にコンバージョンがある"""
+
+    def __init__(self, n_pages: int, faults: Faults):
+        self.paths = [f"/p/{i}" for i in range(n_pages) if i % 3 == 0]
+        self.faults = faults
+
+    def _report(self, req):
+        if req.dimension_filter.filter.in_list_filter.values:
+            wanted = set(req.dimension_filter.filter.in_list_filter.values)
+            paths = [p for p in self.paths if p in wanted]
+        else:
+            paths = self.paths
+        return _ga_response(paths, req.offset, req.limit or 10000)
+
+    def run_report(self, req):
+        if self.faults.hit("ga"):
+            raise ServiceUnavailable("fake backend error")
+        return self._report(req)
+
+    def batch_run_reports(self, req):
+        if self.faults.hit("ga"):
+            raise ServiceUnavailable("fake backend error")
+        return SimpleNamespace(reports=[self._report(r) for r in req.requests])
+
+
+# ---------------------- SerpAPI ----------------------
+
+def make_fake_google_search(ports: list[int], faults: Faults):
+    class FakeGoogleSearch:
+        def __init__(self, params):
+            self.params = params
+
+        def get_dict(self):
+            if faults.hit("serpapi"):
+                return {"error": "fake backend error"}
+            q = self.params["q"]
+            bucket = zlib.crc32(q.encode("utf-8")) % 40
+            return {"organic_results": [
+                {
+                    # キーワード間で一部の URL が重なるようにする（_dedupe_competitors の経路を通す）
+                    "link": f"http://127.0.0.1:{ports[j % len(ports)]}/c/{(bucket + j) % 60}",
+                    "title": f"{q} の競合 {j}",
+                }
+                for j in range(10)
+            ]}
+    return FakeGoogleSearch
+
+
+# ---------------------- OpenAI ----------------------
+
+class FakeOpenAI:
+    def __init__(self, faults: Faults):
+        self.faults = faults
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+
+    def _create(self, *, model, messages, max_tokens, temperature, stream=False):
+        if self.faults.hit("openai"):
+            raise RuntimeError("fake backend error")
+        text = "改善案:\n" + "\n".join(f"{i}. タイトルと説明文を見直す" for i in range(1, 11))
+        if stream:
+            return iter([SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=text))])])
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=text))])
+
+
+# ---------------------- Sheets ----------------------
+
+_A1 = re.compile(r"^'(?P<title>(?:[^']|'')*)'!A(?P<first>\d+):[A-Z]+(?P<last>\d+)$")
+
+
+def _cell_value(cell: dict):
+    v = cell.get("userEnteredValue", {})
+    return next(iter(v.values()), "")
+
+
+class FakeSheetsHttp:
+    """export_sheet_tabs が使う http_client の 4 メソッドだけを持つ代役（値はメモリに持つ）"""
+
+    def __init__(self, faults: Faults):
+        self.faults = faults
+        self.sheets = {}   # title -> {"props": {...}, "values": [[...]]}
+        self._lock = threading.Lock()
+
+    def _call(self):
+        if self.faults.hit("sheets"):
+            raise RuntimeError("fake backend error")
+
+    def fetch_sheet_metadata(self, spreadsheet_id, params=None):
+        self._call()
+        with self._lock:
+            return {"sheets": [{"properties": dict(s["props"])} for s in self.sheets.values()]}
+
+    def values_batch_get(self, spreadsheet_id, ranges, params=None):
+        self._call()
+        with self._lock:
+            out = []
+            for r in ranges:
+                title = _A1.match(r).group("title").replace("''", "'")
+                out.append({"range": r, "values": [list(row) for row in self.sheets[title]["values"]]})
+            return {"valueRanges": out}
+
+    def values_batch_update(self, spreadsheet_id, body):
+        self._call()
+        with self._lock:
+            for d in body["data"]:
+                m = _A1.match(d["range"])
+                values = self.sheets[m.group("title").replace("''", "'")]["values"]
+                first = int(m.group("first")) - 1
+                for i, row in enumerate(d["values"]):
+                    while len(values) <= first + i:
+                        values.append([])
+                    values[first + i] = list(row)
+
+    def batch_update(self, spreadsheet_id, body):
+        self._call()
+        with self._lock:
+            by_id = {s["props"]["sheetId"]: s for s in self.sheets.values()}
+            for req in body["requests"]:
+                if "addSheet" in req:
+                    props = req["addSheet"]["properties"]
+                    self.sheets[props["title"]] = by_id[props["sheetId"]] = {"props": dict(props), "values": []}
+                elif "updateSheetProperties" in req:
+                    props = req["updateSheetProperties"]["properties"]
+                    by_id[props["sheetId"]]["props"]["gridProperties"] = dict(props["gridProperties"])
+                elif "updateCells" in req:
+                    uc = req["updateCells"]
+                    if "rows" in uc:
+                        sheet = by_id[uc["start"]["sheetId"]]
+                        sheet["values"] = [[_cell_value(c) for c in r["values"]] for r in uc["rows"]]
+                    else:
+                        by_id[uc["range"]["sheetId"]]["values"] = []
+
+
+# ---------------------- 実行 ----------------------
+
+def install_fakes(*, rows: int, faults: Faults, ports: list[int]):
+    site = f"http://127.0.0.1:{ports[0]}"
+    gsc = FakeSearchConsole(rows, site, faults)
+    ga = FakeGaClient(gsc.n_pages, faults)
+    openai_client = FakeOpenAI(faults)
+    sheets = SimpleNamespace(http_client=FakeSheetsHttp(faults))
+
+    gsc_utils.get_search_console_service = lambda creds: gsc
+    gsc_utils.list_sc_sites = lambda creds: [site + "/"]   # スナップショットを返す前のアクセス権確認
+    ga_utils.get_ga_data_client = lambda creds: ga
+    serp_api_utils.GoogleSearch = make_fake_google_search(ports, faults)
+    chatgpt_utils.get_openai_client = lambda: openai_client
+    sheet_utils.get_gspread_client = lambda creds: sheets
+    return site
+
+
+def reset_caches(run_id: str):
+    """キャッシュを空にする（cold 計測用）。SQLite は新しいファイルに切り替える"""
+    cache_utils._shared_store = cache_utils.SqliteStore(os.path.join(_TMP, f"cache-{run_id}.sqlite3"))
+    gsc_snapshot._store = gsc_snapshot.GscSnapshotStore(os.path.join(_TMP, f"gsc-{run_id}.sqlite3"))
+    page_cache._memory.clear()
+    serp_api_utils._serp_memory.clear()
+    chatgpt_utils._llm_memory.clear()
+
+
+def run_once(site: str, args, run_id: str, *, trace_memory: bool = False) -> dict:
+    if args.cache == "cold":
+        reset_caches(run_id)
+    metrics.reset()
+    out = io.StringIO()
+    if trace_memory:
+        tracemalloc.start()
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(sys.stdout if args.verbose else out):
+        result = main.process_seo_improvement(
+            url=site + "/",
+            creds=SimpleNamespace(token="bench"),
+            sc_property=site + "/",
+            ga_property="properties/1",
+            sheet_id="bench-sheet",
+            competitor_keywords=args.competitor_keywords,
+        )
+    total = time.perf_counter() - started
+    peak = None
+    if trace_memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return {
+        "total": total,
+        "peak_bytes": peak,
+        "spans": metrics.snapshot(),
+        "table_rows": len((result.get("table_columns") or {}).get("URL", [])),
+        "competitors": len(result.get("competitors", [])),
+        "suggestion": bool(result.get("chatgpt_response")),
+    }
+
+
+def _pct(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+def bench_size(rows: int, args, faults: Faults, ports: list[int]) -> dict:
+    site = install_fakes(rows=rows, faults=faults, ports=ports)
+    for i in range(args.warmup):
+        run_once(site, args, f"{rows}-warmup{i}")
+    runs = [run_once(site, args, f"{rows}-{i}") for i in range(args.repeat)]
+    mem = run_once(site, args, f"{rows}-mem", trace_memory=True)
+
+    stages = {}
+    for name in sorted({s for r in runs for s in r["spans"]}):
+        counts = [r["spans"].get(name, {}).get("count", 0) for r in runs]
+        sums = [r["spans"].get(name, {}).get("sum", 0.0) for r in runs]
+        errors = [r["spans"].get(name, {}).get("errors", 0) for r in runs]
+        stages[name] = {
+            "calls_per_run": statistics.mean(counts),
+            "mean_ms": statistics.mean(sums) * 1000,
+            "errors": sum(errors),
+        }
+    totals = [r["total"] for r in runs]
+    return {
+        "rows": rows,
+        "total_ms": {
+            "mean": statistics.mean(totals) * 1000,
+            "p50": _pct(totals, 0.5) * 1000,
+            "p95": _pct(totals, 0.95) * 1000,
+        },
+        "peak_mib": mem["peak_bytes"] / (1024 * 1024),
+        "table_rows": runs[-1]["table_rows"],
+        "competitors": runs[-1]["competitors"],
+        "suggestion": runs[-1]["suggestion"],
+        "stages": stages,
+    }
+
+
+def print_report(rep: dict):
+    t = rep["total_ms"]
+    print(f"\n=== GSC {rep['rows']:,} 行 → 表 {rep['table_rows']:,} 行 / 競合 {rep['competitors']} 件"
+          f" / 提案 {'あり' if rep['suggestion'] else 'なし'} ===")
+    print(f"  total   mean {t['mean']:9.1f} ms   p50 {t['p50']:9.1f} ms   p95 {t['p95']:9.1f} ms"
+          f"   peak {rep['peak_mib']:7.1f} MiB")
+    print(f"  {'span':<20}{'calls/run':>10}{'mean ms':>12}{'errors':>8}")
+    ordered = [s for s in STAGES if s in rep["stages"]] + sorted(s for s in rep["stages"] if s not in STAGES)
+    for name in ordered:
+        s = rep["stages"][name]
+        print(f"  {name:<20}{s['calls_per_run']:>10.1f}{s['mean_ms']:>12.1f}{s['errors']:>8}")
+
+
+def _parse_service_values(values: list[str], option: str) -> dict[str, float]:
+    out = {}
+    for v in values or []:
+        name, _, x = v.partition("=")
+        try:
+            out[name] = float(x)
+        except ValueError:
+            name = None
+        if name not in SERVICES:
+            raise SystemExit(f"{option} は {'/'.join(SERVICES)}=数値 の形式で指定してください: {v}")
+    return out
+
+
+def main_cli(argv=None):
+    ap = argparse.ArgumentParser(description="解析パイプライン全体のベンチマーク（ローカルの代役サービス）")
+    ap.add_argument("--rows", type=int, nargs="+", default=[100, 10000, 100000], help="GSC の行数")
+    ap.add_argument("--repeat", type=int, default=3)
+    ap.add_argument("--warmup", type=int, default=1)
+    ap.add_argument("--latency", action="append", metavar="SERVICE=SEC",
+                    help=f"呼び出しごとの遅延（既定 {DEFAULT_LATENCY}）。複数指定可")
+    ap.add_argument("--error-rate", action="append", metavar="SERVICE=P", help="エラーにする割合（0〜1）")
+    ap.add_argument("--cache", choices=("cold", "warm"), default="cold")
+    ap.add_argument("--snapshot", action="store_true", help="GSC 日別スナップショット経由で取得する")
+    ap.add_argument("--competitor-keywords", type=int, default=3)
+    ap.add_argument("--page-hosts", type=int, default=5, help="競合ページを返すローカルサーバーの数")
+    ap.add_argument("--page-kb", type=int, default=60, help="競合ページの HTML サイズ（KB）")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--json", help="結果を JSON で保存するパス")
+    ap.add_argument("-v", "--verbose", action="store_true", help="パイプラインのログを表示する")
+    args = ap.parse_args(argv)
+
+    latency = dict(DEFAULT_LATENCY, **_parse_service_values(args.latency, "--latency"))
+    faults = Faults(latency, _parse_service_values(args.error_rate, "--error-rate"), args.seed)
+    main.GSC_SNAPSHOT_ENABLED = args.snapshot
+    ports = start_page_servers(args.page_hosts, faults, args.page_kb)
+
+    print(f"latency={latency} error_rate={faults.error_rate} cache={args.cache} snapshot={args.snapshot}")
+    reports = []
+    for rows in args.rows:
+        rep = bench_size(rows, args, faults, ports)
+        print_report(rep)
+        reports.append(rep)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"latency": latency, "error_rate": faults.error_rate, "cache": args.cache,
+                       "snapshot": args.snapshot, "results": reports}, f, ensure_ascii=False, indent=2)
+        print(f"\n✅ {args.json} に保存しました")
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,142 @@
+"""
+起動（import）時間の予算チェック。
+
+各モジュールを新しいプロセスで `python -X importtime` 付きで import し、
+モジュールごとの累積 import 時間と、app の import で時間を使っている上位のパッケージを表示する。
+さらに app を import して /privacy・/terms・/login を表示した時点で、重い依存
+（pandas・Google API クライアント・OpenAI・Firestore など）が読み込まれていないことを確認する。
+
+    python benchmarks/import_budget.py [--budget-ms 400] [--top 15] [--repeat 3]
+
+予算超過、または静的ページで重い依存が読み込まれていたら終了コード 1。
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# プロジェクトのモジュール（個別に import 時間を測る）
+PROJECT_MODULES = [
+    "app", "oauth", "firebase_app", "jobs", "cache_utils", "metrics", "rate_limit", "result_store",
+    "improvement_writer",
+    "main", "gsc_utils", "gsc_snapshot", "ga_utils", "serp_api_utils", "page_cache",
+    "chatgpt_utils", "sheet_utils", "client_cache",
+]
+
+# 静的ページの表示までに読み込まれてはいけないモジュール
+HEAVY_MODULES = [
+    "pandas", "numpy", "googleapiclient", "google.analytics", "openai", "bs4", "gspread",
+    "serpapi", "google.cloud.firestore", "firebase_admin", "google_auth_oauthlib", "grpc", "main",
+]
+
+_STATIC_CHECK = """
+import json, sys
+import app
+client = app.app.test_client()
+status = {p: client.get(p).status_code for p in ("/privacy", "/terms", "/login")}
+print(json.dumps({"status": status, "loaded": [m for m in %r if m in sys.modules]}))
+""" % (HEAVY_MODULES,)
+
+
+def _env():
+    env = dict(os.environ)
+    env["PYTHONPATH"] = ROOT + os.pathsep + env.get("PYTHONPATH", "")
+    return env
+
+
+def import_profile(module: str) -> list[tuple[str, int, int, int]]:
+    """-X importtime の出力 → [(モジュール名, 深さ, self us, cumulative us)]"""
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=ROOT, env=_env(), capture_output=True, text=True,
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(f"import {module} に失敗しました:\n{proc.stderr[-2000:]}")
+    rows = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, cum_us, name = line.split(":", 1)[1].split("|", 2)
+        name = name.rstrip()[1:]   # 区切りの空白の後ろは深さ × 2 の空白
+        depth = (len(name) - len(name.lstrip(" "))) // 2
+        rows.append((name.strip(), depth, int(self_us), int(cum_us)))
+    return rows
+
+
+def cumulative_ms(module: str, repeat: int) -> float:
+    """モジュール自身の累積 import 時間（ms、repeat 回の中央値）"""
+    values = []
+    for _ in range(repeat):
+        rows = import_profile(module)
+        own = [cum for name, depth, _, cum in rows if name == module and depth == 0]
+        values.append((own[-1] if own else 0) / 1000)
+    return statistics.median(values)
+
+
+def top_level_costs(module: str, top: int) -> list[tuple[str, float]]:
+    """module の import 中に読み込まれた直下のパッケージを累積時間の大きい順に"""
+    rows = import_profile(module)
+    # -X importtime は子を先に出し、インデントで深さを表す。module の行から遡って直下（深さ 1）を集める
+    end = max(i for i, (name, depth, _, _) in enumerate(rows) if name == module and depth == 0)
+    direct = []
+    for name, depth, _, cum in reversed(rows[:end]):
+        if depth == 0:
+            break   # ここから前はインタプリタ起動時などの別の import
+        if depth == 1:
+            direct.append((name, cum / 1000))
+    return sorted(direct, key=lambda x: -x[1])[:top]
+
+
+def static_pages_check() -> dict:
+    proc = subprocess.run([sys.executable, "-c", _STATIC_CHECK], cwd=ROOT, env=_env(),
+                          capture_output=True, text=True)
+    if proc.returncode != 0:
+        raise RuntimeError(f"静的ページの確認に失敗しました:\n{proc.stderr[-2000:]}")
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="import 時間の予算チェック")
+    ap.add_argument("--budget-ms", type=float, default=400.0, help="app の import 時間の上限（ms）")
+    ap.add_argument("--top", type=int, default=15, help="app の import で重い直下パッケージを何件表示するか")
+    ap.add_argument("--repeat", type=int, default=3, help="各モジュールの計測回数（中央値を使う）")
+    args = ap.parse_args(argv)
+
+    print(f"{'module':<18}{'import ms':>12}")
+    costs = {}
+    for m in PROJECT_MODULES:
+        try:
+            costs[m] = cumulative_ms(m, args.repeat)
+            print(f"{m:<18}{costs[m]:>12.1f}")
+        except RuntimeError as e:
+            print(f"{m:<18}{'error':>12}  {str(e).splitlines()[-1]}")
+
+    print(f"\napp の import で時間を使っている直下のモジュール（上位 {args.top}）")
+    for name, ms in top_level_costs("app", args.top):
+        print(f"  {name:<40}{ms:>10.1f} ms")
+
+    ok = True
+    app_ms = costs.get("app")
+    if app_ms is None or app_ms > args.budget_ms:
+        print(f"\n❌ app の import 時間 {app_ms} ms が予算 {args.budget_ms:.0f} ms を超えています")
+        ok = False
+    else:
+        print(f"\n✅ app の import 時間 {app_ms:.1f} ms（予算 {args.budget_ms:.0f} ms）")
+
+    check = static_pages_check()
+    print("静的ページ:", ", ".join(f"{p} {s}" for p, s in check["status"].items()))
+    if check["loaded"]:
+        print("❌ 静的ページの表示までに重い依存が読み込まれています:", ", ".join(check["loaded"]))
+        ok = False
+    else:
+        print("✅ 静的ページの表示で重い依存は読み込まれていません")
+
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
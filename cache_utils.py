@@ -0,0 +1,198 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+# プロセス内で共有する小さなキャッシュ部品（gunicorn のスレッド間で共有される前提）
+
+_MISSING = object()
+
+
+class LRUCache:
+    """
+    スレッドセーフな LRU キャッシュ（任意で TTL 付き）。
+    - maxsize: 保持する最大件数。超えたら最も古く使われたものから捨てる
+    - ttl:     秒。None なら期限なし。set(..., ttl=) で個別に上書きできる
+    """
+
+    def __init__(self, maxsize: int = 128, ttl: float | None = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()   # key -> (expires_at | None, value)
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key, _MISSING)
+            if item is _MISSING:
+                return default
+            expires_at, value = item
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl: float | None = None):
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.monotonic() + ttl if ttl is not None else None
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._data.pop(key, _MISSING)
+        return default if item is _MISSING else item[1]
+
+    def discard_if(self, predicate):
+        """predicate(key) が真のものをまとめて捨てる"""
+        with self._lock:
+            for key in [k for k in self._data if predicate(k)]:
+                del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def values(self) -> list:
+        """保持している値の一覧（期限切れの判定はしない。監視用）"""
+        with self._lock:
+            return [value for _, value in self._data.values()]
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+
+# --- 永続化された 2 段目のキャッシュ（ローカル SQLite） ------------------------
+# gunicorn の複数ワーカー（別プロセス）間でも共有できるよう、ファイルに保存する。
+
+def default_cache_path() -> str:
+    """Cloud Run でも書き込める /tmp を既定にする（MRSEO_CACHE_DB で上書き可）"""
+    return os.getenv("MRSEO_CACHE_DB", "/tmp/mrseo_cache.sqlite3")
+
+
+class SqliteStore:
+    """
+    namespace + key → JSON 値 を保存する小さな KV ストア（期限付き）。
+    接続はスレッドごとに張り、WAL モードで複数プロセスから同時に読み書きできるようにする。
+    """
+
+    def __init__(self, path: str | None = None):
+        self.path = path or default_cache_path()
+        self._local = threading.local()
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS kv ("
+                " namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL,"
+                " expires_at REAL, PRIMARY KEY (namespace, key))"
+            )
+            self._local.conn = conn
+        return conn
+
+    def get(self, namespace: str, key: str, default=None):
+        try:
+            row = self._conn().execute(
+                "SELECT value, expires_at FROM kv WHERE namespace = ? AND key = ?",
+                (namespace, key),
+            ).fetchone()
+        except sqlite3.Error as e:
+            print("⚠️ キャッシュ読み込みエラー:", e)
+            return default
+        if row is None:
+            return default
+        value, expires_at = row
+        if expires_at is not None and expires_at <= time.time():
+            self.delete(namespace, key)
+            return default
+        return json.loads(value)
+
+    def set(self, namespace: str, key: str, value, ttl: float | None = None):
+        expires_at = time.time() + ttl if ttl is not None else None
+        try:
+            self._conn().execute(
+                "INSERT OR REPLACE INTO kv (namespace, key, value, expires_at) VALUES (?, ?, ?, ?)",
+                (namespace, key, json.dumps(value, ensure_ascii=False), expires_at),
+            )
+        except sqlite3.Error as e:
+            print("⚠️ キャッシュ書き込みエラー:", e)
+
+    def delete(self, namespace: str, key: str):
+        try:
+            self._conn().execute("DELETE FROM kv WHERE namespace = ? AND key = ?", (namespace, key))
+        except sqlite3.Error as e:
+            print("⚠️ キャッシュ削除エラー:", e)
+
+
+_shared_store = None
+_shared_store_lock = threading.Lock()
+
+
+def get_shared_store() -> SqliteStore:
+    """プロセス内で 1 つの SqliteStore を返す"""
+    global _shared_store
+    if _shared_store is None:
+        with _shared_store_lock:
+            if _shared_store is None:
+                _shared_store = SqliteStore()
+    return _shared_store
+
+
+# --- 同時ミスの合流（single-flight） ---------------------------------------------
+
+class _Call:
+    __slots__ = ("event", "result", "error")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    同じキーの処理が実行中なら、後から来たスレッドは新たに実行せずその結果を待つ。
+    先頭（leader）が例外を出した場合は、待っていたスレッドにも同じ例外を投げる。
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn, *args, **kwargs):
+        return self.run(key, fn, *args, **kwargs)[0]
+
+    def run(self, key, fn, *args, **kwargs):
+        """do と同じだが (結果, 他のスレッドの実行結果を受け取ったか) を返す"""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = fn(*args, **kwargs)
+            return call.result, False
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.event.set()
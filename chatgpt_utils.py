@@ -1,8 +1,15 @@
+import hashlib
+import json
 import os
+import re
+import unicodedata
 from openai import OpenAI
 import pandas as pd
-import requests
-from bs4 import BeautifulSoup
+
+from cache_utils import LRUCache, SingleFlight, get_shared_store
+from metrics import cache_event, span
+from page_cache import fetch_page_meta
+from rate_limit import call as rate_limited
 
 # --- OpenAIクライアントを遅延初期化（起動時クラッシュ防止） ---
 _client = None
@@ -13,34 +20,26 @@ def get_openai_client() -> OpenAI:
         if not api_key:
             # 起動エラーは避け、呼び出し時に明示エラー
             raise RuntimeError("OPENAI_API_KEY が未設定です（Cloud Run の環境変数に設定してください）")
-        _client = OpenAI(api_key=api_key)
+        # 再試行は rate_limit.call に任せる（SDK 側でも再試行すると回数と待ち時間が掛け算になる）
+        _client = OpenAI(api_key=api_key, max_retries=0)
         # もしくは _client = OpenAI() でもOK（環境変数を自動検出）
     return _client
 
 def fetch_service_description(url: str) -> str:
     """ターゲット URL からサイトの自己紹介文（meta description, og:description, h1＋p）を取得する"""
     try:
-        headers = {"User-Agent": "Mozilla/5.0"}
-        res = requests.get(url, timeout=5, headers=headers)
-        res.raise_for_status()
-        soup = BeautifulSoup(res.text, "html.parser")
+        meta = fetch_page_meta(url)   # キャッシュ優先（期限切れなら条件付き GET）
 
         # 1) meta description
-        desc = soup.find("meta", {"name":"description"})
-        if desc and desc.get("content"):
-            return desc["content"].strip()
+        if meta["description"]:
+            return meta["description"]
 
         # 2) og:description
-        desc = soup.find("meta", {"property":"og:description"})
-        if desc and desc.get("content"):
-            return desc["content"].strip()
+        if meta["og_description"]:
+            return meta["og_description"]
 
         # 3) h1 + 最初の段落
-        h1 = soup.find("h1")
-        p  = soup.find("p")
-        parts = []
-        if h1: parts.append(h1.get_text().strip())
-        if p:  parts.append(p.get_text().strip())
+        parts = [t for t in (meta["h1"], meta["p"]) if t]
         if parts:
             return "／".join(parts)
 
@@ -83,21 +82,121 @@ def build_prompt(target_url, competitors_info, ga_data):
 """
     return prompt
 
+# --- 生成パラメータと応答キャッシュ ----------------------------------------------
+# 正規化したプロンプト＋モデル/温度などをキーにしたコンテンツアドレス型キャッシュ。
+# 同じ入力なら API を呼ばずに前回の提案を返す。
+
+_SYSTEM_PROMPT = "あなたはSEOの専門家です。"
+_MAX_TOKENS = 1000
+_TEMPERATURE = 0.7
+_LLM_NAMESPACE = "llm"
+LLM_CACHE_TTL = int(os.getenv("LLM_CACHE_TTL", str(7 * 24 * 3600)))   # 0 で無効
+
+_llm_memory = LRUCache(maxsize=256)
+_llm_flight = SingleFlight()
+
+def _model() -> str:
+    return os.getenv("OPENAI_MODEL", "gpt-4o-mini")  # 任意で上書き可。旧: gpt-3.5-turbo
+
+def _normalize_prompt(prompt: str) -> str:
+    """全角/半角ゆれ・行末空白・連続空行を揃え、意味の同じプロンプトを同じキーにする"""
+    text = unicodedata.normalize("NFKC", prompt or "")
+    lines = [ln.rstrip() for ln in text.strip().splitlines()]
+    return re.sub(r"\n{3,}", "\n\n", "\n".join(lines))
+
+def _cache_key(prompt: str) -> str:
+    payload = json.dumps(
+        [_model(), _TEMPERATURE, _MAX_TOKENS, _SYSTEM_PROMPT, _normalize_prompt(prompt)],
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+def get_cached_chatgpt_response(prompt: str) -> str | None:
+    """キャッシュ済みの応答があれば返す（API は呼ばない）"""
+    if LLM_CACHE_TTL <= 0:
+        return None
+    key = _cache_key(prompt)
+    text = _llm_memory.get(key)
+    if text is None:
+        text = get_shared_store().get(_LLM_NAMESPACE, key)
+        if text is not None:
+            _llm_memory.set(key, text, ttl=LLM_CACHE_TTL)
+    cache_event("llm", "miss" if text is None else "hit")
+    return text
+
+def _store_chatgpt_response(prompt: str, text: str):
+    if LLM_CACHE_TTL <= 0 or not text:
+        return
+    key = _cache_key(prompt)
+    _llm_memory.set(key, text, ttl=LLM_CACHE_TTL)
+    get_shared_store().set(_LLM_NAMESPACE, key, text, ttl=LLM_CACHE_TTL)
+
+def _messages(prompt: str) -> list[dict]:
+    return [
+        {"role": "system", "content": _SYSTEM_PROMPT},
+        {"role": "user", "content": prompt}
+    ]
+
+def _create_completion(prompt: str) -> str:
+    client = get_openai_client()
+
+    def _create():
+        with span("openai.completion"):
+            return client.chat.completions.create(
+                model=_model(),
+                messages=_messages(prompt),
+                max_tokens=_MAX_TOKENS,
+                temperature=_TEMPERATURE
+            )
+    resp = rate_limited("openai", _create)
+    text = (resp.choices[0].message.content or "").strip()
+    _store_chatgpt_response(prompt, text)
+    return text
+
 def get_chatgpt_response(prompt: str) -> str | None:
-    """OpenAIに投げて応答を返す"""
+    """OpenAIに投げて応答を返す（同じ入力はキャッシュから。同時の同一入力は 1 回に合流）"""
+    cached = get_cached_chatgpt_response(prompt)
+    if cached is not None:
+        return cached
     try:
-        client = get_openai_client()
-        model = os.getenv("OPENAI_MODEL", "gpt-4o-mini")  # 任意で上書き可。旧: gpt-3.5-turbo
-        resp = client.chat.completions.create(
-            model=model,
-            messages=[
-                {"role": "system", "content": "あなたはSEOの専門家です。"},
-                {"role": "user", "content": prompt}
-            ],
-            max_tokens=1000,
-            temperature=0.7
-        )
-        return (resp.choices[0].message.content or "").strip()
+        return _llm_flight.do(_cache_key(prompt), _create_completion, prompt)
     except Exception as e:
         print("❌ ChatGPT APIエラー:", e)
         return None
+
+def stream_chatgpt_response(prompt: str):
+    """
+    応答をトークン（差分テキスト）単位で順に yield するジェネレータ。
+    キャッシュにあれば全文を 1 回で返す。最後まで受け取れた応答だけキャッシュに保存する。
+    途中で失敗したときは例外を投げる（途中までの応答を完了扱いにしない）。
+    """
+    cached = get_cached_chatgpt_response(prompt)
+    if cached is not None:
+        yield cached
+        return
+    parts = []
+    try:
+        client = get_openai_client()
+
+        def _open():
+            with span("openai.stream_open"):   # 最初の応答（ヘッダ）が返るまで
+                return client.chat.completions.create(
+                    model=_model(),
+                    messages=_messages(prompt),
+                    max_tokens=_MAX_TOKENS,
+                    temperature=_TEMPERATURE,
+                    stream=True,
+                )
+        # 再試行するのはストリームを開くまで（途中まで yield した後は呼び直さない）
+        stream = rate_limited("openai", _open)
+        for chunk in stream:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content or ""
+            if delta:
+                parts.append(delta)
+                yield delta
+    except Exception as e:
+        print("❌ ChatGPT APIエラー(stream):", e)
+        raise
+    _store_chatgpt_response(prompt, "".join(parts).strip())
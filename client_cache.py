@@ -0,0 +1,78 @@
+import hashlib
+import threading
+import weakref
+
+from cache_utils import LRUCache
+from metrics import cache_event
+
+# --- ユーザーOAuth Credentials ごとの API クライアントキャッシュ ------------------
+# discovery の build / gRPC チャネル生成 / gspread の認可を 1 解析で何度も繰り返さないため、
+# 資格情報（≒ユーザー）単位でクライアントを使い回す。
+# スレッド非安全なクライアントはスレッドローカルに持つ（ThreadPoolExecutor の短命なスレッドの分は
+# スレッドと一緒に消えるので、共有のキャッシュから長生きのものを追い出さない）。
+
+_clients = LRUCache(maxsize=256)
+_PER_THREAD_MAXSIZE = 32
+_local = threading.local()
+_thread_caches = weakref.WeakSet()   # invalidate で全スレッドの分を消すため（スレッド終了で自然に外れる）
+_thread_caches_lock = threading.Lock()
+
+
+def _credential_key(creds) -> str:
+    """
+    資格情報を表すキー。refresh_token があればそれを基準にする
+    （アクセストークンは更新で変わるが、同じユーザーの同じ資格情報とみなせる）。
+    """
+    ident = getattr(creds, "refresh_token", None) or getattr(creds, "token", None) or id(creds)
+    client_id = getattr(creds, "client_id", None) or ""
+    return hashlib.sha256(f"{client_id}:{ident}".encode()).hexdigest()
+
+
+def _is_stale(cached_creds) -> bool:
+    """キャッシュ中のクライアントが持つ資格情報がもう使えないか（自分で更新できない期限切れ）"""
+    if getattr(cached_creds, "refresh_token", None):
+        return False   # google-auth がリクエスト時に自動リフレッシュする
+    return not getattr(cached_creds, "valid", True)
+
+
+def get_client(kind: str, creds, factory, *, per_thread: bool = False):
+    """
+    kind + 資格情報 をキーにクライアントを返す。無ければ factory(creds) で作って保存する。
+    per_thread=True はスレッド非安全なクライアント用で、スレッドごとに別インスタンスを持つ
+    （スレッドが終われば消えるので、使い捨てのスレッドプールからは毎回作り直しになる。
+    googleapiclient は共有のサービス＋スレッドごとの http で実行する方が安い: gsc_utils._execute）。
+    """
+    cache = _thread_cache() if per_thread else _clients
+    key = (kind, _credential_key(creds))
+    entry = cache.get(key)
+    if entry is not None and not _is_stale(entry[0]):
+        cache_event("api_client", "hit")
+        return entry[1]
+    cache_event("api_client", "miss")
+
+    # 同時に作られても害はない（後勝ちで保存される）ので、生成はロックの外で行う
+    client = factory(creds)
+    cache.set(key, (creds, client))
+    return client
+
+
+def _thread_cache() -> LRUCache:
+    cache = getattr(_local, "clients", None)
+    if cache is None:
+        cache = _local.clients = LRUCache(maxsize=_PER_THREAD_MAXSIZE)
+        with _thread_caches_lock:
+            _thread_caches.add(cache)
+    return cache
+
+
+def invalidate(creds=None):
+    """資格情報が失効・再発行されたときに呼ぶ。creds=None なら全件破棄"""
+    with _thread_caches_lock:
+        caches = [_clients, *_thread_caches]
+    if creds is None:
+        for cache in caches:
+            cache.clear()
+        return
+    cred_key = _credential_key(creds)
+    for cache in caches:
+        cache.discard_if(lambda key: key[1] == cred_key)
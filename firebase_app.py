@@ -0,0 +1,41 @@
+import threading
+
+# --- firebase_admin の遅延初期化 ------------------------------------------------
+# firebase_admin.firestore は google.cloud.firestore（gRPC）ごと読み込むので重い。
+# import 時には初期化せず、Firestore / Auth を最初に使うときに 1 回だけ初期化する
+# （/privacy や /login の表示だけならコールドスタートで読み込まない）。
+
+_db = None
+_lock = threading.Lock()
+
+
+def ensure_app():
+    """既定の firebase_admin アプリを（まだなら）初期化する"""
+    import firebase_admin
+    try:
+        firebase_admin.get_app()
+    except ValueError:
+        with _lock:
+            try:
+                firebase_admin.get_app()
+            except ValueError:
+                firebase_admin.initialize_app()
+
+
+def get_db():
+    """Firestore クライアント（プロセスで 1 つ）"""
+    global _db
+    if _db is None:
+        ensure_app()
+        from firebase_admin import firestore
+        with _lock:
+            if _db is None:
+                _db = firestore.client()
+    return _db
+
+
+def get_auth():
+    """firebase_admin.auth モジュール（アプリ初期化済みの状態で返す）"""
+    ensure_app()
+    from firebase_admin import auth
+    return auth
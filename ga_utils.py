@@ -3,15 +3,41 @@ import pandas as pd
 
 from google.analytics.data_v1beta import BetaAnalyticsDataClient
 from google.analytics.data_v1beta.types import (
-    RunReportRequest, DateRange, Metric, Dimension,
+    RunReportRequest, BatchRunReportsRequest, DateRange, Metric, Dimension,
     Filter, FilterExpression
 )
 
+from client_cache import get_client
+from metrics import span
+from rate_limit import call as rate_limited
+
+# batchRunReports は 1 回あたり最大 5 レポートまで
+_BATCH_MAX_REPORTS = 5
+# in_list フィルタ 1 件に詰める pagePath 数
+_IN_LIST_CHUNK = 500
+# 1 レポートあたりの最大行数（GA4 Data API の上限）
+_REPORT_ROW_LIMIT = 100000
+
+def get_ga_data_client(creds) -> BetaAnalyticsDataClient:
+    """GA4 Data API クライアント（gRPC チャネルごと資格情報単位で使い回す。スレッドセーフ）"""
+    return get_client("ga4-data", creds, lambda c: BetaAnalyticsDataClient(credentials=c))
+
 def _as_property_str(prop) -> str:
     """ 123456789 / '123456789' → 'properties/123456789' を保証 """
     s = str(prop)
     return s if s.startswith("properties/") else f"properties/{s}"
 
+def can_access_property(creds, ga_property) -> bool:
+    """ユーザーがプロパティのデータを読めるか（getMetadata が通るか。レポートは実行しない）"""
+    property_name = _as_property_str(ga_property)
+    client = get_ga_data_client(creds)
+    try:
+        rate_limited("ga", client.get_metadata, name=f"{property_name}/metadata", key=property_name)
+        return True
+    except Exception as e:
+        print(f"GA権限確認NG: {property_name} -> {type(e).__name__}")
+        return False
+
 def _ensure_path(url_or_path: str) -> str:
     """ URLでもpathでも受け取り、必ず '/...' の形にする """
     if not url_or_path:
@@ -24,6 +50,19 @@ def _ensure_path(url_or_path: str) -> str:
     except Exception:
         return "/"
 
+def _run_report(client, req, property_name: str):
+    """runReport を 1 回（プロパティ単位のレート制限・429/5xx の再試行つき）"""
+    def _run():
+        with span("ga.report"):
+            return client.run_report(req)
+    return rate_limited("ga", _run, key=property_name)
+
+def _batch_run_reports(client, req, property_name: str):
+    def _run():
+        with span("ga.batch_report", reports=len(req.requests)):
+            return client.batch_run_reports(req)
+    return rate_limited("ga", _run, key=property_name)
+
 def fetch_ga_conversion_for_url(
     *,
     creds,            # ★ 追加：ユーザーOAuthの Credentials
@@ -39,7 +78,7 @@ def fetch_ga_conversion_for_url(
     property_name = _as_property_str(ga_property)
     path = _ensure_path(full_url)
 
-    client = BetaAnalyticsDataClient(credentials=creds)
+    client = get_ga_data_client(creds)
 
     req = RunReportRequest(
         property=property_name,
@@ -57,7 +96,7 @@ def fetch_ga_conversion_for_url(
         ),
     )
 
-    resp = client.run_report(req)
+    resp = _run_report(client, req, property_name)
 
     rows = []
     for r in getattr(resp, "rows", []):
@@ -67,6 +106,91 @@ def fetch_ga_conversion_for_url(
         })
     return pd.DataFrame(rows)
 
+def _rows_to_conversions(resp) -> dict:
+    out = {}
+    for r in getattr(resp, "rows", []):
+        path = r.dimension_values[0].value
+        out[path] = out.get(path, 0) + int(float(r.metric_values[0].value or 0))
+    return out
+
+def _conversion_request(property_name, start_date, end_date, paths=None, offset=0):
+    kwargs = dict(
+        date_ranges=[DateRange(start_date=start_date, end_date=end_date)],
+        dimensions=[Dimension(name="pagePath")],
+        metrics=[Metric(name="conversions")],
+        limit=_REPORT_ROW_LIMIT,
+        offset=offset,
+    )
+    if property_name:
+        # batchRunReports の中身は親リクエストの property を使うので空のまま
+        kwargs["property"] = property_name
+    if paths is not None:
+        kwargs["dimension_filter"] = FilterExpression(
+            filter=Filter(
+                field_name="pagePath",
+                in_list_filter=Filter.InListFilter(values=list(paths)),
+            )
+        )
+    return RunReportRequest(**kwargs)
+
+def fetch_ga_conversions_for_paths(
+    *,
+    creds,
+    ga_property,
+    start_date: str,
+    end_date: str,
+    urls,
+    mode: str = "auto",
+) -> pd.DataFrame:
+    """
+    複数 URL/パスのコンバージョンをまとめて取得する（URL 1件ごとに RPC しない）。
+    - mode="in_list": pagePath の in_list フィルタを 500 件ずつ作り、
+                      batchRunReports（最大5レポート/回）でまとめて投げる
+    - mode="scan":    フィルタ無しで pagePath 全件を取得し、ローカルで突き合わせる
+    - mode="auto":    パス数が多いときは scan、少ないときは in_list
+    返値: DataFrame(columns=['URL','コンバージョン数'])（URL は '/...' のパス、データがあるものだけ）
+    """
+    property_name = _as_property_str(ga_property)
+    paths = list(dict.fromkeys(_ensure_path(u) for u in (urls or [])))
+    if not paths:
+        return pd.DataFrame(columns=["URL", "コンバージョン数"])
+
+    if mode == "auto":
+        mode = "scan" if len(paths) > _IN_LIST_CHUNK * _BATCH_MAX_REPORTS else "in_list"
+
+    client = get_ga_data_client(creds)
+    conversions = {}
+
+    if mode == "scan":
+        offset = 0
+        while True:
+            resp = _run_report(
+                client, _conversion_request(property_name, start_date, end_date, offset=offset), property_name
+            )
+            for k, v in _rows_to_conversions(resp).items():
+                conversions[k] = conversions.get(k, 0) + v
+            offset += len(resp.rows)
+            if not resp.rows or offset >= resp.row_count:
+                break
+    else:
+        chunks = [paths[i:i + _IN_LIST_CHUNK] for i in range(0, len(paths), _IN_LIST_CHUNK)]
+        for i in range(0, len(chunks), _BATCH_MAX_REPORTS):
+            batch = chunks[i:i + _BATCH_MAX_REPORTS]
+            resp = _batch_run_reports(client, BatchRunReportsRequest(
+                property=property_name,
+                requests=[_conversion_request(None, start_date, end_date, c) for c in batch],
+            ), property_name)
+            for report in resp.reports:
+                for k, v in _rows_to_conversions(report).items():
+                    conversions[k] = conversions.get(k, 0) + v
+
+    wanted = set(paths)
+    rows = [
+        {"URL": p, "コンバージョン数": c}
+        for p, c in conversions.items() if p in wanted
+    ]
+    return pd.DataFrame(rows, columns=["URL", "コンバージョン数"])
+
 def get_domain_from_url(site_url: str) -> str:
     """
     https://www.example.com → https://example.com
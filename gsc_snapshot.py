@@ -0,0 +1,208 @@
+import os
+import sqlite3
+import threading
+import time
+from datetime import date, timedelta
+
+import pandas as pd
+from googleapiclient.errors import HttpError
+
+from cache_utils import SingleFlight
+from metrics import inc
+from gsc_utils import can_access_site, fetch_gsc_daily_rows, fetch_gsc_data, run_parallel, _to_date, _GSC_COLUMNS
+
+# --- Search Console の日別スナップショット ------------------------------------------
+# プロパティごとに query×page×date の行をローカル SQLite に貯めておき、
+# 解析のたびに 28 日分を取り直すのではなく「まだ持っていない日」と「未確定の日」だけ取得する。
+# 28 日集計はローカルで作る（クリック・表示回数は合計、順位は表示回数で加重平均）。
+#
+# ※ 日別に取った行の合計は、期間まとめて取った値と匿名化クエリの扱いなどで僅かにずれることがある。
+
+# GSC のデータは概ね 3 日経つと確定する。それより新しい日は未確定として取り直す対象にする
+FINAL_AFTER_DAYS = 3
+# 未確定の日を取り直す間隔（秒）
+NONFINAL_REFRESH = int(os.getenv("GSC_SNAPSHOT_NONFINAL_REFRESH", str(3 * 3600)))
+# これより古い日は捨てる
+RETENTION_DAYS = int(os.getenv("GSC_SNAPSHOT_RETENTION_DAYS", "90"))
+
+
+def default_snapshot_path() -> str:
+    return os.getenv("GSC_SNAPSHOT_DB", "/tmp/mrseo_gsc.sqlite3")
+
+
+class GscSnapshotStore:
+    """プロパティ単位の日別行ストア（スレッドごとに接続、WAL で複数プロセスから共有）"""
+
+    def __init__(self, path: str | None = None):
+        self.path = path or default_snapshot_path()
+        self._local = threading.local()
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS gsc_rows ("
+                " property TEXT NOT NULL, day TEXT NOT NULL, query TEXT, page TEXT,"
+                " clicks INTEGER, impressions INTEGER, position REAL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS gsc_rows_prop_day ON gsc_rows (property, day)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS gsc_days ("
+                " property TEXT NOT NULL, day TEXT NOT NULL, final INTEGER NOT NULL,"
+                " fetched_at REAL NOT NULL, PRIMARY KEY (property, day))"
+            )
+            self._local.conn = conn
+        return conn
+
+    def days_to_fetch(self, sc_property: str, start_date, end_date) -> list[str]:
+        """期間内で「未取得」または「未確定かつ取り直し時期」の日付（ISO 文字列）"""
+        sd, ed = _to_date(start_date), _to_date(end_date)
+        known = dict(
+            (d, (final, fetched_at)) for d, final, fetched_at in self._conn().execute(
+                "SELECT day, final, fetched_at FROM gsc_days WHERE property = ? AND day BETWEEN ? AND ?",
+                (sc_property, sd.isoformat(), ed.isoformat()),
+            )
+        )
+        now = time.time()
+        out = []
+        for i in range((ed - sd).days + 1):
+            d = (sd + timedelta(days=i)).isoformat()
+            state = known.get(d)
+            if state is None:
+                out.append(d)
+            elif not state[0] and now - state[1] >= NONFINAL_REFRESH:
+                out.append(d)
+        return out
+
+    def replace_day(self, sc_property: str, day: str, rows: pd.DataFrame, today: date | None = None):
+        """1 日分の行を入れ替える（未確定→確定の上書きも同じ処理）"""
+        today = today or date.today()
+        final = _to_date(day) <= today - timedelta(days=FINAL_AFTER_DAYS)
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("DELETE FROM gsc_rows WHERE property = ? AND day = ?", (sc_property, day))
+            conn.executemany(
+                "INSERT INTO gsc_rows (property, day, query, page, clicks, impressions, position)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    (sc_property, day, q, u, int(c), int(i), float(p))
+                    for q, u, c, i, p in zip(
+                        rows["検索キーワード"], rows["URL"], rows["クリック数"], rows["表示回数"], rows["平均順位"]
+                    )
+                ),
+            )
+            conn.execute(
+                "INSERT OR REPLACE INTO gsc_days (property, day, final, fetched_at) VALUES (?, ?, ?, ?)",
+                (sc_property, day, int(final), time.time()),
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def aggregate(self, sc_property: str, start_date, end_date) -> pd.DataFrame:
+        """期間の [query, page] 集計を fetch_gsc_data と同じ列で返す"""
+        cur = self._conn().execute(
+            "SELECT query, page, SUM(clicks), SUM(impressions),"
+            "       SUM(position * impressions), AVG(position)"
+            " FROM gsc_rows WHERE property = ? AND day BETWEEN ? AND ?"
+            " GROUP BY query, page ORDER BY SUM(clicks) DESC",
+            (sc_property, _to_date(start_date).isoformat(), _to_date(end_date).isoformat()),
+        )
+        data = []
+        for query, page, clicks, imps, pos_w, pos_avg in cur:
+            data.append([
+                query,
+                page,
+                clicks,
+                imps,
+                round(clicks / imps * 100, 2) if imps else 0.0,
+                round(pos_w / imps, 2) if imps else round(pos_avg or 0.0, 2),
+            ])
+        return pd.DataFrame(data, columns=_GSC_COLUMNS)
+
+    def prune(self, today: date | None = None):
+        cutoff = ((today or date.today()) - timedelta(days=RETENTION_DAYS)).isoformat()
+        conn = self._conn()
+        conn.execute("DELETE FROM gsc_rows WHERE day < ?", (cutoff,))
+        conn.execute("DELETE FROM gsc_days WHERE day < ?", (cutoff,))
+
+
+_store = None
+_store_lock = threading.Lock()
+_day_flight = SingleFlight()
+
+
+def get_snapshot_store() -> GscSnapshotStore:
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = GscSnapshotStore()
+    return _store
+
+
+def fetch_gsc_window(
+    *,
+    creds,
+    sc_property: str,
+    start_date,
+    end_date,
+    max_workers: int = 4,
+    store: GscSnapshotStore | None = None,
+) -> pd.DataFrame:
+    """
+    スナップショットを使って期間の [query, page] 集計を返す。
+    足りない日・未確定の日だけ API から日別に取得して保存し、集計はローカルで行う。
+    スナップショットが使えないとき（DB エラー等）は従来どおり期間まとめて取得する。
+    スナップショットはプロパティ単位でユーザー間に共有されるので、返す前に creds のユーザーが
+    そのプロパティを読めることを確認する（読めなければ空、確認できなければ creds で直接取得）。
+    """
+    try:
+        if not can_access_site(creds, sc_property):
+            print(f"⚠️ {sc_property} へのアクセス権がないため GSC データを返しません")
+            return pd.DataFrame(columns=_GSC_COLUMNS)
+    except Exception as e:
+        print("⚠️ GSCのアクセス権を確認できません（直接取得します）:", e)
+        return fetch_gsc_data(
+            creds=creds, sc_property=sc_property, start_date=start_date, end_date=end_date,
+            paginate=True, date_shards=4,
+        )
+
+    try:
+        store = store or get_snapshot_store()
+        missing = store.days_to_fetch(sc_property, start_date, end_date)
+        total = (_to_date(end_date) - _to_date(start_date)).days + 1
+        inc("mrseo_gsc_snapshot_days_total", total - len(missing), source="snapshot")
+        inc("mrseo_gsc_snapshot_days_total", len(missing), source="api")
+    except sqlite3.Error as e:
+        print("⚠️ GSCスナップショット利用不可（直接取得します）:", e)
+        return fetch_gsc_data(
+            creds=creds, sc_property=sc_property, start_date=start_date, end_date=end_date,
+            paginate=True, date_shards=4,
+        )
+
+    if missing:
+        print(f"📥 GSCスナップショット: {sc_property} の {len(missing)} 日分を取得")
+
+        def _fetch_day(day):
+            # 同じプロパティ・同じ日の取得が同時に走らないようにまとめる
+            def _load():
+                rows = fetch_gsc_daily_rows(
+                    creds=creds, sc_property=sc_property, start_date=day, end_date=day
+                )
+                store.replace_day(sc_property, day, rows)
+            _day_flight.do((sc_property, day), _load)
+
+        try:
+            run_parallel(_fetch_day, missing, max_workers)
+        except HttpError as e:
+            # 一部の日だけ欠けた集計は誤解を招くので、fetch_gsc_data と同じく空で返す
+            print("❌ GSC API エラー:", e)
+            return pd.DataFrame(columns=_GSC_COLUMNS)
+        store.prune()
+
+    return store.aggregate(sc_property, start_date, end_date)
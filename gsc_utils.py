@@ -1,21 +1,97 @@
+import os
+import threading
+
+import httplib2
+import numpy as np
 import pandas as pd
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import date, timedelta
+from functools import lru_cache
 from urllib.parse import urlparse
+from google_auth_httplib2 import AuthorizedHttp
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 
+from cache_utils import LRUCache
+from client_cache import _credential_key, get_client
+from metrics import span
+from rate_limit import call as rate_limited
+
 # --- ユーザーOAuthの Credentials を受け取って使う -----------------------------
+# discovery で作るサービスオブジェクトは資格情報ごとに 1 つを全スレッドで共有し、
+# 通信だけスレッドごとの httplib2.Http で行う（httplib2 はスレッド非安全）。
+# 並列取得は下の常駐スレッドプールで行うので、スレッドごとの接続（TLS）も使い回される。
+
+GSC_POOL_SIZE = int(os.getenv("GSC_POOL_SIZE", "8"))
+
+_local = threading.local()
+_pool = None
+_pool_lock = threading.Lock()
 
 def get_search_console_service(creds):
-    """Search Console v1 クライアント（ユーザーOAuthで）"""
-    return build('searchconsole', 'v1', credentials=creds, cache_discovery=False)
+    """Search Console v1 クライアント（ユーザーOAuthで）。資格情報ごとに使い回す（実行は _execute で）"""
+    return get_client(
+        "searchconsole",
+        creds,
+        lambda c: build('searchconsole', 'v1', credentials=c, cache_discovery=False),
+    )
+
+def _thread_http() -> httplib2.Http:
+    http = getattr(_local, "http", None)
+    if http is None:
+        http = _local.http = httplib2.Http(timeout=60)
+    return http
+
+def _execute(request, creds):
+    """共有のサービスで作ったリクエストを、このスレッドの接続と creds の認可で実行する"""
+    return request.execute(http=AuthorizedHttp(creds, http=_thread_http()))
+
+def _get_pool() -> ThreadPoolExecutor:
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ThreadPoolExecutor(max_workers=GSC_POOL_SIZE, thread_name_prefix="gsc")
+    return _pool
+
+def run_parallel(fn, items, max_workers: int) -> list:
+    """
+    items を常駐プールで fn に渡し、結果を items の順で返す（同時実行は max_workers まで）。
+    例外は最初のものをそのまま投げる。プールのスレッドの中からは呼ばない（入れ子で詰まる）。
+    """
+    items = list(items)
+    results = [None] * len(items)
+    pool = _get_pool()
+    running = {}
+    todo = iter(enumerate(items))
+    try:
+        for i, item in todo:
+            running[pool.submit(fn, item)] = i
+            if len(running) >= max(1, max_workers):
+                break
+        while running:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for f in done:
+                results[running.pop(f)] = f.result()
+                nxt = next(todo, None)
+                if nxt is not None:
+                    running[pool.submit(fn, nxt[1])] = nxt[0]
+    finally:
+        for f in running:
+            f.cancel()
+    return results
 
 def list_sc_sites(creds) -> list[str]:
     """
     （任意）ユーザーがアクセス権のあるサイト一覧を取得。
     Search Console のサイト列挙は webmasters v3 を使うのが安定。
     """
-    svc = build('webmasters', 'v3', credentials=creds, cache_discovery=False)
-    res = svc.sites().list().execute()
+    svc = get_client(
+        "webmasters",
+        creds,
+        lambda c: build('webmasters', 'v3', credentials=c, cache_discovery=False),
+    )
+    res = rate_limited("gsc", lambda: _execute(svc.sites().list(), creds))
     sites = []
     for entry in res.get('siteEntry', []):
         # 未確認サイトは除外
@@ -23,6 +99,22 @@ def list_sc_sites(creds) -> list[str]:
             sites.append(entry.get('siteUrl'))
     return sites
 
+# サイトへのアクセス権の確認結果（資格情報×プロパティ）。共有のスナップショットを返す前に使う
+ACCESS_CHECK_TTL = int(os.getenv("ACCESS_CHECK_TTL", "600"))
+_site_access = LRUCache(maxsize=4096, ttl=ACCESS_CHECK_TTL)
+
+def can_access_site(creds, sc_property: str) -> bool:
+    """
+    資格情報のユーザーが sc_property を読めるか（list_sc_sites に含まれるか）。
+    結果は資格情報ごとに ACCESS_CHECK_TTL 秒キャッシュする。確認できないとき（API エラー）は例外を投げる。
+    """
+    key = (_credential_key(creds), sc_property)
+    allowed = _site_access.get(key)
+    if allowed is None:
+        allowed = sc_property in list_sc_sites(creds)
+        _site_access.set(key, allowed)
+    return allowed
+
 # --- ユーティリティ -----------------------------------------------------------
 
 def _iso(d) -> str:
@@ -47,6 +139,93 @@ def normalize_url(url: str) -> str:
     path = p.path or '/'
     return f"{scheme}://{netloc}{path}"
 
+def _to_date(d) -> date:
+    if isinstance(d, date):
+        return d if type(d) is date else d.date()
+    return date.fromisoformat(str(d)[:10])
+
+def _date_shards(start_date, end_date, shards: int) -> list[tuple[str, str]]:
+    """[start, end] をおおよそ等分した日付区間のリストに分割する"""
+    sd, ed = _to_date(start_date), _to_date(end_date)
+    days = (ed - sd).days + 1
+    shards = max(1, min(shards, days))
+    size, extra = divmod(days, shards)
+    out, cur = [], sd
+    for i in range(shards):
+        n = size + (1 if i < extra else 0)
+        out.append((cur.isoformat(), (cur + timedelta(days=n - 1)).isoformat()))
+        cur += timedelta(days=n)
+    return out
+
+_GSC_COLUMNS = ['検索キーワード', 'URL', 'クリック数', '表示回数', 'CTR（%）', '平均順位']
+# Search Analytics API の 1 リクエストあたりの上限
+_GSC_MAX_PAGE = 25000
+
+@lru_cache(maxsize=65536)
+def _normalize_url_cached(url: str) -> str:
+    return normalize_url(url) if url else ''
+
+def _normalize_pages(pages: list[str]) -> list[str]:
+    """同じページが何千回も出てくるので、異なる URL ごとに 1 回だけ正規化する"""
+    mapping = {u: _normalize_url_cached(u) for u in dict.fromkeys(pages)}
+    return [mapping[u] for u in pages]
+
+def _key_at(keys_list, i: int) -> list[str]:
+    return [k[i] if len(k) > i else '' for k in keys_list]
+
+def _metric(rows, name: str, dtype) -> np.ndarray:
+    return np.fromiter((r.get(name) or 0 for r in rows), dtype=dtype, count=len(rows))
+
+def _rows_to_frame(rows) -> pd.DataFrame:
+    """API の rows を列ごとの配列にまとめてから DataFrame 化する（行ごとの Python 処理を避ける）"""
+    if not rows:
+        return pd.DataFrame(columns=_GSC_COLUMNS)
+    keys = [r.get('keys') or () for r in rows]
+    return pd.DataFrame({
+        '検索キーワード': _key_at(keys, 1),
+        'URL':          _normalize_pages(_key_at(keys, 0)),
+        'クリック数':     _metric(rows, 'clicks', np.int64),
+        '表示回数':      _metric(rows, 'impressions', np.int64),
+        'CTR（%）':      np.round(_metric(rows, 'ctr', np.float64) * 100, 2),     # → %
+        '平均順位':      np.round(_metric(rows, 'position', np.float64), 2),
+    }, columns=_GSC_COLUMNS)
+
+def _query(svc, creds, sc_property: str, body: dict) -> dict:
+    """searchanalytics.query を 1 回（サイト単位のレート制限・429/5xx の再試行つき）"""
+    def _run():
+        with span("gsc.query"):
+            return _execute(svc.searchanalytics().query(siteUrl=sc_property, body=body), creds)
+    return rate_limited("gsc", _run, key=sc_property)
+
+def _iter_pages(creds, sc_property: str, body: dict, page_size: int, max_rows: int | None):
+    """startRow を進めながら 1 ページずつ rows を返す（最後のページは page_size 未満）"""
+    svc = get_search_console_service(creds)
+    start = 0
+    while True:
+        limit = page_size if max_rows is None else min(page_size, max_rows - start)
+        if limit <= 0:
+            return
+        page_body = dict(body, rowLimit=limit, startRow=start)
+        resp = _query(svc, creds, sc_property, page_body)
+        rows = resp.get('rows', [])
+        if rows:
+            yield rows
+        if len(rows) < limit:
+            return
+        start += len(rows)
+
+def _combine_shards(frames: list[pd.DataFrame]) -> pd.DataFrame:
+    """日付シャードごとの [query, page] 集計を 1 期間分に合算する（順位は表示回数で加重平均）"""
+    df = pd.concat(frames, ignore_index=True)
+    df['_pos_w'] = df['平均順位'] * df['表示回数']
+    g = df.groupby(['検索キーワード', 'URL'], as_index=False, sort=False).agg(
+        {'クリック数': 'sum', '表示回数': 'sum', '_pos_w': 'sum', '平均順位': 'mean'}
+    )
+    imps = g['表示回数'].where(g['表示回数'] > 0)
+    g['CTR（%）'] = (g['クリック数'] / imps * 100).fillna(0.0).round(2)
+    g['平均順位'] = (g['_pos_w'] / imps).fillna(g['平均順位']).round(2)
+    return g[_GSC_COLUMNS].sort_values('クリック数', ascending=False, kind='stable').reset_index(drop=True)
+
 # --- メイン：検索アナリティクス ------------------------------------------------
 
 def fetch_gsc_data(
@@ -57,13 +236,18 @@ def fetch_gsc_data(
     end_date,              # date/datetime/str どれでもOK
     row_limit: int = 25000,
     url_filter: str | None = None,   # ページに contains フィルタを掛けたいとき
+    paginate: bool = False,          # True なら startRow で 25,000 行を超えて取得
+    date_shards: int = 1,            # 期間を分割して並列取得する数（paginate 時のみ）
+    max_workers: int = 4,
+    max_rows: int | None = None,     # paginate 時の各シャードの上限行数（None=全件）
 ) -> pd.DataFrame:
     """
     Search Console Search Analytics API v1 を叩いて
     [query, page] 単位の指標を DataFrame で返す。
-    """
-    svc = get_search_console_service(creds)
 
+    paginate=True のときは startRow を進めて全件を取得し、さらに date_shards>1 なら
+    期間を分割して並列に取得する。届いたページから順に DataFrame 化して最後に結合する。
+    """
     body = {
         'startDate': _iso(start_date),
         'endDate': _iso(end_date),
@@ -80,31 +264,68 @@ def fetch_gsc_data(
         }]
 
     try:
-        resp = svc.searchanalytics().query(siteUrl=sc_property, body=body).execute()
-        rows = resp.get('rows', [])
-        data = []
-        for r in rows:
-            keys = r.get('keys', [])
-            page = keys[0] if len(keys) > 0 else ''
-            query = keys[1] if len(keys) > 1 else ''
-            clicks = r.get('clicks', 0) or 0
-            imps   = r.get('impressions', 0) or 0
-            ctr    = r.get('ctr', 0.0) or 0.0
-            pos    = r.get('position', 0.0) or 0.0
-            data.append([
-                query,
-                normalize_url(page) if page else '',
-                clicks,
-                imps,
-                round(ctr * 100, 2),     # → %
-                round(pos, 2),
-            ])
-
-        return pd.DataFrame(
-            data,
-            columns=['検索キーワード', 'URL', 'クリック数', '表示回数', 'CTR（%）', '平均順位']
-        )
+        if not paginate:
+            svc = get_search_console_service(creds)
+            resp = _query(svc, creds, sc_property, body)
+            return _rows_to_frame(resp.get('rows', []))
+
+        page_size = min(row_limit, _GSC_MAX_PAGE)
+        shards = _date_shards(start_date, end_date, date_shards)
+
+        def _fetch_shard(shard):
+            shard_body = dict(body, startDate=shard[0], endDate=shard[1])
+            # ページが届くたびに DataFrame 化しておく（生の dict を溜め込まない）
+            return [_rows_to_frame(rows) for rows in _iter_pages(creds, sc_property, shard_body, page_size, max_rows)]
+
+        frames = [frame for shard_frames in run_parallel(_fetch_shard, shards, max_workers) for frame in shard_frames]
+
+        if not frames:
+            return pd.DataFrame(columns=_GSC_COLUMNS)
+        if len(shards) == 1:
+            return pd.concat(frames, ignore_index=True)
+        return _combine_shards(frames)
 
     except HttpError as e:
         print("❌ GSC API エラー:", e)
-        return pd.DataFrame(columns=['検索キーワード', 'URL', 'クリック数', '表示回数', 'CTR（%）', '平均順位'])
+        return pd.DataFrame(columns=_GSC_COLUMNS)
+
+
+# --- 日別の取得（スナップショット用） --------------------------------------------
+
+_GSC_DAILY_COLUMNS = ['日付', '検索キーワード', 'URL', 'クリック数', '表示回数', '平均順位']
+
+def _daily_rows_to_frame(rows) -> pd.DataFrame:
+    if not rows:
+        return pd.DataFrame(columns=_GSC_DAILY_COLUMNS)
+    keys = [r.get('keys') or () for r in rows]
+    return pd.DataFrame({
+        '日付':          _key_at(keys, 0),
+        '検索キーワード': _key_at(keys, 2),
+        'URL':          _normalize_pages(_key_at(keys, 1)),
+        'クリック数':     _metric(rows, 'clicks', np.int64),
+        '表示回数':      _metric(rows, 'impressions', np.int64),
+        '平均順位':      _metric(rows, 'position', np.float64),
+    }, columns=_GSC_DAILY_COLUMNS)
+
+def fetch_gsc_daily_rows(
+    *,
+    creds,
+    sc_property: str,
+    start_date,
+    end_date,
+    data_state: str = 'all',   # 'all' なら確定前（直近数日）のデータも含む
+) -> pd.DataFrame:
+    """
+    [date, page, query] 単位の日別行を startRow で全件取得して返す。
+    列: ['日付','検索キーワード','URL','クリック数','表示回数','平均順位']（順位は丸めない）
+    """
+    body = {
+        'startDate': _iso(start_date),
+        'endDate': _iso(end_date),
+        'dimensions': ['date', 'page', 'query'],
+        'dataState': data_state,
+    }
+    frames = [_daily_rows_to_frame(rows) for rows in _iter_pages(creds, sc_property, body, _GSC_MAX_PAGE, None)]
+    if not frames:
+        return pd.DataFrame(columns=_GSC_DAILY_COLUMNS)
+    return pd.concat(frames, ignore_index=True)
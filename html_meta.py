@@ -0,0 +1,163 @@
+import codecs
+import os
+import re
+from html.parser import HTMLParser
+
+# --- ページのメタ情報をストリームのまま取り出す -------------------------------------
+# 競合ページには数 MB の HTML もあるので、全文をダウンロードして BeautifulSoup に掛けるのではなく、
+# 届いたチャンクから順にインクリメンタルに解析し、必要な情報が揃った時点で読むのをやめる。
+# - description / og:description があれば </head>（または <body> の開始）で終了
+# - どちらも無ければ本文に進み、h1 と最初の <p> を拾ったところで終了（紹介文のフォールバック用）
+# - どの場合も MAX_BYTES で打ち切る
+
+MAX_BYTES = int(os.getenv("HTML_META_MAX_BYTES", str(512 * 1024)))
+CHUNK_SIZE = 16 * 1024
+# 解析をやめた後、これ以下の残りなら読み捨てて接続を再利用する
+DRAIN_BYTES = 64 * 1024
+# <meta charset> を探す先頭のバイト数
+_SNIFF_BYTES = 4096
+
+EMPTY_META = {"title": "", "description": "", "og_description": "", "canonical": "", "h1": "", "p": ""}
+
+# <meta charset="..."> / <meta http-equiv="Content-Type" content="text/html; charset=...">
+_META_CHARSET = re.compile(rb"""<meta[^>]+charset\s*=\s*["']?\s*([A-Za-z0-9_\-:.]+)""", re.I)
+_SPACES = re.compile(r"\s+")
+# これらが出てきたら本文に入ったとみなす
+_BODY_TAGS = frozenset((
+    "body", "div", "main", "header", "footer", "section", "article", "nav",
+    "ul", "ol", "table", "form", "h2", "h3",
+))
+
+
+def _clean(text: str) -> str:
+    return _SPACES.sub(" ", text).strip()
+
+
+class _MetaParser(HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.meta = dict(EMPTY_META)
+        self.done = False
+        self._in_body = False
+        self._capture = None    # いま本文を集めているタグ（title / h1 / p）
+        self._buf = []
+
+    # 本文に入った時点で description 系が揃っていれば終わり
+    def _enter_body(self):
+        if not self._in_body:
+            self._in_body = True
+            if self.meta["description"] or self.meta["og_description"]:
+                self.done = True
+
+    def handle_starttag(self, tag, attrs):
+        if self.done:
+            return
+        if tag == "meta":
+            a = {k.lower(): (v or "") for k, v in attrs}
+            name = a.get("name", "").lower()
+            prop = a.get("property", "").lower()
+            if name == "description" and not self.meta["description"]:
+                self.meta["description"] = _clean(a.get("content", ""))
+            elif prop == "og:description" and not self.meta["og_description"]:
+                self.meta["og_description"] = _clean(a.get("content", ""))
+        elif tag == "link":
+            a = {k.lower(): (v or "") for k, v in attrs}
+            if "canonical" in a.get("rel", "").lower().split() and not self.meta["canonical"]:
+                self.meta["canonical"] = a.get("href", "").strip()
+        elif tag == "title" and not self.meta["title"] and not self._in_body:
+            self._capture, self._buf = "title", []
+        elif tag in ("h1", "p"):
+            self._enter_body()
+            if not self.done and not self.meta[tag] and self._capture is None:
+                self._capture, self._buf = tag, []
+        elif tag in _BODY_TAGS:
+            self._enter_body()   # </head> や <body> を省略したページ
+
+    def handle_endtag(self, tag):
+        if self.done:
+            return
+        if tag == self._capture:
+            self.meta[tag] = _clean("".join(self._buf))
+            self._capture, self._buf = None, []
+            if tag == "p" and self.meta["p"]:
+                self.done = True    # 最初の段落まで読めばフォールバックに必要な分は揃う
+        elif tag == "head":
+            self._enter_body()
+
+    def handle_data(self, data):
+        if self._capture is not None and not self.done:
+            self._buf.append(data)
+
+
+def _sniff_encoding(head: bytes) -> str | None:
+    if head.startswith(codecs.BOM_UTF8):
+        return "utf-8-sig"
+    m = _META_CHARSET.search(head[:_SNIFF_BYTES])
+    return m.group(1).decode("ascii", "ignore") if m else None
+
+
+def _decoder(encoding: str | None):
+    try:
+        return codecs.getincrementaldecoder(encoding or "utf-8")(errors="replace")
+    except LookupError:
+        return codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+
+def extract_meta(chunks, *, encoding: str | None = None, max_bytes: int = MAX_BYTES) -> dict:
+    """
+    HTML のバイト列（チャンクの iterable）から
+    {"title","description","og_description","canonical","h1","p"} を 1 パスで取り出す（無い項目は空文字）。
+    encoding が None なら <meta charset> を見て決める（無ければ UTF-8）。
+    """
+    parser = _MetaParser()
+    decoder = None
+    pending = b""   # 文字コードを決めるまで（先頭 _SNIFF_BYTES）は溜めておく
+    read = 0
+    for chunk in chunks:
+        if not chunk:
+            continue
+        chunk = chunk[:max(0, max_bytes - read)]
+        read += len(chunk)
+        if decoder is None:
+            pending += chunk
+            if len(pending) < _SNIFF_BYTES and read < max_bytes:
+                continue
+            decoder = _decoder(encoding or _sniff_encoding(pending))
+            chunk, pending = pending, b""
+        parser.feed(decoder.decode(chunk))
+        if parser.done or read >= max_bytes:
+            break
+    if decoder is None and pending:
+        decoder = _decoder(encoding or _sniff_encoding(pending))
+        parser.feed(decoder.decode(pending))
+    if decoder is not None and not parser.done:
+        parser.feed(decoder.decode(b"", final=True))
+    # 閉じタグの前で打ち切った title / h1 / p は、そこまでの内容を使う
+    if parser._capture and not parser.meta[parser._capture]:
+        parser.meta[parser._capture] = _clean("".join(parser._buf))
+    return parser.meta
+
+
+def _charset_from_headers(headers) -> str | None:
+    content_type = (headers or {}).get("Content-Type", "")
+    for part in content_type.split(";")[1:]:
+        key, _, value = part.strip().partition("=")
+        if key.lower() == "charset" and value:
+            return value.strip("\"' ")
+    return None
+
+
+def extract_meta_from_response(response, *, max_bytes: int = MAX_BYTES) -> dict:
+    """stream=True で受けた requests の Response から読み、必要な分だけ読んだら接続を返す"""
+    chunks = response.iter_content(CHUNK_SIZE)
+    try:
+        meta = extract_meta(chunks, encoding=_charset_from_headers(response.headers), max_bytes=max_bytes)
+        # 残りが少なければ読み切って接続をプールに戻す（keep-alive）。多ければ切ってしまう方が安い
+        drained = 0
+        for chunk in chunks:
+            drained += len(chunk)
+            if drained > DRAIN_BYTES:
+                break
+        return meta
+    finally:
+        response.close()
@@ -0,0 +1,82 @@
+import os
+import threading
+from http.cookiejar import DefaultCookiePolicy
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# --- 外向き HTTP の共通セッション ---------------------------------------------------
+# requests.get を毎回呼ぶと、同じサイトへの 2 回目でも TCP+TLS の接続からやり直しになる。
+# プロセスで 1 つの Session（接続プール・keep-alive）を使い回し、
+# User-Agent・タイムアウト・リトライの方針もここにまとめる。
+# - Session の送信はスレッド間で共有してよいが、Cookie の保存は共有すると混ざるので受け付けない
+# - fork 後（一括実行のワーカーなど）は接続を共有しないよう、プロセスごとに作り直す
+
+USER_AGENT = os.getenv("HTTP_USER_AGENT", "Mozilla/5.0")
+# (接続, 読み込み) の秒数
+DEFAULT_TIMEOUT = (
+    float(os.getenv("HTTP_CONNECT_TIMEOUT", "3.05")),
+    float(os.getenv("HTTP_READ_TIMEOUT", "5")),
+)
+# ホスト（プール）をいくつ保持するか / 1 ホストあたりの接続数
+POOL_CONNECTIONS = int(os.getenv("HTTP_POOL_CONNECTIONS", "32"))
+POOL_MAXSIZE = int(os.getenv("HTTP_POOL_MAXSIZE", "16"))
+# 接続エラー・429・5xx の再試行回数（GET/HEAD のみ。Retry-After に従うが MAX_RETRY_AFTER 秒まで）
+RETRIES = int(os.getenv("HTTP_RETRIES", "2"))
+MAX_RETRY_AFTER = float(os.getenv("HTTP_MAX_RETRY_AFTER", "5"))
+
+_session = None
+_session_pid = None
+_lock = threading.Lock()
+
+
+class _CappedRetry(Retry):
+    """
+    Retry-After を MAX_RETRY_AFTER 秒で打ち切る Retry。
+    urllib3 は Retry-After の値をそのまま sleep するので、他人のサイトが「503 Retry-After: 86400」を
+    返すとスレッドが丸 1 日止まってしまう。
+    """
+
+    def get_retry_after(self, response):
+        retry_after = super().get_retry_after(response)
+        return None if retry_after is None else min(retry_after, MAX_RETRY_AFTER)
+
+
+def _build_session() -> requests.Session:
+    s = requests.Session()
+    s.headers["User-Agent"] = USER_AGENT
+    # 複数スレッドの応答の Cookie が混ざらないよう、Cookie は保存しない
+    s.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+    retry = _CappedRetry(
+        total=RETRIES,
+        connect=RETRIES,
+        read=0,                      # 読み込み途中の失敗は締切に響くので再試行しない
+        status=RETRIES,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=frozenset(("GET", "HEAD")),
+        backoff_factor=0.3,
+        respect_retry_after_header=True,
+        raise_on_status=False,       # 最後の応答をそのまま返す（呼び出し側で raise_for_status）
+    )
+    adapter = HTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE, max_retries=retry)
+    s.mount("https://", adapter)
+    s.mount("http://", adapter)
+    return s
+
+
+def get_session() -> requests.Session:
+    """プロセスで共通の Session"""
+    global _session, _session_pid
+    pid = os.getpid()
+    if _session is None or _session_pid != pid:
+        with _lock:
+            if _session is None or _session_pid != pid:
+                _session = _build_session()
+                _session_pid = pid
+    return _session
+
+
+def get(url: str, *, timeout=None, headers: dict | None = None, **kwargs) -> requests.Response:
+    """共通セッションで GET する（タイムアウト未指定なら DEFAULT_TIMEOUT）"""
+    return get_session().get(url, timeout=timeout or DEFAULT_TIMEOUT, headers=headers, **kwargs)
@@ -0,0 +1,322 @@
+import atexit
+import os
+import secrets
+import string
+import threading
+import time
+from datetime import datetime
+
+from cache_utils import get_shared_store
+from metrics import inc, register_gauges
+from rate_limit import backoff_delay, is_retryable
+from result_store import delete_result_blobs, pack_result, save_result_blobs
+
+# --- improvements の書き込みを後回しにする（write-behind） ---------------------------
+# 解析結果の保存（pack・blob・set）を待ってから画面を返すと、Firestore の往復が
+# そのまま応答時間に乗る。ドキュメント ID を先に払い出してキューに積み、
+# バックグラウンドのスレッドが WriteBatch でまとめて書く（失敗はバックオフして再試行）。
+# - 書き込み前のものは pending として持ち、履歴・詳細画面はそこからも表示する
+# - 同じドキュメントへの操作はキューの順に書く（set の後の update も安全）
+# - まだ書いていないドキュメントの削除はキューから取り除くだけ
+#
+# gunicorn の別ワーカーに届いた詳細・削除のリクエストのために、書き込み前の内容は
+# ワーカー間で共有する SQLite（cache_utils の共有ストア）にも置く。
+# - 詳細画面・行 API は共有ストアの内容で表示できる
+# - 削除は共有ストアに墓標を残し、書き込む側は commit の直前に墓標のあるものを捨て、
+#   commit の直後にもう一度確認して、間に合わなかったものは消す（削除したものが復活しない）
+# - 履歴一覧に書き込み前の分を足すのは、保存したワーカーだけ（他のワーカーでは書き込み後に出る。
+#   ふつうは FLUSH_INTERVAL＋commit 1 回分の遅れ）
+# - 別ワーカーの書き込み前のドキュメントへの update は、set が届くまで NotFound を再試行する
+#
+# 設定: PERSIST_BATCH_SIZE, PERSIST_FLUSH_INTERVAL（秒）, PERSIST_RETRIES
+
+COLLECTION = "improvements"
+BATCH_SIZE = int(os.getenv("PERSIST_BATCH_SIZE", "20"))           # WriteBatch の上限は 500 操作
+FLUSH_INTERVAL = float(os.getenv("PERSIST_FLUSH_INTERVAL", "0.2"))  # 最初の操作からまとめて待つ秒数
+RETRIES = int(os.getenv("PERSIST_RETRIES", "5"))
+
+_ID_CHARS = string.ascii_letters + string.digits
+
+_PENDING_NAMESPACE = "improvement_pending"
+_DELETED_NAMESPACE = "improvement_deleted"
+_SHARED_TTL = 3600
+
+
+def new_doc_id() -> str:
+    """Firestore の自動 ID と同じ形式（英数字 20 文字）の ID をローカルで作る"""
+    return "".join(secrets.choice(_ID_CHARS) for _ in range(20))
+
+
+def _history_item(doc_id: str, rec: dict) -> dict:
+    """main._history_item と同じ形の履歴 1 行"""
+    return {
+        "id":               doc_id,
+        "timestamp":        rec["timestamp"].strftime("%Y-%m-%d %H:%M:%S"),
+        "input_url":        rec["input_url"],
+        "chatgpt_response": rec["result"].get("chatgpt_response", ""),
+    }
+
+
+class ImprovementWriter:
+    """
+    improvements への set / update をキューに積み、バックグラウンドで WriteBatch にまとめて書く。
+    db_factory: Firestore クライアントを返す関数（初回の書き込み時に呼ぶ）
+    """
+
+    def __init__(self, db_factory, *, batch_size: int = BATCH_SIZE, flush_interval: float = FLUSH_INTERVAL,
+                 retries: int = RETRIES, shared_store=None):
+        self._db_factory = db_factory
+        self._shared = shared_store
+        self.batch_size = max(1, min(batch_size, 500))
+        self.flush_interval = flush_interval
+        self.retries = retries
+        self._queue = []           # [(op, doc_id, data)]  op = "set" | "update"
+        self._pending = {}         # doc_id -> {"uid","input_url","result","timestamp"}（まだ書いていないもの）
+        self._inflight = set()     # 書き込み中の doc_id
+        self._written = set()      # set は書き終わったが、後続の update が残っている doc_id
+        self._cond = threading.Condition()
+        self._thread = None
+
+    # --- 呼び出し側 ---
+
+    def save(self, uid: str, input_url: str, result: dict) -> str:
+        """解析結果の保存をキューに積み、ドキュメント ID をすぐ返す"""
+        doc_id = new_doc_id()
+        rec = {
+            "uid":       uid,
+            "input_url": input_url,
+            "result":    dict(result),     # 呼び出し側の dict を後から書き換えられても影響しない
+            "timestamp": datetime.utcnow(),
+        }
+        # 共有ストアへはキューに積む前に書く（先に commit されると、消した後に古い内容が残る）
+        self._store().set(_PENDING_NAMESPACE, doc_id, dict(rec, timestamp=rec["timestamp"].isoformat()),
+                          ttl=_SHARED_TTL)
+        self._enqueue("set", doc_id, rec, pending=rec)
+        return doc_id
+
+    def update(self, doc_id: str, fields: dict):
+        """"result.chatgpt_response" のようなドット区切りのフィールドを更新する"""
+        self._enqueue("update", doc_id, fields)
+
+    def cancel(self, doc_id: str, uid: str | None = None) -> bool:
+        """
+        このワーカーがまだ書いていないドキュメント（uid を渡したときは本人のもの）なら
+        キューから取り除いて True。それ以外は False（呼び出し側で Firestore から削除する）。
+        - 書き込み中なら終わるまで待つ
+        - 別のワーカーのキューにあるかもしれないので、墓標を残して書き込み・復活を防ぐ
+        """
+        with self._cond:
+            rec = self._pending.get(doc_id)
+            if rec and uid is not None and rec["uid"] != uid:
+                return False    # 他人のものには触らない
+            if rec and doc_id not in self._inflight and doc_id not in self._written:
+                self._queue = [op for op in self._queue if op[1] != doc_id]
+                del self._pending[doc_id]
+                self._store().delete(_PENDING_NAMESPACE, doc_id)
+                return True
+            while doc_id in self._inflight:
+                self._cond.wait()
+            # 書き込み後に積まれた update は、これから削除するドキュメントには当てられないので捨てる
+            self._queue = [op for op in self._queue if op[1] != doc_id]
+            self._pending.pop(doc_id, None)
+            self._written.discard(doc_id)
+
+        # 別のワーカーがまだ書いていない（または書き込み中の）本人のものだけ墓標を残す
+        shared = self._store().get(_PENDING_NAMESPACE, doc_id)
+        if shared is not None and (uid is None or shared["uid"] == uid):
+            self._store().set(_DELETED_NAMESPACE, doc_id, True, ttl=_SHARED_TTL)
+            self._store().delete(_PENDING_NAMESPACE, doc_id)
+        return False
+
+    def get_pending(self, doc_id: str) -> dict | None:
+        """
+        まだ書いていない保存内容（{"uid","input_url","result","timestamp"}）。
+        このワーカーに無ければ、別のワーカーが共有ストアに置いたものを返す
+        """
+        with self._cond:
+            rec = self._pending.get(doc_id)
+            if rec:
+                return dict(rec)
+        shared = self._store().get(_PENDING_NAMESPACE, doc_id)
+        if shared is None or self._is_deleted(doc_id):
+            return None
+        return dict(shared, timestamp=datetime.fromisoformat(shared["timestamp"]))
+
+    def pending_history(self, uid: str) -> list[dict]:
+        """ユーザーのまだ書いていない履歴（新しい順。履歴一覧と同じ形）"""
+        with self._cond:
+            recs = [(doc_id, rec) for doc_id, rec in self._pending.items() if rec["uid"] == uid]
+            items = [_history_item(doc_id, rec) for doc_id, rec in recs]
+        return sorted(items, key=lambda item: item["timestamp"], reverse=True)
+
+    def flush(self, timeout: float | None = None) -> bool:
+        """キューが空になるまで待つ（終了時・確認用）。書き切れたら True"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            self._cond.notify_all()
+            while self._queue or self._inflight:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def depth(self) -> int:
+        with self._cond:
+            return len(self._queue) + len(self._inflight)
+
+    # --- バックグラウンド ---
+
+    def _store(self):
+        return self._shared or get_shared_store()
+
+    def _is_deleted(self, doc_id: str) -> bool:
+        return bool(self._store().get(_DELETED_NAMESPACE, doc_id))
+
+    def _enqueue(self, op: str, doc_id: str, data: dict, pending: dict | None = None):
+        with self._cond:
+            self._queue.append((op, doc_id, data))
+            if pending is not None:
+                self._pending[doc_id] = pending
+            elif op == "update" and doc_id in self._pending:
+                # 書き込み前の表示にも反映する（"result.chatgpt_response" → rec["result"]["chatgpt_response"]）
+                rec = self._pending[doc_id]
+                for path, value in data.items():
+                    *parents, leaf = path.split(".")
+                    target = rec
+                    for p in parents:
+                        target = target.setdefault(p, {})
+                    target[leaf] = value
+                if doc_id not in self._written:
+                    # 他のワーカー向けの写しも更新する。set の commit 後の削除と前後しないようロック内で書く
+                    self._store().set(_PENDING_NAMESPACE, doc_id, dict(rec, timestamp=rec["timestamp"].isoformat()),
+                                      ttl=_SHARED_TTL)
+            self._ensure_thread()
+            self._cond.notify_all()
+
+    def _ensure_thread(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._loop, name="improvement-writer", daemon=True)
+            self._thread.start()
+
+    def _take_batch(self) -> list:
+        with self._cond:
+            while not self._queue:
+                self._cond.wait()
+            # 最初の操作から flush_interval だけ待って、その間に来たものもまとめる
+            deadline = time.monotonic() + self.flush_interval
+            while len(self._queue) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            batch, self._queue = self._queue[:self.batch_size], self._queue[self.batch_size:]
+            self._inflight.update(doc_id for _, doc_id, _ in batch)
+            return batch
+
+    def _loop(self):
+        while True:
+            batch = self._take_batch()
+            try:
+                self._write(batch)
+            except Exception as e:   # ここで止まるとキューが溜まり続けるので、記録して次へ
+                print(f"❌ 履歴の保存に失敗: {e}")
+                inc("mrseo_persist_ops_total", len(batch), status="failed")
+            finally:
+                with self._cond:
+                    for _, doc_id, _ in batch:
+                        self._inflight.discard(doc_id)
+                        if not any(op[1] == doc_id for op in self._queue):
+                            self._pending.pop(doc_id, None)
+                            self._written.discard(doc_id)
+                    self._cond.notify_all()
+
+    def _write(self, batch: list):
+        db = self._db_factory()
+        try:
+            self._commit(db, batch)
+            inc("mrseo_persist_ops_total", len(batch), status="ok")
+            return
+        except Exception as e:
+            if len(batch) == 1:
+                raise
+            print(f"⚠️ 履歴のまとめ書きに失敗したので 1 件ずつ書き直します: {e}")
+        # 1 件の不正な操作（削除済みドキュメントへの update など）で全体を失わないよう、個別に書く
+        for op in batch:
+            try:
+                self._commit(db, [op])
+                inc("mrseo_persist_ops_total", status="ok")
+            except Exception as e:
+                print(f"❌ 履歴の保存に失敗: {op[0]} {op[1]} -> {e}")
+                inc("mrseo_persist_ops_total", status="failed")
+
+    def _commit(self, db, batch: list):
+        """blob → WriteBatch の順に書く。再試行できるエラーはバックオフして繰り返す"""
+        # 削除済み（墓標あり）のものは書かない
+        batch = [op for op in batch if not self._is_deleted(op[1])]
+        if not batch:
+            return
+        col = db.collection(COLLECTION)
+        writes = []
+        for op, doc_id, data in batch:
+            ref = col.document(doc_id)
+            if op == "set":
+                packed, blobs = pack_result(data["result"])
+                if blobs:
+                    # 大きな表は本体より先にサイドドキュメントへ（本体だけ見えて表が無い状態を避ける）
+                    save_result_blobs(ref, blobs)
+                writes.append((op, ref, {
+                    "uid":       data["uid"],
+                    "input_url": data["input_url"],
+                    "result":    packed,
+                    "timestamp": data["timestamp"],
+                }))
+            else:
+                writes.append((op, ref, data))
+
+        for attempt in range(self.retries + 1):
+            wb = db.batch()
+            for op, ref, data in writes:
+                getattr(wb, op)(ref, data)
+            try:
+                wb.commit()
+                break
+            except Exception as e:
+                # 別ワーカーの set がまだ届いていないドキュメントへの update は NotFound になるので待つ
+                not_yet = type(e).__name__ == "NotFound" and any(op == "update" for op, _, _ in writes)
+                if attempt >= self.retries or not (is_retryable(e) or not_yet):
+                    raise
+                delay = backoff_delay(attempt)
+                inc("mrseo_persist_retries_total")
+                print(f"⏳ 履歴の保存を再試行 {attempt + 1}/{self.retries}（{delay:.1f} 秒後）: {type(e).__name__}")
+                time.sleep(delay)
+
+        written = [doc_id for op, doc_id, _ in batch if op == "set"]
+        with self._cond:
+            self._written.update(written)
+        for doc_id in written:
+            self._store().delete(_PENDING_NAMESPACE, doc_id)
+            if self._is_deleted(doc_id):
+                # commit 中に削除された（墓標の確認と commit の間に割り込まれた）ので消し直す
+                ref = col.document(doc_id)
+                delete_result_blobs(ref)
+                ref.delete()
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_improvement_writer() -> ImprovementWriter:
+    """プロセス共通の writer（終了時にキューを書き切る）"""
+    global _writer
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                from firebase_app import get_db
+                _writer = ImprovementWriter(get_db)
+                atexit.register(_writer.flush, 10)
+    return _writer
+
+
+register_gauges(lambda: [("mrseo_persist_queue_depth", {}, _writer.depth() if _writer else 0)])
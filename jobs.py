@@ -0,0 +1,242 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+# --- 解析ジョブのキュー -----------------------------------------------------------
+# 重い解析（GSC/GA/SerpAPI/スクレイピング/OpenAI/Sheets）を Web スレッドから切り離し、
+# 上限つきのワーカープールで実行する。状態はストア（メモリ or SQLite）に置き、
+# 画面側はジョブ ID でポーリングして結果を受け取る。
+
+STATUS_QUEUED = "queued"
+STATUS_RUNNING = "running"
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+_ACTIVE = (STATUS_QUEUED, STATUS_RUNNING)
+
+# これより長く queued/running のままのジョブは、ワーカーの再起動などで取り残されたものとみなして失敗にする
+STALE_AFTER = float(os.getenv("JOB_STALE_AFTER", "1800"))
+_STALE_ERROR = "ジョブが完了しないまま時間切れになりました"
+
+
+class JobLimitExceeded(Exception):
+    """ユーザーごと、またはキュー全体の上限を超えたとき"""
+
+
+def _check_limits(user_active: int, total_active: int, per_user_limit, max_pending):
+    if per_user_limit is not None and user_active >= per_user_limit:
+        raise JobLimitExceeded("実行中の解析が多すぎます。完了してから再度お試しください。")
+    if max_pending is not None and total_active >= max_pending:
+        raise JobLimitExceeded("現在混み合っています。しばらくしてから再度お試しください。")
+
+
+class InMemoryJobStore:
+    """プロセス内の dict に保存する（テスト・単一ワーカー向け）。終わったジョブは retention 秒で消す"""
+
+    def __init__(self, retention: float = 3600, stale_after: float = STALE_AFTER):
+        self.retention = retention
+        self.stale_after = stale_after
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def create(self, job: dict, *, per_user_limit: int | None = None, max_pending: int | None = None):
+        """上限を確認してから追加する（確認と追加はロックの中でまとめて行う）"""
+        with self._lock:
+            self._prune()
+            _check_limits(
+                sum(1 for j in self._jobs.values() if j["status"] in _ACTIVE and j["owner"] == job["owner"]),
+                sum(1 for j in self._jobs.values() if j["status"] in _ACTIVE),
+                per_user_limit, max_pending,
+            )
+            self._jobs[job["id"]] = dict(job)
+
+    def update(self, job_id: str, **fields):
+        with self._lock:
+            if job_id in self._jobs:
+                self._jobs[job_id].update(fields)
+
+    def get(self, job_id: str) -> dict | None:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job else None
+
+    def count_active(self, owner: str | None = None) -> int:
+        with self._lock:
+            return sum(
+                1 for j in self._jobs.values()
+                if j["status"] in _ACTIVE and (owner is None or j["owner"] == owner)
+            )
+
+    def _prune(self):
+        now = time.time()
+        for j in self._jobs.values():
+            if j["status"] in _ACTIVE and (j.get("started_at") or j["created_at"]) < now - self.stale_after:
+                j.update(status=STATUS_FAILED, error=_STALE_ERROR, finished_at=now)
+        cutoff = now - self.retention
+        for job_id in [k for k, j in self._jobs.items()
+                       if j["status"] not in _ACTIVE and (j.get("finished_at") or 0) < cutoff]:
+            del self._jobs[job_id]
+
+
+class SqliteJobStore:
+    """SQLite に保存する（gunicorn の複数ワーカー間で状態を共有できる）"""
+
+    _FIELDS = ("owner", "status", "payload", "result", "error", "created_at", "started_at", "finished_at")
+
+    def __init__(self, path: str, retention: float = 24 * 3600, stale_after: float = STALE_AFTER):
+        self.path = path
+        self.retention = retention
+        self.stale_after = stale_after
+        self._local = threading.local()
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                " id TEXT PRIMARY KEY, owner TEXT, status TEXT, payload TEXT, result TEXT,"
+                " error TEXT, created_at REAL, started_at REAL, finished_at REAL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_owner_status ON jobs (owner, status)")
+            self._local.conn = conn
+        return conn
+
+    def create(self, job: dict, *, per_user_limit: int | None = None, max_pending: int | None = None):
+        """
+        上限を確認してから追加する。確認と追加は 1 つの書き込みトランザクション（BEGIN IMMEDIATE）で行い、
+        別のワーカープロセスと同時に投入しても上限を超えないようにする
+        """
+        conn = self._conn()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                "DELETE FROM jobs WHERE status NOT IN (?, ?) AND finished_at < ?",
+                (*_ACTIVE, now - self.retention),
+            )
+            # 取り残されたジョブ（実行中にワーカーが落ちたなど）は失敗にして、上限の数から外す
+            conn.execute(
+                "UPDATE jobs SET status = ?, error = ?, finished_at = ?"
+                " WHERE status IN (?, ?) AND COALESCE(started_at, created_at) < ?",
+                (STATUS_FAILED, _STALE_ERROR, now, *_ACTIVE, now - self.stale_after),
+            )
+            _check_limits(
+                self.count_active(job["owner"]), self.count_active(), per_user_limit, max_pending,
+            )
+            conn.execute(
+                "INSERT INTO jobs (id, owner, status, payload, result, error, created_at, started_at, finished_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (job["id"], *(self._encode(k, job.get(k)) for k in self._FIELDS)),
+            )
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def update(self, job_id: str, **fields):
+        if not fields:
+            return
+        cols = ", ".join(f"{k} = ?" for k in fields)
+        self._conn().execute(
+            f"UPDATE jobs SET {cols} WHERE id = ?",
+            (*(self._encode(k, v) for k, v in fields.items()), job_id),
+        )
+
+    def get(self, job_id: str) -> dict | None:
+        row = self._conn().execute(
+            f"SELECT id, {', '.join(self._FIELDS)} FROM jobs WHERE id = ?", (job_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        job = {"id": row[0]}
+        for k, v in zip(self._FIELDS, row[1:]):
+            job[k] = json.loads(v) if k in ("payload", "result") and v is not None else v
+        return job
+
+    def count_active(self, owner: str | None = None) -> int:
+        if owner is None:
+            sql, args = "SELECT COUNT(*) FROM jobs WHERE status IN (?, ?)", _ACTIVE
+        else:
+            sql, args = "SELECT COUNT(*) FROM jobs WHERE status IN (?, ?) AND owner = ?", (*_ACTIVE, owner)
+        return self._conn().execute(sql, args).fetchone()[0]
+
+    @staticmethod
+    def _encode(key, value):
+        if key in ("payload", "result") and value is not None:
+            return json.dumps(value, ensure_ascii=False, default=str)
+        return value
+
+
+class JobQueue:
+    """
+    上限つきワーカープールでジョブを実行する。
+    - max_workers:    同時に実行する解析数
+    - max_pending:    実行待ち＋実行中の上限（超えたら JobLimitExceeded）
+    - per_user_limit: 1ユーザーが同時に持てる実行待ち＋実行中の数
+    """
+
+    def __init__(self, store, *, max_workers: int = 4, max_pending: int = 64, per_user_limit: int = 2):
+        self.store = store
+        self.max_pending = max_pending
+        self.per_user_limit = per_user_limit
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="analysis-job")
+
+    def submit(self, owner: str, fn, payload: dict) -> str:
+        """fn(payload) をバックグラウンドで実行し、ジョブ ID を返す"""
+        job_id = uuid.uuid4().hex
+        self.store.create({
+            "id": job_id,
+            "owner": owner,
+            "status": STATUS_QUEUED,
+            "payload": payload,
+            "created_at": time.time(),
+        }, per_user_limit=self.per_user_limit, max_pending=self.max_pending)
+        self._pool.submit(self._run, job_id, fn, payload)
+        return job_id
+
+    def get(self, job_id: str) -> dict | None:
+        return self.store.get(job_id)
+
+    def _run(self, job_id: str, fn, payload: dict):
+        self.store.update(job_id, status=STATUS_RUNNING, started_at=time.time())
+        try:
+            result = fn(payload)
+        except Exception as e:
+            traceback.print_exc()
+            self.store.update(job_id, status=STATUS_FAILED, error=str(e), finished_at=time.time())
+            return
+        self.store.update(job_id, status=STATUS_DONE, result=result, finished_at=time.time())
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_job_queue() -> JobQueue:
+    """
+    環境変数から設定したプロセス共通のキューを返す。
+    JOB_BACKEND=sqlite|memory（既定 sqlite）, JOB_DB, JOB_WORKERS, JOB_MAX_PENDING, JOB_PER_USER_LIMIT,
+    JOB_STALE_AFTER。gunicorn の複数ワーカーでは、状態のポーリングが投入したのと別のワーカーに届くので
+    sqlite（ワーカー間で共有）を使う。memory は単一ワーカー・テスト用
+    """
+    global _queue
+    if _queue is None:
+        with _queue_lock:
+            if _queue is None:
+                if os.getenv("JOB_BACKEND", "sqlite") == "memory":
+                    store = InMemoryJobStore()
+                else:
+                    store = SqliteJobStore(os.getenv("JOB_DB", "/tmp/mrseo_jobs.sqlite3"))
+                _queue = JobQueue(
+                    store,
+                    max_workers=int(os.getenv("JOB_WORKERS", "4")),
+                    max_pending=int(os.getenv("JOB_MAX_PENDING", "64")),
+                    per_user_limit=int(os.getenv("JOB_PER_USER_LIMIT", "2")),
+                )
+    return _queue
@@ -1,22 +1,35 @@
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date, timedelta
 from urllib.parse import urlparse
 import pandas as pd
 
-from serp_api_utils import get_top_competitor_urls, get_meta_info_from_url
-from chatgpt_utils import build_prompt, get_chatgpt_response
+from serp_api_utils import get_top_competitor_urls, fetch_meta_infos
+from chatgpt_utils import build_prompt, get_chatgpt_response, get_cached_chatgpt_response
 
-from ga_utils import fetch_ga_conversion_for_url
-from gsc_utils import fetch_gsc_data
-from sheet_utils import (
-    get_spreadsheet, get_or_create_worksheet,
-    update_sheet, write_competitor_data_to_sheet
-)
+from cache_utils import LRUCache, SingleFlight
+from ga_utils import can_access_property, fetch_ga_conversions_for_paths
+from gsc_utils import ACCESS_CHECK_TTL, can_access_site, fetch_gsc_data
+from gsc_snapshot import fetch_gsc_window
+from metrics import inc, span, timed
+from service_slots import slot
+from result_store import frame_to_columns, chart_from_columns
+from sheet_utils import export_sheet_tabs, competitor_rows, COMPETITOR_HEADERS
 
-# Firestore は firebase_admin で統一（google.cloud と混在させない）
-from firebase_admin import firestore as fa_firestore
-db = fa_firestore.client()
+# Firestore は firebase_admin で統一（google.cloud と混在させない）。一括実行では使わない
+from firebase_app import get_db as _db
 
 
+# GSC の日別スナップショットを使うか（GSC_SNAPSHOT=0 で毎回 28 日分を直接取得）
+GSC_SNAPSHOT_ENABLED = os.getenv("GSC_SNAPSHOT", "1") != "0"
+
+# Sheets へは変わった行だけ書く（SHEETS_DIFF=0 で毎回全体を書き直す）
+SHEETS_DIFF_ENABLED = os.getenv("SHEETS_DIFF", "1") != "0"
+
+# 実行中の同じ解析に合流するか（ANALYSIS_COALESCE=0 で毎回それぞれ実行）
+ANALYSIS_COALESCE_ENABLED = os.getenv("ANALYSIS_COALESCE", "1") != "0"
+
 # ---------------------- ヘルパー ----------------------
 
 def _last_28_days():
@@ -34,8 +47,73 @@ def _path_only(u: str) -> str:
     p = urlparse(u if u.startswith(("http://", "https://")) else "https://" + u)
     return p.path or "/"
 
+def _top_queries(raw: pd.DataFrame, n: int, by: str = "表示回数") -> list[str]:
+    """GSC の [query, page] 行からクエリ単位で合計し、上位 n 件のキーワードを返す"""
+    if raw is None or raw.empty or "検索キーワード" not in raw.columns or n <= 0:
+        return []
+    by = by if by in ("表示回数", "クリック数") else "表示回数"
+    q = raw.assign(検索キーワード=raw["検索キーワード"].astype(str).str.strip())
+    q = q[q["検索キーワード"] != ""]
+    totals = q.groupby("検索キーワード", sort=False)[by].sum()
+    return totals.nlargest(n, keep="first").index.tolist()
+
+def _search_competitors(keywords: list[str]) -> list[list[dict]]:
+    """キーワードごとの SerpAPI 上位結果（入力順）。失敗したキーワードは空"""
+    def _one(kw):
+        try:
+            with slot("serpapi"), span("serpapi"):
+                return get_top_competitor_urls(kw) or []
+        except Exception as e:
+            print("SerpAPI呼び出し失敗:", kw, e)
+            return []
+
+    if len(keywords) == 1:
+        return [_one(keywords[0])]
+    with ThreadPoolExecutor(max_workers=min(len(keywords), 5)) as pool:
+        return list(pool.map(_one, keywords))
+
+def _competitor_key(u: str) -> str:
+    """重複判定用：スキーム・www・末尾スラッシュ・クエリ/フラグメントの違いを無視する"""
+    p = urlparse(u)
+    return (p.netloc.lower().removeprefix("www.") + (p.path.rstrip("/") or "/"))
+
+def _dedupe_competitors(keywords: list[str], serps: list[list[dict]], limit: int) -> list[dict]:
+    """
+    複数キーワードの SERP を 1 つの競合リストにまとめる。
+    順位の良い順（同順位ならキーワードの順）に並べ、同じ URL はまとめてキーワードを併記する。
+    """
+    merged = {}
+    order = []
+    for kw_idx, comps in enumerate(serps):
+        for c in comps:
+            u = c.get("url") if isinstance(c, dict) else c
+            if not u:
+                continue
+            key = _competitor_key(u)
+            pos = c.get("position", 0) if isinstance(c, dict) else 0
+            if key not in merged:
+                merged[key] = {
+                    "url": u,
+                    "title": c.get("title", "") if isinstance(c, dict) else "",
+                    "position": pos,
+                    "keywords": [],
+                    "_rank": (pos, kw_idx),
+                }
+                order.append(key)
+            entry = merged[key]
+            if keywords[kw_idx] not in entry["keywords"]:
+                entry["keywords"].append(keywords[kw_idx])
+            if (pos, kw_idx) < entry["_rank"]:
+                entry["_rank"] = (pos, kw_idx)
+                entry["position"] = pos
+    out = sorted((merged[k] for k in order), key=lambda e: e["_rank"])[:limit]
+    for e in out:
+        e.pop("_rank")
+    return out
+
 # ---------------------- メイン（新シグネチャ） ----------------------
 
+@timed("analysis")
 def process_seo_improvement(
     *,
     url: str,                      # フォームで入力されたフルURL（表示用）
@@ -44,13 +122,18 @@ def process_seo_improvement(
     ga_property: str | int | None = None,   # "properties/123..." or 123 or None
     sheet_id: str | None = None,   # 出力先スプレッドシート（任意）
     skip_metrics: bool = False,    # True なら GA/GSC/Sheets を丸ごとスキップ
+    defer_suggestion: bool = False,# True なら ChatGPT を呼ばずプロンプトを返す（画面側でストリーミング）
+    competitor_keywords: int = 1,  # 競合を調べる GSC キーワードの数（上位 N 件）
+    keyword_rank_by: str = "表示回数",# 上位キーワードの基準（"表示回数" or "クリック数"）
 ) -> dict:
     print(f"🚀 SEO改善を開始: {url} (skip_metrics={skip_metrics})")
 
     # ---------------- 1) GSC / GA 指標の収集 ----------------
+    raw = pd.DataFrame()
     gsc_df = pd.DataFrame()
     merged_df = pd.DataFrame()
     chart_labels, chart_data = [], {}
+    table_columns = {}
     clicks = impressions = conversions = 0
     ctr = position = 0.0
 
@@ -60,13 +143,25 @@ def process_seo_improvement(
         # ---- GSC ----
         if sc_property:
             try:
-                raw = fetch_gsc_data(
-                    creds=creds,
-                    sc_property=sc_property,
-                    start_date=sd,
-                    end_date=ed,
-                    row_limit=25000,
-                )  # 列: ['検索キーワード','URL','クリック数','表示回数','CTR（%）','平均順位']
+                with slot("gsc"), span("gsc"):
+                    if GSC_SNAPSHOT_ENABLED:
+                        # 日別スナップショットから集計（足りない日・未確定の日だけ API で取得）
+                        raw = fetch_gsc_window(
+                            creds=creds,
+                            sc_property=sc_property,
+                            start_date=sd,
+                            end_date=ed,
+                        )
+                    else:
+                        raw = fetch_gsc_data(
+                            creds=creds,
+                            sc_property=sc_property,
+                            start_date=sd,
+                            end_date=ed,
+                            row_limit=25000,
+                            paginate=True,       # 25,000 行を超えるロングテールも取得
+                            date_shards=4,       # 28日を 7日×4 に分けて並列取得
+                        )  # 列: ['検索キーワード','URL','クリック数','表示回数','CTR（%）','平均順位']
                 # URL単位に集計（重複ページがあるため）
                 if not raw.empty:
                     gsc_df = (
@@ -82,41 +177,36 @@ def process_seo_improvement(
                 print("GSC取得スキップ:", e)
 
         # ---- GA（コンバージョン例）----
+        # URL ごとに RPC せず、パス一覧をまとめて 1〜数回のレポートで取得する
         ga_conv = pd.DataFrame(columns=["URL", "コンバージョン数"])
         if ga_property and not gsc_df.empty:
-            per_url = []
-            for u in gsc_df["URL"].unique():
-                try:
-                    ga_df = fetch_ga_conversion_for_url(
+            try:
+                with slot("ga"), span("ga"):
+                    ga_df = fetch_ga_conversions_for_paths(
                         creds=creds,
                         ga_property=ga_property,
                         start_date=sd,
                         end_date=ed,
-                        full_url=_path_only(u),
-                    )  # 列: ['URL','コンバージョン数']
-                    if not ga_df.empty:
-                        per_url.append(ga_df.iloc[0])
-                except Exception as e:
-                    print("GA取得スキップ(単ページ):", u, e)
-            if per_url:
-                ga_conv = pd.DataFrame(per_url)
-            else:
-                ga_conv = pd.DataFrame(columns=["URL", "コンバージョン数"])
+                        urls=[_path_only(u) for u in gsc_df["URL"].unique()],
+                    )  # 列: ['URL'(パス),'コンバージョン数']
+                if not ga_df.empty:
+                    # GA はパス、GSC はフルURLなので、パス経由で GSC の URL に戻す
+                    conv_by_path = dict(zip(ga_df["URL"], ga_df["コンバージョン数"]))
+                    ga_conv = pd.DataFrame({
+                        "URL": gsc_df["URL"],
+                        "コンバージョン数": [conv_by_path.get(_path_only(u)) for u in gsc_df["URL"]],
+                    }).dropna(subset=["コンバージョン数"])
+            except Exception as e:
+                print("GA取得スキップ:", e)
 
         # ---- マージ ----
         if not gsc_df.empty:
             merged_df = pd.merge(gsc_df, ga_conv, on="URL", how="left")
             merged_df["コンバージョン数"] = merged_df["コンバージョン数"].fillna(0).astype(int)
 
-            # チャート・集計
-            chart_labels = merged_df["URL"].tolist()
-            chart_data = {
-                "clicks":      merged_df["クリック数"].astype(int).tolist(),
-                "impressions": merged_df["表示回数"].astype(int).tolist(),
-                "ctr":         merged_df["CTR（%）"].astype(float).round(2).tolist(),
-                "position":    merged_df["平均順位"].astype(float).round(2).tolist(),
-                "conversions": merged_df["コンバージョン数"].astype(int).tolist(),
-            }
+            # チャート・集計（表と同じ列データから作る）
+            table_columns = frame_to_columns(merged_df)
+            chart_labels, chart_data = chart_from_columns(table_columns)
 
             clicks       = int(merged_df["クリック数"].sum())
             impressions  = int(merged_df["表示回数"].sum())
@@ -125,120 +215,243 @@ def process_seo_improvement(
             position     = float(merged_df["平均順位"].mean())
 
     # ---------------- 2) 競合取得 & ChatGPT 提案 ----------------
-    # GSCキーワード（あれば）から代表をピックアップ
+    # GSCキーワード（あれば）から、表示回数（またはクリック数）の多い上位 N 件を選ぶ
     gsc_keywords = []
     try:
-        if not skip_metrics and "検索キーワード" in locals().get("raw", pd.DataFrame()).columns:
-            gsc_keywords = [
-                str(k).strip() for k in raw["検索キーワード"].dropna().tolist()
-                if str(k).strip()
-            ]
-    except Exception:
-        pass
+        if not skip_metrics:
+            gsc_keywords = _top_queries(raw, competitor_keywords, keyword_rank_by)
+    except Exception as e:
+        print("キーワード選定スキップ:", e)
 
     competitors_info = []
     competitor_data  = []
     response         = ""  # 生成失敗時は空のまま
+    prompt           = ""  # defer_suggestion 時に呼び出し側へ渡す
 
     if gsc_keywords:
-        try:
-            top_urls = get_top_competitor_urls(gsc_keywords[0]) or []
-        except Exception as e:
-            print("SerpAPI呼び出し失敗:", e)
-            top_urls = []
+        # キーワードごとの SerpAPI は並列に投げ、同じ URL は 1 回だけ取得する
+        serps = _search_competitors(gsc_keywords)
+        comps = _dedupe_competitors(gsc_keywords, serps, limit=5 * len(gsc_keywords))
+        comp_urls = [c["url"] for c in comps]
 
-        for idx, u in enumerate(top_urls, start=1):
-            try:
-                info = get_meta_info_from_url(u)
-            except Exception:
-                info = {}
+        # 競合ページは並列取得（締切つき・SERP順で返る）
+        with slot("scrape"), span("scrape"):
+            infos = fetch_meta_infos(comp_urls, max_workers=10)
+
+        for comp, info in zip(comps, infos):
+            info = info or {}
+            u = comp["url"]
             competitors_info.append(info)
             competitor_data.append({
                 "URL": u,
-                "タイトル": info.get("title", ""),
+                "タイトル": info.get("title", "") or comp.get("title", ""),
                 "メタディスクリプション": info.get("description", ""),
-                "position": idx,
-                "title": info.get("title", ""),
+                "position": comp["position"],
+                "title": info.get("title", "") or comp.get("title", ""),
                 "url": u,
+                "keywords": comp["keywords"],
             })
 
         if competitors_info:
             try:
-                prompt = build_prompt(
-                    # 改善対象：順位が悪いURL。なければフォームURLのルート。
-                    (merged_df.sort_values("平均順位", ascending=False).iloc[0]["URL"]
-                     if not merged_df.empty else url.rstrip("/") + "/"),
-                    competitors_info,
-                    merged_df if not merged_df.empty else pd.DataFrame(),
-                )
-                response = get_chatgpt_response(prompt) or ""
+                with slot("scrape"), span("prompt"):   # 対象ページの紹介文を取得する
+                    prompt = build_prompt(
+                        # 改善対象：順位が悪いURL。なければフォームURLのルート。
+                        (merged_df.sort_values("平均順位", ascending=False).iloc[0]["URL"]
+                         if not merged_df.empty else url.rstrip("/") + "/"),
+                        competitors_info,
+                        merged_df if not merged_df.empty else pd.DataFrame(),
+                    )
+                if defer_suggestion:
+                    # キャッシュ済みならそのまま使い、無ければ生成は呼び出し側（SSE）に任せる
+                    response = get_cached_chatgpt_response(prompt) or ""
+                else:
+                    with slot("openai"), span("openai"):
+                        response = get_chatgpt_response(prompt) or ""
             except Exception as e:
                 print("ChatGPT生成失敗:", e)
 
     # ---------------- 3) Sheets 書き込み（任意） ----------------
     if (not skip_metrics) and creds and sheet_id:
         try:
-            spreadsheet = get_spreadsheet(creds, sheet_id)
-            ws = get_or_create_worksheet(spreadsheet, "SEOデータ")
-
-            if not merged_df.empty:
-                headers = ["URL", "クリック数", "表示回数", "CTR（%）", "平均順位", "コンバージョン数"]
-                rows = merged_df[headers].values.tolist()
-            else:
+            with slot("sheets"), span("sheets"):
                 headers = ["URL", "クリック数", "表示回数", "CTR（%）", "平均順位", "コンバージョン数"]
-                rows = []
+                rows = merged_df[headers].values.tolist() if not merged_df.empty else []
 
-            update_sheet(ws, headers, rows)
-            write_competitor_data_to_sheet(spreadsheet, competitor_data)
+                # 2 シートをメタデータ取得 1 回 + batchUpdate 1 回で書く
+                export_sheet_tabs(
+                    creds,
+                    sheet_id,
+                    {
+                        "SEOデータ": (headers, rows),
+                        "競合分析":  (COMPETITOR_HEADERS, competitor_rows(competitor_data)),
+                    },
+                    diff=SHEETS_DIFF_ENABLED,
+                )
             print("✅ Sheets 書き込み完了")
         except Exception as e:
             print("Sheets書き込みスキップ:", e)
 
-    # ---------------- 4) テーブルHTML ----------------
-    if not merged_df.empty:
-        table_html = merged_df.to_html(classes="table table-sm", index=False)
-    else:
-        table_html = "<p>直近28日で有効なGSC/GAデータがありませんでした。</p>"
-
-    # ---------------- 5) レスポンス ----------------
+    # ---------------- 4) レスポンス ----------------
+    # 表は HTML にしない（画面は /results/<id>/rows から必要なページだけ読む）
     return {
         "clicks":           clicks,
         "impressions":      impressions,
         "ctr":              ctr,
         "position":         position,
         "conversions":      conversions,
-        "table_html":       table_html,
+        "table_columns":    table_columns,   # 列ごとのリスト（保存・行 API はこれを使う）
         "chart_labels":     chart_labels,
         "chart_data":       chart_data,
         "competitors":      competitor_data,
         "chatgpt_response": response or "",
+        "chatgpt_prompt":   prompt if (defer_suggestion and not response) else "",
     }
 
 
-def get_history_for_user(uid: str):
-    """ユーザーの履歴（新しい順）"""
-    docs = (
-        db.collection("improvements")
-          .where("uid", "==", uid)
-          .order_by("timestamp", direction=fa_firestore.Query.DESCENDING)
-          .stream()
+# ---------------------- 同時の同一解析の合流 ----------------------
+# 複数のユーザーやタブが同じサイトを同時に解析すると、GSC/GA/SerpAPI/スクレイピング/OpenAI を
+# 人数分呼んでしまう。(期間, URL, プロパティ, オプション) が同じなら、実行中の解析（leader）の
+# 結果を待って使い回す。
+# - 他のユーザーの結果を受け取るのは、自分もそのプロパティ（GSC サイト・GA4 プロパティ）を
+#   読めることを確認できたときだけ。leader の権限も同じように確認する（権限が無くて空の結果に
+#   なった解析を、権限のあるユーザーに渡さない）。確認できなければ自分で実行する
+# - 権限の確認結果は ACCESS_CHECK_TTL 秒キャッシュする（GSC は gsc_utils.can_access_site が
+#   資格情報×サイトで持つので、ここでは GA4 のプロパティ分だけユーザー×プロパティで持つ）
+# - 合流はプロセス内のみ（gunicorn のワーカーをまたいでは合流しない）
+
+_analysis_flight = SingleFlight()
+_ga_access_cache = LRUCache(maxsize=4096, ttl=ACCESS_CHECK_TTL)
+
+def _analysis_key(kwargs: dict) -> str:
+    """結果が同じになる解析を同じキーにする（資格情報そのものは含めない）"""
+    uses_metrics = not kwargs.get("skip_metrics") and kwargs.get("creds") is not None
+    return json.dumps([
+        _last_28_days(),
+        kwargs.get("url"),
+        # 指標を使わないならプロパティ・シートは結果に影響しない
+        str(kwargs.get("sc_property") or "") if uses_metrics else "",
+        str(kwargs.get("ga_property") or "") if uses_metrics else "",
+        str(kwargs.get("sheet_id") or "") if uses_metrics else "",
+        uses_metrics,
+        bool(kwargs.get("defer_suggestion", False)),
+        kwargs.get("competitor_keywords", 1),
+        kwargs.get("keyword_rank_by", "表示回数"),
+    ], ensure_ascii=False)
+
+def _check_access(kind: str, prop: str, check) -> bool | None:
+    """確認できないとき（API エラー）は None"""
+    try:
+        return bool(check())
+    except Exception as e:
+        print(f"権限確認スキップ（{kind} {prop}）:", e)
+        return None
+
+def _has_ga_access(principal, creds, ga_property: str) -> bool:
+    key = (principal, ga_property)
+    allowed = _ga_access_cache.get(key) if principal else None
+    if allowed is None:
+        allowed = _check_access("ga", ga_property, lambda: can_access_property(creds, ga_property))
+        if allowed is None:
+            return False    # 確認できないときは共有しない（キャッシュもしない）
+        if principal:
+            _ga_access_cache.set(key, allowed)
+    return allowed
+
+def _can_read_properties(principal, kwargs: dict) -> bool:
+    """kwargs の資格情報で、解析に使うプロパティをすべて読めるか"""
+    creds = kwargs.get("creds")
+    if kwargs.get("skip_metrics") or creds is None:
+        return True     # 指標を使わない解析にはユーザー固有のデータが入らない
+    sc_property = kwargs.get("sc_property")
+    ga_property = kwargs.get("ga_property")
+    if sc_property and not _check_access("gsc", str(sc_property), lambda: can_access_site(creds, sc_property)):
+        return False
+    if ga_property and not _has_ga_access(principal, creds, str(ga_property)):
+        return False
+    return True
+
+def run_seo_improvement(*, principal: str | None = None, **kwargs) -> dict:
+    """
+    process_seo_improvement を、実行中の同じ解析があればそれに合流して実行する。
+    principal: 結果を共有してよいか判断するためのユーザーID（未ログインなら None）
+    返値は呼び出しごとの dict（呼び出し側で pop などしてよい）
+    """
+    if not ANALYSIS_COALESCE_ENABLED:
+        return process_seo_improvement(**kwargs)
+
+    def _lead():
+        return {"principal": principal, "kwargs": kwargs, "result": process_seo_improvement(**kwargs)}
+
+    run, shared = _analysis_flight.run(_analysis_key(kwargs), _lead)
+    same_user = principal is not None and principal == run["principal"]
+    if shared and not same_user and not (
+        _can_read_properties(principal, kwargs) and _can_read_properties(run["principal"], run["kwargs"])
+    ):
+        inc("mrseo_analysis_coalesced_total", result="denied")
+        return process_seo_improvement(**kwargs)
+    if shared:
+        inc("mrseo_analysis_coalesced_total", result="shared")
+        print(f"🔁 実行中の解析に合流: {kwargs.get('url')}")
+    return dict(run["result"])
+
+
+# ---------------------- 履歴（カーソルページング） ----------------------
+
+HISTORY_PAGE_SIZE = 20
+# 一覧に必要なフィールドだけ読む（result の表やチャート配列は読まない）
+_HISTORY_FIELDS = ["input_url", "timestamp", "result.chatgpt_response"]
+
+def _history_item(doc) -> dict:
+    d = doc.to_dict() or {}
+    ts = d.get("timestamp")
+    if hasattr(ts, "strftime"):
+        ts_str = ts.strftime("%Y-%m-%d %H:%M:%S")
+    else:
+        ts_str = str(ts)
+    return {
+        "id":               doc.id,
+        "timestamp":        ts_str,
+        "input_url":        d.get("input_url", ""),
+        "chatgpt_response": (d.get("result") or {}).get("chatgpt_response", ""),
+    }
+
+def get_history_page(uid: str, *, page_size: int = HISTORY_PAGE_SIZE, cursor: str | None = None):
+    """
+    ユーザーの履歴を新しい順に 1 ページ分返す。
+    cursor には前ページの next_cursor（最後のドキュメントID）を渡す。
+    返値: (items, next_cursor)  ※ 次ページが無ければ next_cursor は None
+    """
+    from firebase_admin import firestore as fa_firestore
+
+    col = _db().collection("improvements")
+    query = (
+        col.where("uid", "==", uid)
+           .order_by("timestamp", direction=fa_firestore.Query.DESCENDING)
+           .select(_HISTORY_FIELDS)
     )
-    history = []
-    for doc in docs:
-        d = doc.to_dict()
-        ts = d.get("timestamp")
-        if hasattr(ts, "strftime"):
-            ts_str = ts.strftime("%Y-%m-%d %H:%M:%S")
-        else:
-            ts_str = str(ts)
-        history.append({
-            "id":               doc.id,
-            "timestamp":        ts_str,
-            "input_url":        d.get("input_url", ""),
-            "chatgpt_response": d.get("result", {}).get("chatgpt_response", ""),
-        })
-    return history
+    if cursor:
+        # start_after に要るのは並び順のキーだけなので、本体（大きな result）は読まない
+        snap = col.document(cursor).get(field_paths=["uid", "timestamp"])
+        # 他人のドキュメントをカーソルにされても無視する
+        if not snap.exists or (snap.to_dict() or {}).get("uid") != uid:
+            return [], None
+        query = query.start_after(snap)
+
+    # 1 件多めに読んで次ページの有無を判定する
+    docs = list(query.limit(page_size + 1).stream())
+    items = [_history_item(d) for d in docs[:page_size]]
+    next_cursor = items[-1]["id"] if len(docs) > page_size else None
+    return items, next_cursor
+
+def get_history_for_user(uid: str, page_size: int = HISTORY_PAGE_SIZE):
+    """ユーザーの履歴（新しい順）の先頭ページ"""
+    items, _ = get_history_page(uid, page_size=page_size)
+    return items
 
 
 if __name__ == "__main__":
-    process_seo_improvement("sc-domain:mrseoai.com")
+    # 単発の動作確認用（複数サイトの一括実行は batch_runner.py を使う）
+    import sys
+    from batch_runner import main as batch_main
+    sys.exit(batch_main())
@@ -0,0 +1,181 @@
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# --- 処理時間・回数の計測（Prometheus 形式で /metrics に出す） ------------------------
+# span("gsc") のように囲むと、所要時間のヒストグラムと成功/失敗の回数を記録し、
+# 構造化ログ（1 行 JSON）にも出す。キャッシュのヒット/ミスなどは inc() で数える。
+# 値はプロセスごとに持つ（gunicorn の各ワーカーが自分の分を返す）。
+
+_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_lock = threading.Lock()
+_counters = {}     # (name, labels) -> float
+_histograms = {}   # labels -> [bucket counts..., +Inf count, sum]
+_gauge_callbacks = []   # 出力時に現在値を返す関数
+_HELP = {
+    "mrseo_span_seconds": ("histogram", "処理区間（解析ステージ・外部呼び出し）の所要時間"),
+    "mrseo_span_total": ("counter", "処理区間の実行回数（status=ok|error）"),
+    "mrseo_cache_requests_total": ("counter", "キャッシュの参照回数（result=hit|miss|revalidated など）"),
+    "mrseo_gsc_snapshot_days_total": ("counter", "GSC スナップショットで集計した日数（source=snapshot|api）"),
+    "mrseo_rate_limit_tokens": ("gauge", "レート制限バケットの残りトークン（サービス全体）"),
+    "mrseo_rate_limit_paused_seconds": ("gauge", "429 を受けて呼び出しを止めている残り秒数（最大のもの）"),
+    "mrseo_rate_limit_keys": ("gauge", "ユーザー/プロパティ単位のバケット数"),
+    "mrseo_rate_limit_wait_seconds_total": ("counter", "レート制限で待った合計秒数"),
+    "mrseo_rate_limit_throttled_total": ("counter", "レート制限で待たされた呼び出し数"),
+    "mrseo_rate_limit_rejected_total": ("counter", "待ち時間が上限を超えて諦めた呼び出し数"),
+    "mrseo_retries_total": ("counter", "再試行した回数（reason=HTTP ステータスまたは例外名）"),
+    "mrseo_retry_giveups_total": ("counter", "再試行しても失敗した呼び出し数"),
+    "mrseo_analysis_coalesced_total": ("counter", "実行中の同じ解析に合流した回数（result=shared|denied）"),
+    "mrseo_persist_queue_depth": ("gauge", "まだ Firestore に書いていない履歴の操作数"),
+    "mrseo_persist_ops_total": ("counter", "履歴の書き込み操作数（status=ok|failed）"),
+    "mrseo_persist_retries_total": ("counter", "履歴のまとめ書きを再試行した回数"),
+}
+
+logger = logging.getLogger("mrseo.metrics")
+if not logger.handlers:
+    _handler = logging.StreamHandler()
+    _handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(_handler)
+    logger.setLevel(logging.INFO if os.getenv("METRICS_LOG", "1") != "0" else logging.WARNING)
+    logger.propagate = False
+
+
+def _labels_key(labels: dict) -> tuple:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def inc(name: str, value: float = 1, **labels):
+    key = (name, _labels_key(labels))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def cache_event(cache: str, result: str):
+    """キャッシュのヒット/ミスを数える"""
+    inc("mrseo_cache_requests_total", cache=cache, result=result)
+
+
+def observe(span_name: str, seconds: float, status: str = "ok"):
+    key = _labels_key({"span": span_name})
+    with _lock:
+        h = _histograms.get(key)
+        if h is None:
+            h = _histograms[key] = [0] * (len(_BUCKETS) + 1) + [0.0]
+        for i, b in enumerate(_BUCKETS):
+            if seconds <= b:
+                h[i] += 1
+        h[len(_BUCKETS)] += 1
+        h[-1] += seconds
+    inc("mrseo_span_total", span=span_name, status=status)
+
+
+@contextmanager
+def span(name: str, **fields):
+    """with span("gsc"): ... の区間を計測する。例外はそのまま投げ直す"""
+    started = time.perf_counter()
+    status = "ok"
+    try:
+        yield
+    except BaseException as e:
+        status = "error"
+        fields = dict(fields, error=f"{type(e).__name__}: {e}")
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        observe(name, elapsed, status)
+        logger.info(json.dumps(
+            {"event": "span", "span": name, "status": status, "duration_ms": round(elapsed * 1000, 1), **fields},
+            ensure_ascii=False, default=str,
+        ))
+
+
+def register_gauges(fn):
+    """fn() -> [(name, {labels}, value), ...] を /metrics の出力時に呼ぶ（レート制限の残量など現在値の公開用）"""
+    _gauge_callbacks.append(fn)
+
+
+def _fmt_labels(labels: tuple, extra: tuple = ()) -> str:
+    items = list(labels) + list(extra)
+    if not items:
+        return ""
+    body = ",".join(
+        '{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for k, v in items
+    )
+    return "{" + body + "}"
+
+
+def render_prometheus() -> str:
+    """Prometheus のテキスト形式（version 0.0.4）"""
+    with _lock:
+        counters = dict(_counters)
+        histograms = {k: list(v) for k, v in _histograms.items()}
+
+    lines = []
+    by_name = {}
+    for (name, labels), value in counters.items():
+        by_name.setdefault(name, []).append((labels, value))
+    for name in sorted(by_name):
+        kind, help_text = _HELP.get(name, ("counter", name))
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in sorted(by_name[name]):
+            lines.append(f"{name}{_fmt_labels(labels)} {value:g}")
+
+    gauges = {}
+    for fn in list(_gauge_callbacks):
+        for name, labels, value in fn():
+            gauges.setdefault(name, []).append((_labels_key(labels), value))
+    for name in sorted(gauges):
+        lines.append(f"# HELP {name} {_HELP.get(name, ('gauge', name))[1]}")
+        lines.append(f"# TYPE {name} gauge")
+        for labels, value in sorted(gauges[name]):
+            lines.append(f"{name}{_fmt_labels(labels)} {value:g}")
+
+    if histograms:
+        name = "mrseo_span_seconds"
+        lines.append(f"# HELP {name} {_HELP[name][1]}")
+        lines.append(f"# TYPE {name} histogram")
+        for labels, h in sorted(histograms.items()):
+            for i, b in enumerate(_BUCKETS):
+                lines.append(f"{name}_bucket{_fmt_labels(labels, (('le', f'{b:g}'),))} {h[i]}")
+            lines.append(f"{name}_bucket{_fmt_labels(labels, (('le', '+Inf'),))} {h[len(_BUCKETS)]}")
+            lines.append(f"{name}_sum{_fmt_labels(labels)} {h[-1]:.6f}")
+            lines.append(f"{name}_count{_fmt_labels(labels)} {h[len(_BUCKETS)]}")
+    return "\n".join(lines) + "\n"
+
+
+def snapshot() -> dict:
+    """現在の計測値（ベンチマークなどで使う）。{span: {count, sum, errors}}"""
+    with _lock:
+        out = {}
+        for labels, h in _histograms.items():
+            name = dict(labels)["span"]
+            out[name] = {"count": h[len(_BUCKETS)], "sum": h[-1], "errors": 0}
+        for (metric, labels), value in _counters.items():
+            d = dict(labels)
+            if metric == "mrseo_span_total" and d.get("status") == "error" and d["span"] in out:
+                out[d["span"]]["errors"] = value
+        return out
+
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
+
+
+def timed(name: str):
+    """関数全体を span で囲むデコレータ"""
+    def deco(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return deco
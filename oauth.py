@@ -1,15 +1,19 @@
 import base64
 from pathlib import Path
 import os
-from datetime import datetime
+import threading
+from datetime import datetime, timedelta
+from typing import TYPE_CHECKING
 
 from flask import session, url_for, request
-from google_auth_oauthlib.flow import Flow
-from google.oauth2.credentials import Credentials
-from google.auth.transport.requests import Request
 
-# Firestore に永続化（※ firebase_admin.initialize_app は app.py 側で済ませておく）
-from firebase_admin import firestore
+# google-auth / oauthlib / Firestore は使うときに読み込む（/login などの表示だけなら不要）
+if TYPE_CHECKING:
+    from google.oauth2.credentials import Credentials
+
+from cache_utils import LRUCache, SingleFlight
+from firebase_app import get_db
+from metrics import cache_event, span
 
 # --- 1) スコープ拡張（GA/GSCに加えて Sheets/Drive も扱えるように） ---
 SCOPES = [
@@ -20,19 +24,30 @@ SCOPES = [
 ]
 
 # --- 2) client_secret.json の配置（Cloud Run 環境変数からのBase64対応） ---
-b64 = os.getenv("GOOGLE_OAUTH2_CLIENT_SECRET_JSON_BASE64")
-if b64:
-    credentials_path = Path(__file__).parent / "client_secret.json"
-    credentials_path.write_bytes(base64.b64decode(b64))
-    CLIENT_SECRETS_FILE = str(credentials_path)
-else:
-    CLIENT_SECRETS_FILE = "client_secret.json"
+# import 時ではなく、最初に OAuth フローを作るときに 1 回だけ書き出す
+_client_secrets_file = None
+_client_secrets_lock = threading.Lock()
+
+def client_secrets_file() -> str:
+    global _client_secrets_file
+    if _client_secrets_file is None:
+        with _client_secrets_lock:
+            if _client_secrets_file is None:
+                b64 = os.getenv("GOOGLE_OAUTH2_CLIENT_SECRET_JSON_BASE64")
+                if b64:
+                    credentials_path = Path(__file__).parent / "client_secret.json"
+                    credentials_path.write_bytes(base64.b64decode(b64))
+                    _client_secrets_file = str(credentials_path)
+                else:
+                    _client_secrets_file = "client_secret.json"
+    return _client_secrets_file
 
 
 # ========== 既存：Flow作成 ==========
 def create_flow():
+    from google_auth_oauthlib.flow import Flow
     return Flow.from_client_secrets_file(
-        CLIENT_SECRETS_FILE,
+        client_secrets_file(),
         scopes=SCOPES,
         redirect_uri=url_for("oauth2callback", _external=True, _scheme="https"),
     )
@@ -54,6 +69,7 @@ def build_authorization_url():
 def get_credentials_from_session():
     if "credentials" not in session:
         return None
+    from google.oauth2.credentials import Credentials
     return Credentials(**session["credentials"])
 
 
@@ -69,9 +85,26 @@ def store_credentials_in_session(creds):
     }
 
 
+# ========== 追加：プロセス内の資格情報キャッシュ ==========
+# 毎リクエストの Firestore 読み込みとトークン更新をホットパスから外す。
+# - uid ごとに一定時間キャッシュ（未連携も短時間だけ覚えておく）
+# - 期限が近づいたらバックグラウンドで先回りして更新、期限切れならその場で更新
+# - 同じ uid の更新は 1 本にまとめる（single-flight）。更新結果は Firestore にも書き戻す
+
+CRED_CACHE_TTL = int(os.getenv("CRED_CACHE_TTL", "600"))
+_NEGATIVE_TTL = 30
+_REFRESH_MARGIN = timedelta(minutes=5)
+_NOT_LINKED = object()
+
+_cred_cache = LRUCache(maxsize=2048, ttl=CRED_CACHE_TTL)
+_cred_flight = SingleFlight()
+_refreshing = set()                 # 裏で更新中の uid
+_refreshing_lock = threading.Lock()
+
+
 # ========== 追加：Firestore にユーザー単位で保存 ==========
-def _save_user_credentials(uid: str, creds: Credentials):
-    firestore.client().collection("user_google_tokens").document(uid).set({
+def _save_user_credentials(uid: str, creds: "Credentials"):
+    get_db().collection("user_google_tokens").document(uid).set({
         "token": creds.token,
         "refresh_token": creds.refresh_token,
         "token_uri": creds.token_uri,
@@ -81,13 +114,30 @@ def _save_user_credentials(uid: str, creds: Credentials):
         "expiry": creds.expiry.isoformat() if getattr(creds, "expiry", None) else None,
         "updatedAt": datetime.utcnow().isoformat(),
     }, merge=True)
+    _cred_cache.set(uid, creds)     # write-through
 
 
-# ========== 追加：Firestore から取得＋期限切れなら自動リフレッシュ ==========
-def get_user_credentials(uid: str) -> Credentials | None:
-    doc = firestore.client().collection("user_google_tokens").document(uid).get()
+def _parse_expiry(value) -> datetime | None:
+    """保存済みの expiry（naive UTC の ISO 文字列）を google-auth と同じ形式に戻す"""
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(str(value)).replace(tzinfo=None)
+    except ValueError:
+        return None
+
+
+def _expires_soon(creds: "Credentials") -> bool:
+    expiry = getattr(creds, "expiry", None)
+    return expiry is not None and expiry - _REFRESH_MARGIN <= datetime.utcnow()
+
+
+def _load_user_credentials(uid: str):
+    doc = get_db().collection("user_google_tokens").document(uid).get()
     if not doc.exists:
+        _cred_cache.set(uid, _NOT_LINKED, ttl=_NEGATIVE_TTL)
         return None
+    from google.oauth2.credentials import Credentials
     d = doc.to_dict() or {}
     creds = Credentials(
         token=d.get("token"),
@@ -96,19 +146,76 @@ def get_user_credentials(uid: str) -> Credentials | None:
         client_id=d.get("client_id"),
         client_secret=d.get("client_secret"),
         scopes=d.get("scopes"),
+        expiry=_parse_expiry(d.get("expiry")),
     )
-    # 自動リフレッシュ
-    if creds and creds.expired and creds.refresh_token:
+    _cred_cache.set(uid, creds)
+    return creds
+
+
+def _refresh_user_credentials(uid: str, creds: "Credentials") -> "Credentials":
+    from google.auth.transport.requests import Request
+    from google.oauth2.credentials import Credentials
+
+    # 待っている間に他のスレッドが更新済みならそれを使う（同じオブジェクトなら更新されていない）
+    cached = _cred_cache.get(uid)
+    if isinstance(cached, Credentials) and cached is not creds and cached.valid and not _expires_soon(cached):
+        return cached
+    with span("oauth.refresh"):
         creds.refresh(Request())
-        _save_user_credentials(uid, creds)
+    _save_user_credentials(uid, creds)
     return creds
 
 
+def _refresh_in_background(uid: str, creds: "Credentials"):
+    # 期限前の猶予中はリクエストごとに呼ばれるので、更新中の uid にはスレッドを増やさない
+    with _refreshing_lock:
+        if uid in _refreshing:
+            return
+        _refreshing.add(uid)
+
+    def _run():
+        try:
+            _cred_flight.do(("refresh", uid), _refresh_user_credentials, uid, creds)
+        except Exception as e:
+            print("⚠️ トークン更新エラー:", uid, e)
+        finally:
+            with _refreshing_lock:
+                _refreshing.discard(uid)
+    threading.Thread(target=_run, daemon=True).start()
+
+
+# ========== 追加：Firestore から取得＋期限切れなら自動リフレッシュ ==========
+def get_user_credentials(uid: str) -> "Credentials | None":
+    creds = _cred_cache.get(uid)
+    cache_event("credentials", "miss" if creds is None else "hit")
+    if creds is _NOT_LINKED:
+        return None
+    if creds is None:
+        creds = _cred_flight.do(("load", uid), _load_user_credentials, uid)
+        if creds is None:
+            return None
+
+    if creds.refresh_token and (creds.expired or (creds.expiry is None and not creds.token)):
+        # もう使えないのでその場で更新（同じ uid の更新は 1 本にまとめる）
+        creds = _cred_flight.do(("refresh", uid), _refresh_user_credentials, uid, creds)
+    elif creds.refresh_token and _expires_soon(creds):
+        # まだ使えるうちに裏で更新しておく
+        _refresh_in_background(uid, creds)
+    return creds
+
+
+def invalidate_user_credentials(uid: str):
+    """連携解除などで保存内容が変わったときに呼ぶ"""
+    _cred_cache.pop(uid)
+
+
 # ========== 追加：コールバックでコードをトークンに交換 → Firestoreへ保存 ==========
 def exchange_code_and_store(uid: str):
+    from google_auth_oauthlib.flow import Flow
+
     state = session.get("state")
     flow = Flow.from_client_secrets_file(
-        CLIENT_SECRETS_FILE,
+        client_secrets_file(),
         scopes=SCOPES,
         state=state,
         redirect_uri=url_for("oauth2callback", _external=True, _scheme="https"),
@@ -0,0 +1,87 @@
+import hashlib
+import os
+import time
+
+import http_client
+from cache_utils import LRUCache, get_shared_store
+from html_meta import EMPTY_META, extract_meta_from_response
+from metrics import cache_event, span
+
+# --- 競合/対象ページのメタ情報キャッシュ ----------------------------------------
+# 1段目: プロセス内 LRU、2段目: ローカル SQLite（ワーカー間で共有）。
+# 新鮮な間はダウンロードもパースもしない。期限切れ後も検証子（ETag / Last-Modified）を
+# しばらく保持しておき、条件付き GET で 304 が返れば保存済みのメタ情報をそのまま使う。
+
+_NAMESPACE = "page_meta"
+
+# 新鮮とみなす秒数（この間は HTTP アクセスしない）
+FRESH_TTL = int(os.getenv("PAGE_META_FRESH_TTL", str(6 * 3600)))
+# 再検証用に保持しておく秒数（これを過ぎたら完全に捨てる）
+KEEP_TTL = int(os.getenv("PAGE_META_KEEP_TTL", str(7 * 24 * 3600)))
+
+_memory = LRUCache(maxsize=1024, ttl=KEEP_TTL)
+
+
+def _key(url: str) -> str:
+    return hashlib.sha256(url.encode("utf-8")).hexdigest()
+
+
+def _load(url: str) -> dict | None:
+    key = _key(url)
+    entry = _memory.get(key)
+    if entry is None:
+        entry = get_shared_store().get(_NAMESPACE, key)
+        if entry is not None:
+            _memory.set(key, entry)
+    return entry
+
+
+def _save(url: str, entry: dict):
+    key = _key(url)
+    _memory.set(key, entry)
+    get_shared_store().set(_NAMESPACE, key, entry, ttl=KEEP_TTL)
+
+
+def fetch_page_meta(url: str, *, timeout=None) -> dict:
+    """
+    ページのメタ情報を返す（キャッシュ優先）。
+    返値: {"title","description","og_description","canonical","h1","p"}（無い項目は空文字）。
+    本文は全部は読まず、html_meta で必要な分（通常は </head> まで）だけ読む。
+    取得は http_client の共通セッション（keep-alive・リトライ付き）で行う。timeout 省略時はその既定値。
+    取得失敗時は例外を投げる（呼び出し側が従来どおりログを出して空扱いにする）。
+    """
+    entry = _load(url)
+    now = time.time()
+    if entry is not None and now - entry.get("fetched_at", 0) < FRESH_TTL:
+        cache_event("page_meta", "hit")
+        return {**EMPTY_META, **entry["meta"]}
+
+    headers = {}
+    if entry is not None:
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+
+    with span("http.page"):
+        response = http_client.get(url, timeout=timeout, headers=headers, stream=True)
+    if response.status_code == 304 and entry is not None:
+        response.close()
+        cache_event("page_meta", "revalidated")
+        entry = dict(entry, fetched_at=now)
+        _save(url, entry)
+        return {**EMPTY_META, **entry["meta"]}
+
+    cache_event("page_meta", "miss")
+    if not response.ok:
+        response.close()
+        response.raise_for_status()
+    with span("html.meta"):
+        meta = extract_meta_from_response(response)
+    _save(url, {
+        "meta": meta,
+        "etag": response.headers.get("ETag"),
+        "last_modified": response.headers.get("Last-Modified"),
+        "fetched_at": now,
+    })
+    return meta
@@ -0,0 +1,282 @@
+import os
+import random
+import threading
+import time
+
+from cache_utils import LRUCache
+from metrics import inc, register_gauges
+
+# --- 外部 API のレート制限と再試行 --------------------------------------------------
+# サービス全体（API キー / GCP プロジェクト単位のクォータ）と、ユーザー・プロパティ単位
+# （GSC のサイト、GA4 のプロパティなど）の 2 段のトークンバケットで呼び出しを間引き、
+# 429 / 5xx / 接続エラーは指数バックオフ＋ジッターで再試行する。
+# - 429 を受けたら、そのバケットを待ち時間のあいだ止める（他のスレッドもまとめて減速する）
+# - バケットはプロセスごと（gunicorn のワーカー数に合わせて RATE_LIMIT_* を設定する）
+# - 状態（残量・停止中の秒数・待ち時間・再試行回数）は /metrics に出る
+#
+# 設定: RATE_LIMIT_<SERVICE>="毎秒/バースト"（例 "10/20"、"0" で無効）、
+#       RATE_LIMIT_<SERVICE>_PER_KEY も同じ形式。RATE_LIMIT_MAX_WAIT, RATE_LIMIT_RETRIES
+
+# サービス: (全体の毎秒, バースト), (キーごとの毎秒, バースト) ※ None は制限なし
+DEFAULT_LIMITS = {
+    "gsc":     ((10, 20), (5, 10)),     # Search Console はサイト×ユーザー単位の QPM もある
+    "ga":      ((10, 10), (2, 5)),      # GA4 Data API はプロパティ単位のトークン/同時実行数
+    "serpapi": ((5, 5), None),
+    "openai":  ((3, 5), None),
+}
+
+MAX_WAIT = float(os.getenv("RATE_LIMIT_MAX_WAIT", "30"))     # これ以上待つなら諦める（秒）
+RETRIES = int(os.getenv("RATE_LIMIT_RETRIES", "4"))
+_BACKOFF_BASE = 0.5
+_BACKOFF_CAP = 20.0
+
+_RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+_RETRYABLE_NAMES = {
+    # requests / urllib3 / httpx
+    "ConnectionError", "Timeout", "ConnectTimeout", "ReadTimeout", "ChunkedEncodingError",
+    "ProtocolError", "ConnectError", "ReadError", "RemoteProtocolError",
+    # google.api_core
+    "ResourceExhausted", "TooManyRequests", "ServiceUnavailable", "InternalServerError",
+    "DeadlineExceeded", "BadGateway", "GatewayTimeout",
+    # openai
+    "RateLimitError", "APIConnectionError", "APITimeoutError",
+    # httplib2 / socket
+    "ServerNotFoundError", "timeout", "TimeoutError", "ConnectionResetError",
+}
+# Search Console は 403 で返すレート超過もある
+_RATE_LIMIT_REASONS = ("rateLimitExceeded", "userRateLimitExceeded", "RESOURCE_EXHAUSTED")
+
+
+class RateLimitExceeded(Exception):
+    """待ち時間が RATE_LIMIT_MAX_WAIT を超えるため呼び出さなかった"""
+
+
+class RetryableError(Exception):
+    """例外を投げないクライアント（SerpAPI のエラー応答など）で再試行させたいときに使う"""
+
+    def __init__(self, message: str, status: int | None = None, retry_after: float | None = None):
+        super().__init__(message)
+        self.status_code = status
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """毎秒 rate 個補充され、最大 burst 個まで貯まるバケット（待ちは前借りで順番に割り当てる）"""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, now: float) -> float:
+        """1 トークン予約して、使えるようになるまでの秒数を返す"""
+        with self._lock:
+            self._refill(now)
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+            return max(wait, self.paused_until - now)
+
+    def refund(self):
+        with self._lock:
+            self.tokens = min(self.burst, self.tokens + 1)
+
+    def pause(self, seconds: float):
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def state(self) -> tuple[float, float]:
+        """(残りトークン, 停止中の残り秒数)"""
+        now = time.monotonic()
+        with self._lock:
+            self._refill(now)
+            return self.tokens, max(0.0, self.paused_until - now)
+
+
+def _parse_limit(value: str | None, default):
+    if value is None:
+        return default
+    value = value.strip()
+    if value in ("", "0", "off", "none"):
+        return None
+    rate, _, burst = value.partition("/")
+    return float(rate), float(burst or rate)
+
+
+def _limits(service: str):
+    default_total, default_key = DEFAULT_LIMITS.get(service, (None, None))
+    env = f"RATE_LIMIT_{service.upper()}"
+    return _parse_limit(os.getenv(env), default_total), _parse_limit(os.getenv(env + "_PER_KEY"), default_key)
+
+
+_buckets = {}                          # service -> TokenBucket | None
+_key_buckets = {}                      # service -> LRUCache(key -> TokenBucket)
+_buckets_lock = threading.Lock()
+
+
+def _service_bucket(service: str) -> TokenBucket | None:
+    if service not in _buckets:
+        with _buckets_lock:
+            if service not in _buckets:
+                total, _ = _limits(service)
+                _buckets[service] = TokenBucket(*total) if total else None
+    return _buckets[service]
+
+
+def _key_bucket(service: str, key) -> TokenBucket | None:
+    if key is None:
+        return None
+    _, per_key = _limits(service)
+    if not per_key:
+        return None
+    with _buckets_lock:
+        cache = _key_buckets.setdefault(service, LRUCache(maxsize=4096, ttl=3600))
+        bucket = cache.get(key)
+        if bucket is None:
+            bucket = TokenBucket(*per_key)
+            cache.set(key, bucket)
+        return bucket
+
+
+def acquire(service: str, key=None):
+    """サービス全体とキー単位のバケットから 1 つずつ取り、必要なら待つ"""
+    buckets = [b for b in (_service_bucket(service), _key_bucket(service, key)) if b is not None]
+    if not buckets:
+        return
+    now = time.monotonic()
+    wait = max(b.reserve(now) for b in buckets)
+    if wait > MAX_WAIT:
+        for b in buckets:
+            b.refund()
+        inc("mrseo_rate_limit_rejected_total", service=service)
+        raise RateLimitExceeded(f"{service} のレート制限により {wait:.1f} 秒待ちのため中止しました")
+    if wait > 0:
+        inc("mrseo_rate_limit_throttled_total", service=service)
+        inc("mrseo_rate_limit_wait_seconds_total", wait, service=service)
+        time.sleep(wait)
+
+
+# --- 再試行の判定 ----------------------------------------------------------------
+
+def _status_of(exc) -> int | None:
+    for attr in ("status_code", "code"):
+        v = getattr(exc, attr, None)
+        if isinstance(v, int):
+            return v
+    resp = getattr(exc, "resp", None) or getattr(exc, "response", None)
+    for attr in ("status", "status_code"):
+        v = getattr(resp, attr, None)
+        if isinstance(v, int):
+            return v
+        if isinstance(v, str) and v.isdigit():
+            return int(v)
+    return None
+
+
+def _retry_after(exc) -> float | None:
+    v = getattr(exc, "retry_after", None)
+    if v is None:
+        resp = getattr(exc, "resp", None) or getattr(exc, "response", None)
+        headers = getattr(resp, "headers", None) or (resp if isinstance(resp, dict) else None)
+        if headers is not None:
+            try:
+                v = headers.get("retry-after") or headers.get("Retry-After")
+            except Exception:
+                v = None
+    try:
+        return float(v) if v is not None else None
+    except (TypeError, ValueError):
+        return None   # HTTP-date 形式は使わない（バックオフで代用）
+
+
+def is_retryable(exc) -> bool:
+    status = _status_of(exc)
+    if status in _RETRYABLE_STATUS:
+        return True
+    if status == 403 and any(r in str(exc) for r in _RATE_LIMIT_REASONS):
+        return True
+    if isinstance(exc, RetryableError):
+        return True
+    return any(cls.__name__ in _RETRYABLE_NAMES for cls in type(exc).__mro__)
+
+
+def _is_rate_limited(exc) -> bool:
+    status = _status_of(exc)
+    return status == 429 or (status == 403 and any(r in str(exc) for r in _RATE_LIMIT_REASONS)) \
+        or type(exc).__name__ in ("RateLimitError", "ResourceExhausted", "TooManyRequests")
+
+
+def backoff_delay(attempt: int, retry_after: float | None = None) -> float:
+    """attempt 回目（0 始まり）の待ち秒数（full jitter。Retry-After があればそれ以上）"""
+    delay = random.uniform(0, min(_BACKOFF_CAP, _BACKOFF_BASE * (2 ** attempt)))
+    if retry_after is not None:
+        delay = max(delay, min(retry_after, _BACKOFF_CAP * 3) + random.uniform(0, 0.5))
+    return delay
+
+
+def call(service: str, fn, *args, key=None, retries: int | None = None, **kwargs):
+    """
+    レート制限を守って fn(*args, **kwargs) を呼ぶ。再試行できるエラーはバックオフして呼び直し、
+    回数を使い切ったら最後の例外をそのまま投げる（呼び出し側の従来のエラー処理に任せる）。
+    再試行の待ちが RATE_LIMIT_MAX_WAIT を超えるときも、RateLimitExceeded ではなく元の例外を投げる。
+    key: ユーザー/プロパティ単位で制限するときのキー（GSC のサイト、GA4 のプロパティなど）
+    ※ 待つあいだ呼び出し側の service_slots の枠（一括実行時）は握ったまま
+    """
+    retries = RETRIES if retries is None else retries
+    last_error = None
+    for attempt in range(retries + 1):
+        try:
+            acquire(service, key)
+        except RateLimitExceeded:
+            if last_error is None:
+                raise
+            inc("mrseo_retry_giveups_total", service=service)
+            raise last_error
+        try:
+            return fn(*args, **kwargs)
+        except Exception as e:
+            if not is_retryable(e):
+                raise
+            if attempt >= retries:
+                inc("mrseo_retry_giveups_total", service=service)
+                raise
+            last_error = e
+            delay = backoff_delay(attempt, _retry_after(e))
+            inc("mrseo_retries_total", service=service, reason=str(_status_of(e) or type(e).__name__))
+            # クォータ超過はこの呼び出しだけでなく同じバケットを使う全員で待つ（次の acquire で待つ）
+            bucket = (_key_bucket(service, key) or _service_bucket(service)) if _is_rate_limited(e) else None
+            if bucket is not None:
+                # MAX_WAIT より長く止めると次の acquire が必ず諦めるので、そこまでに抑える
+                delay = min(delay, MAX_WAIT)
+            print(f"⏳ {service} 再試行 {attempt + 1}/{retries}（{delay:.1f} 秒後）: {type(e).__name__}")
+            if bucket is not None:
+                bucket.pause(delay)
+                continue
+            time.sleep(delay)
+
+
+def _gauges():
+    out = []
+    with _buckets_lock:
+        services = dict(_buckets)
+        keyed = {s: c.values() for s, c in _key_buckets.items()}
+    for service, bucket in services.items():
+        if bucket is None:
+            continue
+        tokens, paused = bucket.state()
+        out.append(("mrseo_rate_limit_tokens", {"service": service}, round(tokens, 2)))
+        out.append(("mrseo_rate_limit_paused_seconds", {"service": service, "scope": "service"}, round(paused, 2)))
+    for service, entries in keyed.items():
+        out.append(("mrseo_rate_limit_keys", {"service": service}, len(entries)))
+        paused = max((b.state()[1] for b in entries), default=0.0)
+        out.append(("mrseo_rate_limit_paused_seconds", {"service": service, "scope": "key"}, round(paused, 2)))
+    return out
+
+
+register_gauges(_gauges)
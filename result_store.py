@@ -0,0 +1,204 @@
+import json
+import os
+import zlib
+
+# --- improvements ドキュメントに保存する解析結果のコンパクト形式 --------------------
+# 旧形式は process_seo_improvement の返値（table_html と chart_data の並列リスト）を
+# そのまま保存していたため、大きなサイトでは 1 MiB 近いドキュメントになっていた。
+# 新形式（format=2）では表を「列ごとの型付き配列」で 1 回だけ持ち、
+# - ある程度大きければ zlib 圧縮した bytes にする
+# - それでも大きければサブコレクション improvements/{id}/blobs に分割して逃がす
+# chart_labels / chart_data は表示時に列から組み立てる。表は HTML にせず、
+# /results/<id>/rows（query_rows）で必要なページだけ JSON で返す。
+
+RESULT_FORMAT = 2
+
+TABLE_COLUMNS = ["URL", "クリック数", "表示回数", "CTR（%）", "平均順位", "コンバージョン数"]
+_INT_COLUMNS = {"クリック数", "表示回数", "コンバージョン数"}
+
+# 行 API・チャートで使う列のキー（英字）→ 列名
+COLUMN_KEYS = {
+    "url":         "URL",
+    "clicks":      "クリック数",
+    "impressions": "表示回数",
+    "ctr":         "CTR（%）",
+    "position":    "平均順位",
+    "conversions": "コンバージョン数",
+}
+
+_COMPRESS_OVER = 16 * 1024        # これより大きい表は圧縮する（bytes）
+_OFFLOAD_OVER = 512 * 1024        # 圧縮後これより大きければサイドドキュメントへ
+_BLOB_CHUNK = 800 * 1024          # 1 ドキュメント 1 MiB 制限に収まる分割サイズ
+
+# チャートに載せる URL 数（表示回数の多い順）。全 URL を載せるとページが URL 数に比例して重くなる
+CHART_MAX_URLS = int(os.getenv("CHART_MAX_URLS", "30"))
+
+
+def frame_to_columns(df) -> dict:
+    """マージ済み DataFrame → {列名: 型付きリスト}"""
+    if df is None or df.empty:
+        return {}
+    cols = {}
+    for c in TABLE_COLUMNS:
+        if c not in df.columns:
+            continue
+        if c == "URL":
+            cols[c] = df[c].astype(str).tolist()
+        elif c in _INT_COLUMNS:
+            cols[c] = df[c].fillna(0).astype(int).tolist()
+        else:
+            cols[c] = df[c].astype(float).round(2).tolist()
+    return cols
+
+
+def row_count(columns: dict) -> int:
+    return len((columns or {}).get("URL") or [])
+
+
+def chart_from_columns(columns: dict, limit: int = CHART_MAX_URLS):
+    """列データ → (chart_labels, chart_data)。表示回数の多い上位 limit 件の URL だけ"""
+    n = row_count(columns)
+    if not n:
+        return [], {}
+    impressions = columns.get("表示回数") or [0] * n
+    top = sorted(range(n), key=lambda i: -impressions[i])[:max(0, limit)]
+    return [columns["URL"][i] for i in top], {
+        key: [columns[name][i] for i in top] if name in columns else []
+        for key, name in COLUMN_KEYS.items() if key != "url"
+    }
+
+
+# --- 表の行 API（ソート・絞り込み・ページング） -------------------------------------
+
+def row_order(columns: dict, sort: str | None = None, descending: bool = False) -> list[int]:
+    """sort（COLUMN_KEYS のキー）で並べた行番号。sort が無ければ元の順"""
+    n = row_count(columns)
+    name = COLUMN_KEYS.get(sort or "")
+    if name not in (columns or {}):
+        return list(range(n))
+    values = columns[name]
+    return sorted(range(n), key=values.__getitem__, reverse=descending)
+
+
+def query_rows(columns: dict, order: list[int], *, q: str = "", ranges: dict | None = None,
+               offset: int = 0, limit: int = 100) -> tuple[int, list[list]]:
+    """
+    order の順に、URL に q を含み ranges={キー: (最小, 最大)} に収まる行を絞り込み、
+    offset から limit 行を返す → (絞り込み後の件数, [[url, clicks, ...], ...])
+    """
+    names = [name for name in COLUMN_KEYS.values() if name in columns]
+    q = (q or "").strip().lower()
+    bounds = [
+        (columns[COLUMN_KEYS[key]], lo, hi)
+        for key, (lo, hi) in (ranges or {}).items()
+        if COLUMN_KEYS.get(key) in columns and key != "url"
+    ]
+    urls = columns.get("URL") or []
+
+    def _match(i):
+        if q and q not in urls[i].lower():
+            return False
+        return all((lo is None or col[i] >= lo) and (hi is None or col[i] <= hi) for col, lo, hi in bounds)
+
+    matched = order if not (q or bounds) else [i for i in order if _match(i)]
+    page = matched[max(0, offset):max(0, offset) + max(0, limit)]
+    return len(matched), [[columns[name][i] for name in names] for i in page]
+
+
+def pack_result(result: dict) -> tuple[dict, list[bytes]]:
+    """
+    process_seo_improvement の返値 → (ドキュメントに入れる result, サイドに逃がす blob チャンク)
+    blob チャンクが空でなければ save_result_blobs で保存すること。
+    """
+    columns = result.get("table_columns") or {}
+    raw = json.dumps(columns, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+    table = {"encoding": "json", "data": columns}
+    chunks = []
+    if len(raw) > _COMPRESS_OVER:
+        packed = zlib.compress(raw, 6)
+        if len(packed) > _OFFLOAD_OVER:
+            chunks = [packed[i:i + _BLOB_CHUNK] for i in range(0, len(packed), _BLOB_CHUNK)]
+            table = {"encoding": "zlib-blob", "chunks": len(chunks)}
+        else:
+            table = {"encoding": "zlib", "data": packed}
+
+    packed_result = {
+        "format":           RESULT_FORMAT,
+        "clicks":           result.get("clicks", 0),
+        "impressions":      result.get("impressions", 0),
+        "ctr":              result.get("ctr", 0.0),
+        "position":         result.get("position", 0.0),
+        "conversions":      result.get("conversions", 0),
+        "competitors":      [
+            {k: c.get(k, "") for k in ("position", "title", "url", "メタディスクリプション")}
+            for c in result.get("competitors", [])
+        ],
+        "chatgpt_response": result.get("chatgpt_response", ""),   # 履歴一覧の射影で読むので平置き
+        "table":            table,
+    }
+    return packed_result, chunks
+
+
+def unpack_result(stored: dict, load_blobs=None) -> dict:
+    """
+    保存された result → 画面表示用の dict（chart_* を組み立てる）。
+    旧形式（format なし）はそのまま返す。load_blobs() はサイドドキュメントの bytes 列を返す関数。
+    """
+    stored = stored or {}
+    if stored.get("format") != RESULT_FORMAT:
+        # 旧形式: 表（table_html）は使わず、chart_labels / chart_data の並列リストを列データに戻す
+        legacy = dict(stored)
+        if not legacy.get("table_columns") and legacy.get("chart_labels"):
+            data = legacy.get("chart_data") or {}
+            legacy["table_columns"] = {"URL": list(legacy["chart_labels"])}
+            legacy["table_columns"].update(
+                {COLUMN_KEYS[key]: list(values) for key, values in data.items() if key in COLUMN_KEYS}
+            )
+            legacy["chart_labels"], legacy["chart_data"] = chart_from_columns(legacy["table_columns"])
+        legacy.pop("table_html", None)
+        return legacy
+
+    table = stored.get("table") or {}
+    encoding = table.get("encoding")
+    if encoding == "zlib":
+        columns = json.loads(zlib.decompress(table["data"]).decode("utf-8"))
+    elif encoding == "zlib-blob":
+        blobs = load_blobs() if load_blobs else []
+        columns = json.loads(zlib.decompress(b"".join(blobs)).decode("utf-8")) if blobs else {}
+    else:
+        columns = table.get("data") or {}
+
+    chart_labels, chart_data = chart_from_columns(columns)
+    competitors = [
+        dict(c, URL=c.get("url", ""), タイトル=c.get("title", "")) for c in stored.get("competitors", [])
+    ]
+    return {
+        "clicks":           stored.get("clicks", 0),
+        "impressions":      stored.get("impressions", 0),
+        "ctr":              stored.get("ctr", 0.0),
+        "position":         stored.get("position", 0.0),
+        "conversions":      stored.get("conversions", 0),
+        "table_columns":    columns,
+        "chart_labels":     chart_labels,
+        "chart_data":       chart_data,
+        "competitors":      competitors,
+        "chatgpt_response": stored.get("chatgpt_response", ""),
+    }
+
+
+# --- サイドドキュメント（improvements/{id}/blobs/{n}） ------------------------------
+
+def save_result_blobs(doc_ref, chunks: list[bytes]):
+    for i, chunk in enumerate(chunks):
+        doc_ref.collection("blobs").document(f"{i:04d}").set({"data": chunk})
+
+
+def load_result_blobs(doc_ref) -> list[bytes]:
+    docs = sorted(doc_ref.collection("blobs").stream(), key=lambda d: d.id)
+    return [(d.to_dict() or {}).get("data", b"") for d in docs]
+
+
+def delete_result_blobs(doc_ref):
+    for d in doc_ref.collection("blobs").stream():
+        d.reference.delete()
@@ -1,40 +1,99 @@
 from serpapi import GoogleSearch
+import json
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from urllib.parse import urlparse
 from dotenv import load_dotenv
-from bs4 import BeautifulSoup
-import requests
+
+from cache_utils import LRUCache, SingleFlight, get_shared_store
+from metrics import cache_event, span
+from page_cache import fetch_page_meta
+from rate_limit import RetryableError, call as rate_limited
 
 def _serpapi_key():
     return os.getenv("SERPAPI_KEY") or os.getenv("SERPAPI_API_KEY")
 
-def get_top_competitor_urls(keyword, num_results=5):
-    """SerpAPIで上位サイトのURLを取得"""
+# --- SERP キャッシュ -----------------------------------------------------------
+# 同じ (キーワード, hl, gl, 件数) は一定時間ユーザー間で共有する。
+# 1段目: プロセス内 LRU、2段目: SQLite（gunicorn ワーカー間で共有）。
+
+_SERP_NAMESPACE = "serp"
+SERP_CACHE_TTL = int(os.getenv("SERP_CACHE_TTL", str(24 * 3600)))   # 鮮度の許容時間（秒）。0 で無効
+
+_serp_memory = LRUCache(maxsize=512)
+_serp_flight = SingleFlight()
+
+def _serp_cache_key(keyword, hl, gl, num_results) -> str:
+    return json.dumps([str(keyword).strip().lower(), hl, gl, int(num_results)], ensure_ascii=False)
+
+def get_top_competitor_urls(keyword, num_results=5, *, hl="ja", gl="jp"):
+    """SerpAPIで上位サイトのURLを取得（キャッシュ優先・同時ミスは 1 回の呼び出しに合流）"""
     if not keyword or not str(keyword).strip():
         return []
 
+    if SERP_CACHE_TTL <= 0:
+        return _search_competitor_urls(keyword, num_results, hl, gl) or []
+
+    key = _serp_cache_key(keyword, hl, gl, num_results)
+    cached = _serp_memory.get(key)
+    if cached is not None:
+        cache_event("serp", "hit")
+        return list(cached)
+
+    def _load_or_search():
+        comps = get_shared_store().get(_SERP_NAMESPACE, key)
+        if comps is not None:
+            cache_event("serp", "shared_hit")
+        else:
+            cache_event("serp", "miss")
+            comps = _search_competitor_urls(keyword, num_results, hl, gl)
+            if comps is None:
+                return []   # エラーはキャッシュしない
+            get_shared_store().set(_SERP_NAMESPACE, key, comps, ttl=SERP_CACHE_TTL)
+        _serp_memory.set(key, comps, ttl=SERP_CACHE_TTL)
+        return comps
+
+    return list(_serp_flight.do(key, _load_or_search))
+
+# 再試行する SerpAPI のエラー（小文字で部分一致）。検索結果なし・キー不正などは再試行しない
+_SERPAPI_RETRYABLE = ("rate limit", "too many requests", "temporarily", "try again", "timed out", "internal")
+
+def _search_competitor_urls(keyword, num_results, hl, gl):
+    """SerpAPI を実際に呼ぶ。失敗時は None（キャッシュしないため空リストと区別する）"""
     api_key = _serpapi_key()
     if not api_key:
         print("⚠️ SERPAPI_KEY が未設定のためスキップします。")
-        return []
+        return None
 
     params = {
         "engine": "google",
         "q": keyword,
         "api_key": api_key,
         "num": num_results,
-        "hl": "ja",  # 日本語
-        "gl": "jp",  # 日本
+        "hl": hl,  # 日本語
+        "gl": gl,  # 日本
     }
 
+    def _search():
+        with span("serpapi.search"):
+            results = GoogleSearch(params).get_dict()
+        error = results.get("error")
+        # SerpAPI は 429/5xx でも例外ではなく error 文字列を返すので、再試行できるものは例外にする
+        if error and any(s in str(error).lower() for s in _SERPAPI_RETRYABLE):
+            raise RetryableError(error, status=429 if "rate" in str(error).lower() else 503)
+        return results
+
     try:
-        results = GoogleSearch(params).get_dict()
+        results = rate_limited("serpapi", _search)
     except Exception as e:
         print(f"⚠️ SerpAPI通信エラー: {e}")
-        return []
+        return None
 
     if results.get("error"):
         print(f"⚠️ SerpAPIエラー: {results.get('error')}")
-        return []
+        return None
 
     comps = []
     for i, r in enumerate(results.get("organic_results", []), start=1):
@@ -48,14 +107,68 @@ def get_top_competitor_urls(keyword, num_results=5):
 
 def get_meta_info_from_url(url):
     try:
-        headers = {"User-Agent": "Mozilla/5.0"}
-        response = requests.get(url, timeout=5, headers=headers)
-        response.raise_for_status()
-        soup = BeautifulSoup(response.text, "html.parser")
-        title = soup.title.string.strip() if soup.title and soup.title.string else ""
-        desc_tag = soup.find("meta", attrs={"name": "description"})
-        description = (desc_tag.get("content") or "").strip() if desc_tag else ""
-        return {"url": url, "title": title, "description": description}
+        meta = fetch_page_meta(url)   # キャッシュ優先（期限切れなら条件付き GET）
+        return {"url": url, "title": meta["title"], "description": meta["description"]}
     except Exception as e:
         print(f"⚠️ Meta取得エラー: {url} -> {e}")
         return {"url": url, "title": "", "description": ""}
+
+
+# --- 競合ページの並列取得 -------------------------------------------------------
+
+def _host_of(url: str) -> str:
+    try:
+        return (urlparse(url).netloc or "").lower()
+    except Exception:
+        return ""
+
+def fetch_meta_infos(urls, *, max_workers: int = 5, per_host: int = 2, deadline: float = 8.0):
+    """
+    複数URLの meta 情報を並列で取得する。
+    - max_workers: 全体の同時接続数
+    - per_host:    同一ホストへの同時接続数の上限
+    - deadline:    全体の締切（秒）。間に合わなかったURLは空の meta を返す
+    返値は入力（SERP）順の list[dict]。所要時間は「合計」ではなく「最も遅いページ」程度になる。
+    """
+    urls = list(urls or [])
+    if not urls:
+        return []
+
+    host_slots = {}
+    slots_lock = threading.Lock()
+
+    def _slot(host):
+        with slots_lock:
+            if host not in host_slots:
+                host_slots[host] = threading.BoundedSemaphore(max(1, per_host))
+            return host_slots[host]
+
+    started = time.monotonic()
+
+    def _fetch(u):
+        sem = _slot(_host_of(u))
+        # ホスト枠の待ちで締切を超えるなら取得しない
+        remaining = deadline - (time.monotonic() - started)
+        if remaining <= 0 or not sem.acquire(timeout=remaining):
+            return {"url": u, "title": "", "description": ""}
+        try:
+            return get_meta_info_from_url(u)
+        finally:
+            sem.release()
+
+    pool = ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(urls))))
+    try:
+        futures = [pool.submit(_fetch, u) for u in urls]
+        wait(futures, timeout=deadline)
+    finally:
+        # 締切を過ぎたものは待たずに打ち切る（実行中のものはバックグラウンドで終わらせる）
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    results = []
+    for u, f in zip(urls, futures):
+        if f.done() and not f.cancelled() and f.exception() is None:
+            results.append(f.result())
+        else:
+            print(f"⚠️ Meta取得タイムアウト: {u}")
+            results.append({"url": u, "title": "", "description": ""})
+    return results
@@ -0,0 +1,31 @@
+from contextlib import contextmanager
+
+# --- 外部サービスごとの同時実行枠 ---------------------------------------------------
+# 一括実行（batch_runner）では複数プロセスが同じ API を叩くので、
+# サービスごとにプロセス間で共有するセマフォを登録して同時実行数を抑える。
+# 何も登録されていなければ（通常の Web 実行）枠なしでそのまま実行する。
+# 枠はブロック全体で握るので、中の rate_limit.call がレート制限・再試行で待つあいだも
+# 枠は空かない（待ちは最長 RATE_LIMIT_MAX_WAIT 程度。その間は同じサービスの他の処理も待つ）。
+
+SERVICES = ("gsc", "ga", "serpapi", "scrape", "openai", "sheets")
+
+_slots = {}
+
+
+def configure(slots: dict):
+    """{サービス名: セマフォ（acquire/release を持つもの）} を登録する"""
+    _slots.clear()
+    _slots.update({k: v for k, v in (slots or {}).items() if v is not None})
+
+
+@contextmanager
+def slot(service: str):
+    sem = _slots.get(service)
+    if sem is None:
+        yield
+        return
+    sem.acquire()
+    try:
+        yield
+    finally:
+        sem.release()
@@ -1,11 +1,14 @@
 import gspread
 
+from client_cache import get_client
+from metrics import span
+
 # gspread は引数で渡されたユーザーOAuth Credentialsを利用します
 # （ADC/サービスアカウントは使いません）
 
 def get_gspread_client(creds):
-    """ユーザーOAuthのCredentialsから gspread クライアントを作成"""
-    return gspread.authorize(creds)
+    """ユーザーOAuthのCredentialsから gspread クライアントを作成（資格情報単位で使い回す）"""
+    return get_client("gspread", creds, gspread.authorize)
 
 def get_spreadsheet(creds, spreadsheet_id):
     """スプレッドシートを開く（ユーザーの権限で）"""
@@ -28,11 +31,142 @@ def update_sheet(worksheet, headers, data):
     values = [headers] + data
     worksheet.update('A1', values)
 
+COMPETITOR_HEADERS = ["URL", "タイトル", "メタディスクリプション"]
+
+def competitor_rows(competitor_data):
+    return [[c.get("URL",""), c.get("タイトル",""), c.get("メタディスクリプション","")] for c in competitor_data]
+
 def write_competitor_data_to_sheet(spreadsheet, competitor_data):
     worksheet = get_or_create_worksheet(spreadsheet, "競合分析")
-    headers = ["URL", "タイトル", "メタディスクリプション"]
-    values = [[c.get("URL",""), c.get("タイトル",""), c.get("メタディスクリプション","")] for c in competitor_data]
-    update_sheet(worksheet, headers, values)
+    update_sheet(worksheet, COMPETITOR_HEADERS, competitor_rows(competitor_data))
+
+# --- まとめて書き込む（メタデータ取得 1 回 + batchUpdate 1 回） -------------------
+# シートごとに worksheet() / clear() / update() を呼ぶと 1 解析で 6 回以上の往復になり
+# Sheets API のクォータに当たりやすい。ここでは
+#   1) シート一覧（sheetId / 行列数）を 1 回だけ取得
+#   2) 足りないシートの追加・グリッド拡張・全消去・書き込みを 1 回の batchUpdate で送る
+# diff=True のときは既存の値を 1 回の batchGet で読み、変わった行だけを values.batchUpdate で書く。
+
+def _cell(value) -> dict:
+    if isinstance(value, bool):
+        return {"userEnteredValue": {"boolValue": value}}
+    if isinstance(value, (int, float)):
+        return {"userEnteredValue": {"numberValue": value}}
+    return {"userEnteredValue": {"stringValue": "" if value is None else str(value)}}
+
+def _same_cell(old, new) -> bool:
+    """batchGet（UNFORMATTED_VALUE）の値と書き込む値が同じか"""
+    if isinstance(new, (int, float)) and not isinstance(new, bool):
+        try:
+            return float(old) == float(new)
+        except (TypeError, ValueError):
+            return False
+    return ("" if old is None else str(old)) == ("" if new is None else str(new))
+
+def _a1_range(title: str, first_row: int, last_row: int, n_cols: int) -> str:
+    """0 始まりの行番号 → 'シート名'!A{n}:{列}{m}"""
+    col, n = "", n_cols
+    while n > 0:
+        n, rem = divmod(n - 1, 26)
+        col = chr(65 + rem) + col
+    escaped = title.replace("'", "''")
+    return f"'{escaped}'!A{first_row + 1}:{col}{last_row + 1}"
+
+def _changed_row_ranges(old_rows, new_rows, n_cols: int) -> list[tuple[int, int]]:
+    """変わった行（旧データより短くなった分の消去も含む）を連続区間 [(start, end), ...] にまとめる"""
+    changed = []
+    for i in range(max(len(old_rows), len(new_rows))):
+        old = list(old_rows[i]) if i < len(old_rows) else []
+        new = list(new_rows[i]) if i < len(new_rows) else []
+        old += [""] * (n_cols - len(old))
+        new += [""] * (n_cols - len(new))
+        if not all(_same_cell(o, v) for o, v in zip(old, new)):
+            changed.append(i)
+    ranges = []
+    for i in changed:
+        if ranges and ranges[-1][1] == i - 1:
+            ranges[-1] = (ranges[-1][0], i)
+        else:
+            ranges.append((i, i))
+    return ranges
+
+def export_sheet_tabs(creds, spreadsheet_id, tabs: dict, *, diff: bool = False):
+    """
+    複数シートをまとめて書き込む。
+    tabs: {シート名: (headers, rows)}。各シートは「クリアしてから A1 に書く」のと同じ結果になる。
+    diff=True なら既存の内容と比べて変わった行だけ書く（シートの追加や拡張が要るときは全書き込み）。
+    """
+    http = get_gspread_client(creds).http_client
+    with span("sheets.metadata"):
+        meta = http.fetch_sheet_metadata(
+            spreadsheet_id, params={"fields": "sheets.properties(sheetId,title,gridProperties)"}
+        )
+    existing = {s["properties"]["title"]: s["properties"] for s in meta.get("sheets", [])}
+    values = {title: [list(headers)] + [list(r) for r in rows] for title, (headers, rows) in tabs.items()}
+
+    def _needs_grid(title):
+        grid = existing[title].get("gridProperties", {})
+        n_cols = max((len(r) for r in values[title]), default=0)
+        return len(values[title]) > grid.get("rowCount", 0) or n_cols > grid.get("columnCount", 0)
+
+    if diff and all(t in existing and not _needs_grid(t) for t in tabs):
+        with span("sheets.read"):
+            current = http.values_batch_get(
+                spreadsheet_id,
+                [_a1_range(t, 0, existing[t]["gridProperties"]["rowCount"] - 1,
+                           existing[t]["gridProperties"]["columnCount"]) for t in tabs],
+                params={"valueRenderOption": "UNFORMATTED_VALUE"},
+            )
+        data = []
+        for title, vr in zip(tabs, current.get("valueRanges", [])):
+            new_rows = values[title]
+            n_cols = max([len(r) for r in new_rows] + [len(r) for r in vr.get("values", [])] + [1])
+            for start, end in _changed_row_ranges(vr.get("values", []), new_rows, n_cols):
+                block = [
+                    (list(new_rows[i]) if i < len(new_rows) else []) for i in range(start, end + 1)
+                ]
+                block = [r + [""] * (n_cols - len(r)) for r in block]
+                data.append({"range": _a1_range(title, start, end, n_cols), "values": block})
+        if data:
+            with span("sheets.write", ranges=len(data)):
+                http.values_batch_update(spreadsheet_id, {"valueInputOption": "RAW", "data": data})
+        print(f"✅ Sheets 差分書き込み: {len(data)} 範囲")
+        return
+
+    used_ids = {p["sheetId"] for p in existing.values()}
+    requests = []
+    for title, rows in values.items():
+        n_rows = max(len(rows), 100)
+        n_cols = max(max((len(r) for r in rows), default=0), 20)
+        if title in existing:
+            sheet_id = existing[title]["sheetId"]
+            grid = existing[title].get("gridProperties", {})
+            if _needs_grid(title):
+                requests.append({"updateSheetProperties": {
+                    "properties": {"sheetId": sheet_id, "gridProperties": {
+                        "rowCount": max(grid.get("rowCount", 0), len(rows)),
+                        "columnCount": max(grid.get("columnCount", 0), n_cols),
+                    }},
+                    "fields": "gridProperties(rowCount,columnCount)",
+                }})
+            # worksheet.clear() と同じく値だけ消す
+            requests.append({"updateCells": {"range": {"sheetId": sheet_id}, "fields": "userEnteredValue"}})
+        else:
+            sheet_id = max(used_ids | {0}) + 1
+            used_ids.add(sheet_id)
+            requests.append({"addSheet": {"properties": {
+                "sheetId": sheet_id, "title": title,
+                "gridProperties": {"rowCount": n_rows, "columnCount": n_cols},
+            }}})
+            print(f"🆕 『{title}』シートを新規作成します。")
+        requests.append({"updateCells": {
+            "start": {"sheetId": sheet_id, "rowIndex": 0, "columnIndex": 0},
+            "rows": [{"values": [_cell(v) for v in r]} for r in rows],
+            "fields": "userEnteredValue",
+        }})
+    with span("sheets.write", requests=len(requests)):
+        http.batch_update(spreadsheet_id, {"requests": requests})
+    print(f"✅ Sheets 一括書き込み: {len(values)} シート")
 
 # （任意）新規スプレッドシートをユーザーのDrive上に作成したいとき
 def create_spreadsheet(creds, title="Mr.SEO 出力シート"):
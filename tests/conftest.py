@@ -0,0 +1,5 @@
+import os
+import sys
+
+# モジュールはリポジトリ直下に平置きなので、そこを import パスに入れる
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
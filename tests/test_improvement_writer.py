@@ -0,0 +1,188 @@
+import threading
+import time
+
+import pytest
+
+from cache_utils import SqliteStore
+from improvement_writer import ImprovementWriter
+
+
+# --- Firestore の代役（WriteBatch の set / update と、ドキュメントの delete だけ） ---
+
+class NotFound(Exception):
+    pass
+
+
+class FakeRef:
+    def __init__(self, db, doc_id):
+        self.db, self.id = db, doc_id
+
+    def delete(self):
+        with self.db.lock:
+            self.db.docs.pop(self.id, None)
+            self.db.deleted.append(self.id)
+
+    def collection(self, name):
+        return FakeCollection(self.db, prefix=f"{self.id}/{name}/")
+
+
+class FakeCollection:
+    def __init__(self, db, prefix=""):
+        self.db, self.prefix = db, prefix
+
+    def document(self, doc_id):
+        return FakeRef(self.db, self.prefix + doc_id)
+
+    def stream(self):
+        return []
+
+
+class FakeBatch:
+    def __init__(self, db):
+        self.db, self.ops = db, []
+
+    def set(self, ref, data):
+        self.ops.append(("set", ref, data))
+
+    def update(self, ref, data):
+        self.ops.append(("update", ref, data))
+
+    def commit(self):
+        with self.db.lock:
+            self.db.before_commit(self.ops)
+            for op, ref, data in self.ops:
+                if op == "update" and ref.id not in self.db.docs:
+                    raise NotFound(ref.id)
+            for op, ref, data in self.ops:
+                if op == "set":
+                    self.db.docs[ref.id] = dict(data)
+                else:
+                    self.db.docs[ref.id].update(data)
+
+
+class FakeDB:
+    def __init__(self):
+        self.docs, self.deleted = {}, []
+        self.lock = threading.RLock()
+        self.before_commit = lambda ops: None
+
+    def collection(self, name):
+        return FakeCollection(self)
+
+    def batch(self):
+        return FakeBatch(self)
+
+
+@pytest.fixture
+def shared(tmp_path):
+    # gunicorn のワーカー間で共有する SQLite（同じファイルを別インスタンスで開く）
+    return str(tmp_path / "shared.sqlite3")
+
+
+def _writer(db, shared_path, **kwargs):
+    kwargs.setdefault("flush_interval", 0.01)
+    kwargs.setdefault("retries", 0)
+    return ImprovementWriter(lambda: db, shared_store=SqliteStore(shared_path), **kwargs)
+
+
+def test_save_is_written_and_pending_is_cleared(shared):
+    db = FakeDB()
+    w = _writer(db, shared)
+    doc_id = w.save("u1", "https://example.com/", {"clicks": 1})
+    w.update(doc_id, {"result.chatgpt_response": "改善案"})
+    assert w.flush(5)
+    assert db.docs[doc_id]["uid"] == "u1"
+    assert db.docs[doc_id]["result.chatgpt_response"] == "改善案"
+    assert w.get_pending(doc_id) is None
+    assert _writer(db, shared).get_pending(doc_id) is None
+
+
+def test_other_worker_sees_pending_with_updates(shared):
+    db = FakeDB()
+    gate = threading.Event()
+    db.before_commit = lambda ops: gate.wait(5)
+    w = _writer(db, shared)
+    doc_id = w.save("u1", "https://example.com/", {"clicks": 1})
+    w.update(doc_id, {"result.chatgpt_response": "改善案"})
+    pending = _writer(db, shared).get_pending(doc_id)
+    assert pending["uid"] == "u1"
+    assert pending["result"] == {"clicks": 1, "chatgpt_response": "改善案"}
+    gate.set()
+    assert w.flush(5)
+
+
+def test_cancel_before_write_drops_the_save(shared):
+    db = FakeDB()
+    gate = threading.Event()
+    db.before_commit = lambda ops: gate.wait(5)
+    w = _writer(db, shared, flush_interval=0.5)
+    doc_id = w.save("u1", "https://example.com/", {"clicks": 1})
+    assert w.cancel(doc_id, "u1") is True
+    gate.set()
+    assert w.flush(5)
+    assert doc_id not in db.docs
+
+
+def test_cancel_by_other_user_is_refused(shared):
+    db = FakeDB()
+    w = _writer(db, shared, flush_interval=0.5)
+    doc_id = w.save("u1", "https://example.com/", {"clicks": 1})
+    assert w.cancel(doc_id, "u2") is False
+    assert _writer(db, shared).cancel(doc_id, "u2") is False
+    assert w.flush(5)
+    assert doc_id in db.docs
+
+
+def test_cancel_on_other_worker_leaves_tombstone(shared):
+    db = FakeDB()
+    owner = _writer(db, shared, flush_interval=0.5)
+    doc_id = owner.save("u1", "https://example.com/", {"clicks": 1})
+    other = _writer(db, shared)
+    # 別ワーカーには書き込み前のドキュメントが無いので、呼び出し側で Firestore から消す（False）
+    assert other.cancel(doc_id, "u1") is False
+    assert other.get_pending(doc_id) is None
+    assert owner.flush(5)
+    assert doc_id not in db.docs     # 墓標があるので書かれない（削除したものが復活しない）
+
+
+def test_tombstone_during_commit_deletes_after_write(shared):
+    db = FakeDB()
+    owner = _writer(db, shared)
+    other = _writer(db, shared)
+    cancelled = []
+
+    def _cancel_mid_commit(ops):
+        # 墓標の確認の後、commit の前に別ワーカーで削除された
+        if not cancelled:
+            cancelled.append(other.cancel(ops[0][1].id, "u1"))
+    db.before_commit = _cancel_mid_commit
+
+    doc_id = owner.save("u1", "https://example.com/", {"clicks": 1})
+    assert owner.flush(5)
+    assert cancelled == [False]
+    assert doc_id not in db.docs
+    assert doc_id in db.deleted
+
+
+def test_cancel_after_write_falls_through_to_firestore_delete(shared):
+    db = FakeDB()
+    w = _writer(db, shared, batch_size=2, flush_interval=2.0)
+    doc_id = w.save("u1", "https://example.com/a", {"clicks": 1})
+    w.save("u1", "https://example.com/b", {"clicks": 2})     # 2 件で最初のまとめ書きがすぐ始まる
+
+    # set の commit 中に update が積まれる（set は書き終わるが、ドキュメントはまだキューにある）
+    hooked = []
+    def _update_mid_commit(ops):
+        if not hooked:
+            hooked.append(True)
+            w.update(doc_id, {"result.chatgpt_response": "改善案"})
+    db.before_commit = _update_mid_commit
+
+    deadline = time.monotonic() + 5
+    while not (doc_id in db.docs and w.depth() == 1) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert doc_id in db.docs and w.depth() == 1
+    # 書き込み済みなので True（キューから消しただけ）にはせず、呼び出し側で Firestore から消させる
+    assert w.cancel(doc_id, "u1") is False
+    assert w.depth() == 0
+    assert w.flush(5)
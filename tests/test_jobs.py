@@ -0,0 +1,77 @@
+import time
+
+import pytest
+
+from jobs import (
+    STATUS_DONE, STATUS_FAILED, STATUS_QUEUED, STATUS_RUNNING,
+    InMemoryJobStore, JobLimitExceeded, SqliteJobStore,
+)
+
+
+def _job(job_id, owner="u1", status=STATUS_QUEUED, created_at=None, **extra):
+    return {"id": job_id, "owner": owner, "status": status, "payload": {"url": "https://example.com/"},
+            "created_at": time.time() if created_at is None else created_at, **extra}
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store(request, tmp_path):
+    if request.param == "memory":
+        return InMemoryJobStore(stale_after=60)
+    return SqliteJobStore(str(tmp_path / "jobs.sqlite3"), stale_after=60)
+
+
+def test_create_enforces_per_user_limit(store):
+    store.create(_job("a"), per_user_limit=2)
+    store.create(_job("b"), per_user_limit=2)
+    with pytest.raises(JobLimitExceeded):
+        store.create(_job("c"), per_user_limit=2)
+    # 他のユーザーは別枠
+    store.create(_job("d", owner="u2"), per_user_limit=2)
+    assert store.get("c") is None
+    assert store.count_active("u1") == 2
+
+
+def test_create_enforces_max_pending(store):
+    store.create(_job("a", owner="u1"), max_pending=2)
+    store.create(_job("b", owner="u2"), max_pending=2)
+    with pytest.raises(JobLimitExceeded):
+        store.create(_job("c", owner="u3"), max_pending=2)
+    assert store.count_active() == 2
+
+
+def test_finished_jobs_do_not_count(store):
+    store.create(_job("a"), per_user_limit=1)
+    store.update("a", status=STATUS_DONE, result={"ok": True}, finished_at=time.time())
+    store.create(_job("b"), per_user_limit=1)
+    assert store.get("a")["result"] == {"ok": True}
+
+
+def test_stale_jobs_are_failed_and_free_the_slot(store):
+    old = time.time() - 3600
+    store.create(_job("queued", created_at=old))
+    store.create(_job("running", owner="u2", created_at=old))
+    store.update("running", status=STATUS_RUNNING, started_at=old)
+    # 取り残されたジョブは次の投入で失敗になり、上限の数から外れる
+    store.create(_job("fresh"), per_user_limit=1, max_pending=1)
+    for job_id in ("queued", "running"):
+        job = store.get(job_id)
+        assert job["status"] == STATUS_FAILED
+        assert job["error"]
+    assert store.get("fresh")["status"] == STATUS_QUEUED
+
+
+def test_recently_started_job_is_not_stale(store):
+    store.create(_job("a", created_at=time.time() - 3600))
+    store.update("a", status=STATUS_RUNNING, started_at=time.time())
+    with pytest.raises(JobLimitExceeded):
+        store.create(_job("b"), per_user_limit=1)
+    assert store.get("a")["status"] == STATUS_RUNNING
+
+
+def test_sqlite_limit_is_shared_between_store_instances(tmp_path):
+    # gunicorn の別ワーカー（別の接続）からの投入も同じ上限に数える
+    path = str(tmp_path / "jobs.sqlite3")
+    SqliteJobStore(path).create(_job("a"), per_user_limit=1)
+    with pytest.raises(JobLimitExceeded):
+        SqliteJobStore(path).create(_job("b"), per_user_limit=1)
+    assert SqliteJobStore(path).get("b") is None
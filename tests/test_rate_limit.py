@@ -0,0 +1,89 @@
+import time
+import uuid
+
+import pytest
+
+import rate_limit
+from rate_limit import RateLimitExceeded, TokenBucket, backoff_delay, call
+
+
+class QuotaError(Exception):
+    """429 と Retry-After を持つ API エラーの代役"""
+
+    def __init__(self, retry_after=None):
+        super().__init__("quota exceeded")
+        self.status_code = 429
+        self.retry_after = retry_after
+
+
+def _key():
+    # キー単位のバケットはプロセス内で共有されるので、テストごとに別のキーを使う
+    return uuid.uuid4().hex
+
+
+def test_token_bucket_waits_after_burst():
+    bucket = TokenBucket(rate=10, burst=2)
+    now = time.monotonic()
+    assert bucket.reserve(now) == 0
+    assert bucket.reserve(now) == 0
+    assert bucket.reserve(now) == pytest.approx(0.1)
+    bucket.refund()
+    assert bucket.reserve(now) == pytest.approx(0.1)
+
+
+def test_backoff_respects_retry_after():
+    assert backoff_delay(0, retry_after=5) >= 5
+    assert backoff_delay(0, retry_after=10_000) <= 60.5
+
+
+def test_call_retries_then_succeeds(monkeypatch):
+    monkeypatch.setattr(rate_limit, "backoff_delay", lambda attempt, retry_after=None: 0.01)
+    calls = []
+
+    def flaky():
+        calls.append(1)
+        if len(calls) < 3:
+            raise QuotaError()
+        return "ok"
+
+    assert call("gsc", flaky, key=_key(), retries=3) == "ok"
+    assert len(calls) == 3
+
+
+def test_429_pause_is_capped_at_max_wait(monkeypatch):
+    monkeypatch.setattr(rate_limit, "MAX_WAIT", 0.2)
+    key = _key()
+    calls = []
+
+    def quota():
+        calls.append(1)
+        raise QuotaError(retry_after=90)
+
+    started = time.monotonic()
+    # 待ちが MAX_WAIT を超えても RateLimitExceeded ではなく元の 429 を投げる
+    with pytest.raises(QuotaError):
+        call("gsc", quota, key=key, retries=2)
+    assert len(calls) == 3
+    assert time.monotonic() - started < 2
+    _, paused = rate_limit._key_bucket("gsc", key).state()
+    assert paused <= 0.2
+
+
+def test_non_retryable_error_is_raised_immediately():
+    calls = []
+
+    def broken():
+        calls.append(1)
+        raise ValueError("bad request")
+
+    with pytest.raises(ValueError):
+        call("gsc", broken, key=_key(), retries=3)
+    assert len(calls) == 1
+
+
+def test_acquire_gives_up_beyond_max_wait(monkeypatch):
+    monkeypatch.setattr(rate_limit, "MAX_WAIT", 0.1)
+    key = _key()
+    rate_limit._key_bucket("gsc", key).pause(5)
+    with pytest.raises(RateLimitExceeded):
+        rate_limit.acquire("gsc", key)
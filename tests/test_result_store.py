@@ -0,0 +1,80 @@
+from result_store import RESULT_FORMAT, _BLOB_CHUNK, _OFFLOAD_OVER, pack_result, unpack_result
+
+
+def _result(n_rows: int) -> dict:
+    return {
+        "clicks": 12, "impressions": 340, "ctr": 3.53, "position": 8.2, "conversions": 1,
+        "competitors": [{"position": 1, "title": "競合", "url": "https://comp.example/", "メタディスクリプション": "説明"}],
+        "chatgpt_response": "改善案",
+        "table_columns": {
+            "URL":          [f"https://example.com/p{i}" for i in range(n_rows)],
+            "クリック数":     [i % 7 for i in range(n_rows)],
+            "表示回数":      [i * 3 for i in range(n_rows)],
+            "CTR（%）":      [round((i % 7) / (i * 3 + 1) * 100, 2) for i in range(n_rows)],
+            "平均順位":      [round(1 + i % 50 / 3, 2) for i in range(n_rows)],
+            "コンバージョン数": [i % 2 for i in range(n_rows)],
+        },
+    }
+
+
+def test_small_table_round_trip():
+    result = _result(5)
+    packed, blobs = pack_result(result)
+    assert packed["format"] == RESULT_FORMAT
+    assert packed["table"]["encoding"] == "json"
+    assert blobs == []
+    out = unpack_result(packed)
+    assert out["table_columns"] == result["table_columns"]
+    assert out["chatgpt_response"] == "改善案"
+    assert out["competitors"][0]["URL"] == "https://comp.example/"
+    assert out["chart_labels"]
+
+
+def test_compressed_table_round_trip():
+    result = _result(2000)
+    packed, blobs = pack_result(result)
+    assert packed["table"]["encoding"] == "zlib"
+    assert blobs == []
+    assert unpack_result(packed)["table_columns"] == result["table_columns"]
+
+
+def test_offloaded_table_round_trip():
+    # 圧縮しても大きい表はサイドドキュメント（blob チャンク）に逃がす
+    n = 1
+    while True:
+        result = _result(n)
+        packed, blobs = pack_result(result)
+        if blobs:
+            break
+        n *= 4
+    assert packed["table"] == {"encoding": "zlib-blob", "chunks": len(blobs)}
+    assert all(len(b) <= _BLOB_CHUNK for b in blobs)
+    assert sum(map(len, blobs)) > _OFFLOAD_OVER
+    assert unpack_result(packed, lambda: blobs)["table_columns"] == result["table_columns"]
+
+
+def test_offloaded_table_without_blobs_is_empty():
+    packed = {"format": RESULT_FORMAT, "table": {"encoding": "zlib-blob", "chunks": 2}}
+    assert unpack_result(packed, lambda: [])["table_columns"] == {}
+
+
+def test_legacy_doc_rebuilds_columns_from_chart_data():
+    legacy = {
+        "clicks": 3,
+        "table_html": "<table></table>",
+        "chart_labels": ["https://example.com/a", "https://example.com/b"],
+        "chart_data": {"clicks": [2, 1], "impressions": [20, 10], "unknown": [0, 0]},
+        "chatgpt_response": "旧形式",
+    }
+    out = unpack_result(legacy)
+    assert "table_html" not in out
+    assert out["table_columns"]["URL"] == legacy["chart_labels"]
+    assert out["table_columns"]["クリック数"] == [2, 1]
+    assert out["table_columns"]["表示回数"] == [20, 10]
+    assert out["chatgpt_response"] == "旧形式"
+
+
+def test_legacy_doc_with_columns_is_kept():
+    legacy = {"table_columns": {"URL": ["https://example.com/"], "クリック数": [1]}, "clicks": 1}
+    assert unpack_result(legacy)["table_columns"] == legacy["table_columns"]
+    assert unpack_result(None) == {}